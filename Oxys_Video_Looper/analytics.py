@@ -0,0 +1,277 @@
+# License: GNU GPLv2, see LICENSE.txt
+"""Record every button press in a ring file for visitor statistics.
+
+Each press is one fixed size record: when it happened, the button code,
+the time from the press until VLC played the clip, how long the clip was
+watched and flags for clips that were cut short by the next press or not
+played at all. The file holds at most `capacity` records after a header,
+once it is full the oldest are overwritten, so it never grows beyond its
+size on the SD card.
+
+Records are collected in memory and written in batches by a worker
+thread, at most every `flush_interval` seconds, with one fdatasync per
+batch. The header with the number of records written is synced with the
+next batch, a power cut loses at most the last batch.
+
+    python3 -m Oxys_Video_Looper.analytics ~/.local/share/video_looper/plays.dat --by day
+"""
+import asyncio
+import collections
+import os
+import struct
+import threading
+import time
+
+from . import log, metrics
+
+_log = log.get('analytics')
+
+MAGIC = b'OXPL'
+VERSION = 1
+# magic, version, record size, capacity, records written in total
+HEADER = struct.Struct('<4sHHIQ')
+HEADER_SIZE = 64
+# time.time() of the press, button code, press to play in microseconds,
+# watched in milliseconds, flags
+RECORD = struct.Struct('<d16sIIB3x')
+# the clip was replaced by the next press before it ended
+PREEMPTED = 1
+# the press did not play a clip, one was playing or it does not exist
+REFUSED = 2
+
+MIB = 1 << 20
+_READ_RECORDS = 4096
+# one write at a time, a log replaced by a reload may still be writing
+# to the same file
+_write_lock = threading.Lock()
+
+PLAY_LOG_RECORDS = metrics.REGISTRY.counter(
+    'looper_play_log_records_total', 'Presses written to the play log, or dropped when it could not be written.',
+    ('result',))
+
+Play = collections.namedtuple('Play', 'time code latency watched flags')
+
+
+def _clamp(value, limit=0xffffffff):
+    return max(0, min(int(value), limit))
+
+
+class PlayLog:
+    """Ring file of Play records at `path`. record() and track() are cheap
+    and called on the event loop, run() writes the records in the
+    background."""
+
+    def __init__(self, path, capacity, flush_interval=60.0, batch=256):
+        self.path = path
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.batch = batch
+        self._pending = []
+        self._wake = None
+        # tasks of the clips whose press is recorded once they are over
+        self._tracked = set()
+
+    def record(self, code, timestamp=None, latency=0.0, watched=0.0, flags=0):
+        """Add a press at `timestamp`, time.time() by default. Latency and
+        watched are in seconds."""
+        self._pending.append((time.time() if timestamp is None else timestamp, code, latency, watched, flags))
+        if len(self._pending) >= self.batch and self._wake is not None:
+            self._wake.set()
+
+    def track(self, code, handle):
+        """Record a press once the clip it started, a PlayHandle, is over,
+        or right away if `handle` is None because nothing played."""
+        if handle is None:
+            self.record(code, flags=REFUSED)
+            return
+        self._tracked.add(handle.task)
+        handle.task.add_done_callback(lambda task: self._played(code, handle))
+
+    def _played(self, code, handle):
+        self._tracked.discard(handle.task)
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        timestamp = time.time() - (now - handle.requested)
+        if handle.started is None:
+            # VLC went away before the clip started
+            self.record(code, timestamp, flags=REFUSED)
+            return
+        stopped = handle.stopped if handle.stopped is not None else now
+        self.record(code, timestamp, handle.started - handle.requested, stopped - handle.started,
+                    PREEMPTED if handle.preempted else 0)
+
+    def _open(self):
+        """Open the file, creating it if needed. Returns the fd, capacity
+        and number of records written. An existing file keeps its
+        capacity."""
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            header = os.pread(fd, HEADER.size, 0)
+            if len(header) == HEADER.size:
+                magic, version, size, capacity, written = HEADER.unpack(header)
+                if magic != MAGIC or version != VERSION or size != RECORD.size:
+                    raise ValueError('{0} is not a play log'.format(self.path))
+                return fd, capacity, written
+            os.pwrite(fd, HEADER.pack(MAGIC, VERSION, RECORD.size, self.capacity, 0).ljust(HEADER_SIZE, b'\0'), 0)
+            return fd, self.capacity, 0
+        except BaseException:
+            os.close(fd)
+            raise
+
+    def _write(self, records):
+        """Append records to the ring, runs in a worker thread."""
+        data = b''.join(RECORD.pack(timestamp, code.encode('utf-8')[:16], _clamp(latency * 1e6),
+                                    _clamp(watched * 1e3), flags)
+                        for timestamp, code, latency, watched, flags in records)
+        with _write_lock:
+            fd, capacity, written = self._open()
+            try:
+                # more than fit only the newest are kept
+                skip = max(0, len(records) - capacity)
+                data = memoryview(data)[skip * RECORD.size:]
+                written += skip
+                count = len(records) - skip
+                slot = written % capacity
+                first = min(count, capacity - slot)
+                os.pwrite(fd, data[:first * RECORD.size], HEADER_SIZE + slot * RECORD.size)
+                if first < count:
+                    os.pwrite(fd, data[first * RECORD.size:], HEADER_SIZE)
+                os.fdatasync(fd)
+                os.pwrite(fd, HEADER.pack(MAGIC, VERSION, RECORD.size, capacity, written + count), 0)
+            finally:
+                os.close(fd)
+
+    async def flush(self):
+        """Write the records collected so far."""
+        records, self._pending = self._pending, []
+        if not records:
+            return
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._write, records)
+            PLAY_LOG_RECORDS.labels('written').inc(len(records))
+        except (OSError, ValueError) as exc:
+            _log.warning('Could not write the play log {0}: {1}', self.path, exc)
+            # keep them for the next try, but not more than the file holds
+            self._pending[:0] = records
+            dropped = len(self._pending) - self.capacity
+            if dropped > 0:
+                del self._pending[:dropped]
+                PLAY_LOG_RECORDS.labels('dropped').inc(dropped)
+
+    async def close(self):
+        """Wait until the clips being tracked are over, then write the rest.
+        For a log that a reload replaced."""
+        try:
+            if self._tracked:
+                await asyncio.wait(list(self._tracked))
+        finally:
+            if self._pending:
+                await asyncio.shield(self.flush())
+
+    async def run(self):
+        """Write batches until cancelled, then the rest."""
+        self._wake = asyncio.Event()
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wake.clear()
+                await self.flush()
+        finally:
+            if self._pending:
+                # the thread finishes the write even if we are cancelled again
+                await asyncio.shield(self.flush())
+
+
+def read_plays(path):
+    """Yield the Plays in a play log file, oldest first, reading a few
+    thousand records at a time."""
+    with open(path, 'rb') as f:
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return
+        magic, version, size, capacity, written = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION or size != RECORD.size:
+            raise ValueError('{0} is not a play log'.format(path))
+        count = min(written, capacity)
+        start = written % capacity if written > capacity else 0
+        for first, last in ((start, count), (0, start if written > capacity else 0)):
+            f.seek(HEADER_SIZE + first * RECORD.size)
+            for offset in range(first, last, _READ_RECORDS):
+                data = f.read(min(_READ_RECORDS, last - offset) * RECORD.size)
+                for timestamp, code, latency, watched, flags in RECORD.iter_unpack(
+                        data[:len(data) - len(data) % RECORD.size]):
+                    if timestamp:
+                        yield Play(timestamp, code.rstrip(b'\0').decode('utf-8', 'replace'),
+                                   latency / 1e6, watched / 1e3, flags)
+
+
+PERIODS = {'hour': '%Y-%m-%d %H:00', 'day': '%Y-%m-%d'}
+
+
+def rollup(plays, period='day', since=None):
+    """Sum up Plays by local `period`, see PERIODS, and button code. Returns
+    a list of (period, code, stats dict) in order."""
+    fmt = PERIODS[period]
+    totals = {}
+    for play in plays:
+        if since is not None and play.time < since:
+            continue
+        key = (time.strftime(fmt, time.localtime(play.time)), play.code)
+        total = totals.get(key)
+        if total is None:
+            total = totals[key] = [0, 0, 0, 0.0, 0.0]
+        total[0] += 1
+        if not play.flags & REFUSED:
+            total[1] += 1
+            total[3] += play.latency
+            total[4] += play.watched
+        if play.flags & PREEMPTED:
+            total[2] += 1
+    return [(when, code, {'presses': presses, 'plays': played, 'preempted': preempted,
+                          'latency': latency / played if played else None, 'watched': watched})
+            for (when, code), (presses, played, preempted, latency, watched) in sorted(totals.items())]
+
+
+def create_play_log(config):
+    """Create the play log of the [analytics] section of the config, or None
+    if it is disabled."""
+    path = config.get('analytics', 'file', fallback='').strip()
+    if not path:
+        return None
+    size = int(config.getfloat('analytics', 'size', fallback=4) * MIB)
+    return PlayLog(os.path.expanduser(path), max(1, (size - HEADER_SIZE) // RECORD.size),
+                   config.getfloat('analytics', 'flush_interval', fallback=60))
+
+
+def main():
+    import argparse
+    import datetime
+    import json
+
+    parser = argparse.ArgumentParser(description="Sum up the button presses in a play log.")
+    parser.add_argument('path')
+    parser.add_argument('--by', choices=sorted(PERIODS), default='day')
+    parser.add_argument('--since', help="only presses from this date on, e.g. 2024-05-01")
+    parser.add_argument('--json', action='store_true', help="one JSON object per line")
+    args = parser.parse_args()
+    since = datetime.datetime.fromisoformat(args.since).timestamp() if args.since else None
+
+    rows = rollup(read_plays(args.path), args.by, since)
+    if not args.json:
+        print('{0:<16} {1:<16} {2:>7} {3:>7} {4:>9} {5:>11} {6:>11}'.format(
+            args.by, 'button', 'presses', 'plays', 'preempted', 'latency ms', 'watched s'))
+    for when, code, stats in rows:
+        if args.json:
+            print(json.dumps(dict(stats, **{args.by: when, 'code': code})))
+            continue
+        print('{0:<16} {1:<16} {2:>7} {3:>7} {4:>9} {5:>11} {6:>11.0f}'.format(
+            when, code, stats['presses'], stats['plays'], stats['preempted'],
+            '-' if stats['latency'] is None else '{0:.1f}'.format(stats['latency'] * 1000), stats['watched']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+# License: GNU GPLv2, see LICENSE.txt
+"""Latency benchmark of the control path against the fake VLC server.
+
+Drives VlcPlayer directly and a whole VideoLooper (with mock LEDs and no
+input devices) with scripted button presses, and reports per scenario:
+
+- VLC commands per press, until the clip plays and in total
+- press-to-play latency: press until the fake VLC starts the clip
+- clip end detection error: VLC leaving the clip until the player notices
+
+    python3 -m Oxys_Video_Looper.bench --presses 20 --latency 0.002
+
+Runs on any Linux box, --max-p95 makes it fail when the press-to-play
+latency regresses.
+"""
+import argparse
+import asyncio
+import configparser
+import json
+import os
+import sys
+import tempfile
+import time
+
+from .fakevlc import FakeVlc, FakeVlcServer
+from .model import Movie
+
+BUTTONS = ['BTN_TRIGGER', 'BTN_THUMB', 'BTN_THUMB2', 'BTN_TOP', 'BTN_TOP2', 'BTN_PINKIE']
+
+
+def percentile(values, p):
+    """Nearest-rank percentile, None for no values."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(p / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def make_media(path):
+    """Create empty movie files for the loop and every button."""
+    for name in ['loop'] + BUTTONS:
+        open(os.path.join(path, name + '.mp4'), 'w').close()
+
+
+def make_config(server, clip_bank, media):
+    config = configparser.ConfigParser()
+    config.read_dict({
+        'video_looper': {'video_player': 'vlc', 'console_output': 'false', 'loop': 'loop.mp4'},
+        'directory': {'path': media, 'index_cache': ''},
+        'vlc': {'server': server, 'clip_bank': str(clip_bank).lower(), 'clips': ','.join(BUTTONS)},
+        'input': {'devices': '/nonexistent/event*', 'debounce': '0'},
+        'leds': {'pin_factory': 'mock'},
+        # leave the socket of a looper running on this machine alone
+        'control': {'socket': ''},
+    })
+    return config
+
+
+class Scenario:
+    """Collects the numbers of one benchmark scenario."""
+
+    def __init__(self, name, vlc):
+        self.name = name
+        self.vlc = vlc
+        self.latencies = []
+        self.end_errors = []
+        self.commands_to_play = []
+        self.commands = []
+
+    def record(self, code, pressed, commands_before, handle):
+        """Match a finished press with what the fake VLC did."""
+        start = None
+        for index, name, started, ended in self.vlc.history:
+            if started >= pressed and os.path.splitext(name)[0] == code:
+                start = (started, ended)
+                break
+        self.commands.append(len(self.vlc.commands) - commands_before)
+        if start is None:
+            return
+        self.latencies.append(start[0] - pressed)
+        # commands sent before the clip started: those up to the add/goto
+        for count, line in enumerate(self.vlc.commands[commands_before:], 1):
+            if line.startswith('add ') or line.startswith('goto '):
+                self.commands_to_play.append(count)
+                break
+        if start[1] is not None and handle is not None and handle.ended is not None:
+            self.end_errors.append(handle.ended - start[1])
+
+    def report(self):
+        def ms(value):
+            return None if value is None else round(value * 1000, 2)
+        return {
+            'scenario': self.name,
+            'presses': len(self.commands),
+            'commands_per_press': round(sum(self.commands) / max(1, len(self.commands)), 1),
+            'commands_to_play': round(sum(self.commands_to_play) / max(1, len(self.commands_to_play)), 1),
+            'latency_ms': {p: ms(percentile(self.latencies, p)) for p in (50, 90, 95, 99, 100)},
+            'end_error_ms': {p: ms(percentile(self.end_errors, p)) for p in (50, 90, 99, 100)},
+        }
+
+
+async def bench_player(name, server, vlc, presses, clip_bank, media):
+    from .vlc import VlcPlayer
+    scenario = Scenario(name, vlc)
+    player = VlcPlayer(make_config(server, clip_bank, media))
+    await player.start(BUTTONS)
+    for i in range(presses):
+        code = BUTTONS[i % len(BUTTONS)]
+        before = len(vlc.commands)
+        pressed = time.monotonic()
+        handle = player.play(Movie(code))
+        await handle
+        scenario.record(code, pressed, before, handle)
+    await player.stop()
+    return scenario
+
+
+async def bench_looper(name, server, vlc, presses, clip_bank, media):
+    from .video_looper import VideoLooper
+    scenario = Scenario(name, vlc)
+    with tempfile.NamedTemporaryFile('w', suffix='.ini', delete=False) as f:
+        make_config(server, clip_bank, media).write(f)
+    try:
+        looper = VideoLooper(f.name)
+    finally:
+        os.unlink(f.name)
+    runner = asyncio.create_task(looper.run_async())
+    player = looper._player
+    while player.changed is None or player.playing_file != 'LOOP' or player.loop_index is None:
+        await asyncio.sleep(0.01)
+    for i in range(presses):
+        code = BUTTONS[i % len(BUTTONS)]
+        before = len(vlc.commands)
+        pressed = time.monotonic()
+        looper._handle_button(code, pressed)
+        while player.current is None:
+            await asyncio.sleep(0.001)
+        handle = player.current
+        await asyncio.gather(handle.task, return_exceptions=True)
+        scenario.record(code, pressed, before, handle)
+    looper.quit()
+    await runner
+    return scenario
+
+
+SCENARIOS = [
+    ('player, add/delete', bench_player, False),
+    ('player, clip bank', bench_player, True),
+    ('looper, clip bank', bench_looper, True),
+]
+
+
+async def run(args):
+    reports = []
+    with tempfile.TemporaryDirectory() as media:
+        make_media(media)
+        for name, bench, clip_bank in SCENARIOS:
+            vlc = FakeVlc({'loop': args.loop_length}, args.clip_length)
+            server = FakeVlcServer(vlc, latency=args.latency)
+            address = await server.start()
+            try:
+                scenario = await bench(name, address, vlc, args.presses, clip_bank, media)
+            finally:
+                await server.close()
+            reports.append(scenario.report())
+    return reports
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the VLC control path.")
+    parser.add_argument('--presses', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.001, help="seconds per VLC command")
+    parser.add_argument('--clip-length', type=float, default=2.0)
+    parser.add_argument('--loop-length', type=float, default=30.0)
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    parser.add_argument('--max-p95', type=float, help="fail if the p95 press-to-play latency exceeds this many ms")
+    args = parser.parse_args()
+
+    reports = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(reports, indent=2))
+    else:
+        for report in reports:
+            print('{scenario}: {presses} presses, {commands_per_press} commands/press '
+                  '({commands_to_play} until playing)'.format(**report))
+            print('  press to play ms  ' + '  '.join('p{0}={1}'.format(p, v) for p, v in report['latency_ms'].items()))
+            print('  end detection ms  ' + '  '.join('p{0}={1}'.format(p, v) for p, v in report['end_error_ms'].items()))
+    if args.max_p95 is not None:
+        worst = max(report['latency_ms'][95] or 0 for report in reports)
+        if worst > args.max_p95:
+            print('p95 press-to-play latency {0} ms exceeds {1} ms'.format(worst, args.max_p95), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+# License: GNU GPLv2, see LICENSE.txt
+"""Notice changes of the config file and tell what changed.
+
+The directory of the file is watched with inotify, so editors that write
+a new file and rename it over the old one are seen as well. Where inotify
+is not available the file is polled with stat.
+"""
+import asyncio
+import configparser
+import os
+
+from . import inotify, log
+
+_log = log.get('config')
+
+
+def read_config(path):
+    """Parse a config file, raises configparser.Error or OSError."""
+    config = configparser.ConfigParser()
+    with open(path) as f:
+        config.read_file(f, path)
+    return config
+
+
+def diff_config(old, new):
+    """Return the set of (section, option) that were added, removed or
+    changed between two ConfigParsers."""
+    changed = set()
+    for section in set(old.sections()) | set(new.sections()):
+        before = dict(old.items(section, raw=True)) if old.has_section(section) else {}
+        after = dict(new.items(section, raw=True)) if new.has_section(section) else {}
+        for option in set(before) | set(after):
+            if before.get(option) != after.get(option):
+                changed.add((section, option))
+    return changed
+
+
+class ConfigWatcher:
+    """Calls `on_change()` once the file at `path` was written or replaced
+    and then stayed unchanged for `settle` seconds. Must be run on the
+    event loop."""
+
+    def __init__(self, path, on_change, settle=0.2, poll_interval=2.0):
+        self.path = os.path.abspath(path)
+        self.on_change = on_change
+        self.settle = settle
+        self.poll_interval = poll_interval
+        self._stat = self._file_stat()
+        self._changed = None
+
+    def _file_stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    async def run(self):
+        """Watch the file until cancelled."""
+        self._changed = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        watcher = None
+        try:
+            watcher = inotify.Inotify()
+            watcher.add_watch(os.path.dirname(self.path),
+                              inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO | inotify.IN_CREATE)
+        except (OSError, AttributeError) as exc:
+            _log.warning('Polling {0} for changes, no inotify: {1}', self.path, exc)
+            if watcher is not None:
+                watcher.close()
+                watcher = None
+        name = os.path.basename(self.path)
+
+        def read_events():
+            if any(event_name == name for wd, mask, cookie, event_name in watcher.read()):
+                self._changed.set()
+
+        if watcher is not None:
+            loop.add_reader(watcher.fileno(), read_events)
+        try:
+            while True:
+                if watcher is not None:
+                    await self._changed.wait()
+                else:
+                    await asyncio.sleep(self.poll_interval)
+                # wait until the editor is done writing
+                while True:
+                    self._changed.clear()
+                    try:
+                        await asyncio.wait_for(self._changed.wait(), self.settle)
+                    except asyncio.TimeoutError:
+                        break
+                stat = self._file_stat()
+                if stat is None:
+                    continue
+                # FAT keeps mtimes in 2 s steps, trust inotify over stat
+                if watcher is None and stat == self._stat:
+                    continue
+                self._stat = stat
+                try:
+                    result = self.on_change()
+                    if asyncio.iscoroutine(result):
+                        await result
+                except Exception:
+                    # keep watching, the next change may fix it
+                    _log.exception('Applying the changes of {0} failed', self.path)
+        finally:
+            if watcher is not None:
+                loop.remove_reader(watcher.fileno())
+                watcher.close()
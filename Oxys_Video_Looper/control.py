@@ -0,0 +1,192 @@
+# License: GNU GPLv2, see LICENSE.txt
+"""Control the looper over a Unix socket, and optionally loopback HTTP.
+
+Every request is one line, JSON or words, and gets one line of JSON back.
+A connection stays open for as many requests as the client sends, the
+answers come in the order of the requests:
+
+    {"cmd": "trigger", "code": "BTN_TOP", "id": 7}  ->  {"queued":true,"ok":true,"id":7}
+    trigger BTN_TOP                                 ->  {"queued":true,"ok":true}
+    status                                          ->  {"playing":"LOOP",...,"ok":true}
+    loop                                            ->  end the clip, back to the loop
+    stop                                            ->  quit the looper
+
+Over HTTP the same is GET /status, POST /trigger/BTN_TOP, POST /loop and
+POST /stop. From the shell, one request or one per line of stdin:
+
+    python3 -m Oxys_Video_Looper.control trigger BTN_TOP
+"""
+import asyncio
+import json
+import os
+import socket
+import stat
+import sys
+
+from . import log
+
+_log = log.get('control')
+
+DEFAULT_SOCKET = '/tmp/video_looper.sock'
+
+
+def parse_request(line):
+    """Return the request dict of a JSON or a `command [code]` line, or
+    raise ValueError."""
+    line = line.strip()
+    if line.startswith(b'{'):
+        request = json.loads(line)
+        if not isinstance(request, dict) or not isinstance(request.get('cmd'), str):
+            raise ValueError('a request needs a "cmd"')
+        return request
+    words = line.decode('utf-8').split()
+    if not words:
+        raise ValueError('empty request')
+    request = {'cmd': words[0]}
+    if len(words) > 1:
+        request['code'] = words[1]
+    return request
+
+
+def _encode(answer):
+    return (json.dumps(answer, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+class ControlServer:
+    """Answers requests with `handlers`, a dict of command name -> function
+    called with the request dict. A handler returns a dict that goes into
+    the answer, or raises ValueError to refuse the request. Handlers run on
+    the event loop and must not block."""
+
+    def __init__(self, handlers, path=DEFAULT_SOCKET, http_port=None):
+        self.handlers = handlers
+        self.path = path
+        self.http_port = http_port
+
+    def dispatch(self, request):
+        """Answer a request dict."""
+        handler = self.handlers.get(request.get('cmd'))
+        try:
+            if handler is None:
+                raise ValueError('unknown command {0}'.format(request.get('cmd')))
+            answer = dict(handler(request))
+            answer['ok'] = True
+        except ValueError as exc:
+            answer = {'ok': False, 'error': str(exc)}
+        if 'id' in request:
+            answer['id'] = request['id']
+        return answer
+
+    def answer(self, line):
+        """Answer a request line with a line of JSON."""
+        try:
+            request = parse_request(line)
+        except ValueError as exc:
+            return _encode({'ok': False, 'error': 'bad request: {0}'.format(exc)})
+        return _encode(self.dispatch(request))
+
+    async def _client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if line.strip():
+                    writer.write(self.answer(line))
+                    await writer.drain()
+        except (ConnectionError, ValueError):
+            # ValueError: a line longer than the stream limit
+            pass
+        except asyncio.CancelledError:
+            # the looper is shutting down, a cancelled connection task makes
+            # asyncio log an error on Python 3.11
+            pass
+        finally:
+            writer.close()
+
+    async def _http(self, reader, writer):
+        try:
+            request = (await reader.readline()).split()
+            while (await reader.readline()).strip():
+                pass
+            method, path = (request[0], request[1]) if len(request) > 1 else (b'', b'')
+            parts = path.decode('utf-8', 'replace').strip('/').split('/')
+            allowed = b'GET' if parts[0] == 'status' else b'POST'
+            if parts[0] not in self.handlers:
+                status, answer = b'404 Not Found', {'ok': False, 'error': 'not found'}
+            elif method != allowed:
+                status, answer = b'405 Method Not Allowed', {'ok': False, 'error': 'use ' + allowed.decode()}
+            else:
+                request = {'cmd': parts[0]}
+                if len(parts) > 1:
+                    request['code'] = parts[1]
+                answer = self.dispatch(request)
+                status = b'200 OK' if answer['ok'] else b'400 Bad Request'
+            body = _encode(answer)
+            writer.write(b'HTTP/1.0 ' + status + b'\r\n'
+                         b'Content-Type: application/json\r\n'
+                         b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def _remove_socket(self):
+        """Remove a socket left behind by an earlier run, nothing else."""
+        try:
+            if stat.S_ISSOCK(os.lstat(self.path).st_mode):
+                os.unlink(self.path)
+        except OSError:
+            pass
+
+    async def run(self):
+        """Serve until cancelled."""
+        servers = []
+        try:
+            if self.path:
+                self._remove_socket()
+                servers.append(await asyncio.start_unix_server(self._client, self.path))
+                _log.info('Control socket {0}', self.path)
+            if self.http_port:
+                servers.append(await asyncio.start_server(self._http, '127.0.0.1', self.http_port))
+                _log.info('Control on http://127.0.0.1:{0}/', self.http_port)
+            await asyncio.Event().wait()
+        finally:
+            for server in servers:
+                server.close()
+            if self.path:
+                self._remove_socket()
+
+
+def create_control_server(config, handlers):
+    """Create the control server of the [control] section of the config, or
+    None if it is disabled."""
+    path = config.get('control', 'socket', fallback=DEFAULT_SOCKET).strip()
+    http_port = config.get('control', 'http_port', fallback='').strip()
+    if not path and not http_port:
+        return None
+    return ControlServer(handlers, os.path.expanduser(path) if path else None, int(http_port) if http_port else None)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Send requests to a running video looper.")
+    parser.add_argument('--socket', default=DEFAULT_SOCKET)
+    parser.add_argument('request', nargs='*', help="e.g. trigger BTN_TOP, without it one request per line of stdin")
+    args = parser.parse_args()
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(args.socket)
+        stream = sock.makefile('rwb')
+        for line in [' '.join(args.request)] if args.request else sys.stdin:
+            if not line.strip():
+                continue
+            stream.write(line.strip().encode('utf-8') + b'\n')
+            stream.flush()
+            print(stream.readline().decode('utf-8').rstrip())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+# License: GNU GPLv2, see LICENSE.txt
+"""Stand-in for ``cvlc --intf telnet`` that needs no video output.
+
+Speaks the part of the VLC telnet protocol used by VLCClient: the password
+handshake and the playlist, playback and time commands. Playback is
+simulated with a clock, every clip plays for its configured duration.
+Replies can be delayed per command to model a slow Pi.
+
+    python3 -m Oxys_Video_Looper.fakevlc --port 4212 --duration BTN_TOP=12
+"""
+import argparse
+import asyncio
+import os
+import socket
+import time
+
+from .vlcclient import parse_address
+
+BANNER = b"VLC media player 3.0.18 Vetinari\r\nPassword: \xff\xfb\x01"
+WELCOME = b"\xff\xfc\x01\r\nWelcome, Master\r\n> "
+
+
+class FakeItem:
+
+    def __init__(self, index, path, duration):
+        self.index = index
+        self.path = path
+        self.name = os.path.basename(path)
+        self.duration = duration
+
+
+class FakeVlc:
+    """Simulated VLC playlist and playback.
+
+    `durations` maps clip names (with or without extension) to seconds,
+    other files play for `default_duration`. Every item that starts playing
+    is recorded in `history` as [index, name, start time, end time] with
+    time.monotonic() times, the end is filled in when it stops.
+    """
+
+    def __init__(self, durations=None, default_duration=10.0, clock=time.monotonic):
+        self.durations = durations or {}
+        self.default_duration = default_duration
+        self.clock = clock
+        self.items = []
+        self.current = None
+        self.started = None
+        self.playing = False
+        self.loop = False
+        self.repeat = False
+        self.history = []
+        self.commands = []
+        self._next_index = 3  # 1 and 2 are the playlist and media library nodes
+
+    def _duration(self, name):
+        stem = os.path.splitext(name)[0]
+        return self.durations.get(name, self.durations.get(stem, self.default_duration))
+
+    def _item(self, index):
+        for item in self.items:
+            if item.index == index:
+                return item
+        return None
+
+    def _start(self, item, when):
+        self._stop(when)
+        self.current = item.index
+        self.started = when
+        self.playing = True
+        self.history.append([item.index, item.name, when, None])
+
+    def _stop(self, when):
+        if self.playing and self.history and self.history[-1][3] is None:
+            self.history[-1][3] = when
+        self.playing = False
+
+    def advance(self):
+        """Move playback forward to the current time."""
+        now = self.clock()
+        while self.playing:
+            item = self._item(self.current)
+            if item is None:
+                self._stop(now)
+                return
+            end = self.started + item.duration
+            if now < end:
+                return
+            if self.repeat:
+                self._start(item, end)
+                continue
+            position = self.items.index(item)
+            if position + 1 < len(self.items):
+                self._start(self.items[position + 1], end)
+            elif self.loop and self.items:
+                self._start(self.items[0], end)
+            else:
+                self._stop(end)
+
+    def _add(self, path):
+        item = FakeItem(self._next_index, path, self._duration(os.path.basename(path)))
+        self._next_index += 1
+        self.items.append(item)
+        return item
+
+    def _listing(self, title, items):
+        lines = ["+----[ {0} ]".format(title), "| 1 - Playlist"]
+        for item in items:
+            seconds = int(item.duration)
+            lines.append("|   {0}{1} - {2} ({3:02d}:{4:02d}:{5:02d})".format(
+                "*" if item.index == self.current else "", item.index, item.name,
+                seconds // 3600, seconds // 60 % 60, seconds % 60))
+        lines += ["| 2 - Media Library", "+----[ End of playlist ]"]
+        return "\r\n".join(lines)
+
+    def handle(self, line):
+        """Run one command and return the reply text."""
+        self.advance()
+        self.commands.append(line)
+        command, _, arg = line.partition(" ")
+        now = self.clock()
+        if command == "add":
+            self._start(self._add(arg), now)
+        elif command == "enqueue":
+            self._add(arg)
+        elif command == "delete":
+            item = self._item(int(arg))
+            if item is not None:
+                if item.index == self.current:
+                    self._stop(now)
+                    self.current = None
+                self.items.remove(item)
+        elif command == "clear":
+            self._stop(now)
+            self.items = []
+            self.current = None
+        elif command in ("goto", "gotoitem"):
+            item = self._item(int(arg))
+            if item is not None:
+                self._start(item, now)
+        elif command == "play":
+            item = self._item(self.current) or (self.items[0] if self.items else None)
+            if item is not None and not self.playing:
+                self._start(item, now)
+        elif command == "stop":
+            self._stop(now)
+        elif command == "loop":
+            self.loop = arg != "off" if arg else not self.loop
+        elif command == "repeat":
+            self.repeat = arg != "off" if arg else not self.repeat
+        elif command == "playlist":
+            return self._listing("Playlist - playlist", self.items)
+        elif command == "search":
+            if not arg:
+                return ""
+            return self._listing("Search - " + arg, [item for item in self.items if arg in item.name])
+        elif command == "status":
+            lines = []
+            item = self._item(self.current) if self.playing else None
+            if item is not None:
+                lines.append("( new input: file://{0} )".format(item.path))
+            lines.append("( audio volume: 256 )")
+            lines.append("( state {0} )".format("playing" if self.playing else "stopped"))
+            return "\r\n".join(lines)
+        elif command == "get_time":
+            return str(int(now - self.started)) if self.playing else ""
+        elif command == "get_length":
+            item = self._item(self.current) if self.playing else None
+            return str(int(item.duration)) if item is not None else ""
+        elif command == "is_playing":
+            return "1" if self.playing else "0"
+        return ""
+
+
+class FakeVlcServer:
+    """Serves a FakeVlc over TCP or a unix socket on the running event loop.
+
+    `latency` delays every reply by that many seconds, `command_latency`
+    overrides it per command name.
+    """
+
+    def __init__(self, vlc=None, password="admin", latency=0.0, command_latency=None):
+        self.vlc = vlc or FakeVlc()
+        self.password = password
+        self.latency = latency
+        self.command_latency = command_latency or {}
+        self.connections = 0
+        self._server = None
+
+    async def start(self, address="127.0.0.1:0"):
+        """Listen on `address` (host:port or unix:/path), returns the address
+        to connect to."""
+        family, sockaddr = parse_address(address)
+        if family == socket.AF_UNIX:
+            if os.path.exists(sockaddr):
+                os.unlink(sockaddr)
+            self._server = await asyncio.start_unix_server(self._client, sockaddr)
+            return "unix:" + sockaddr
+        self._server = await asyncio.start_server(self._client, *sockaddr)
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return "{0}:{1}".format(host, port)
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def serve_forever(self):
+        await self._server.serve_forever()
+
+    async def _client(self, reader, writer):
+        self.connections += 1
+        try:
+            writer.write(BANNER)
+            while True:
+                password = await reader.readline()
+                if not password:
+                    return
+                if password.strip().decode("utf-8", "replace") == self.password:
+                    break
+                writer.write(b"\r\nWrong password\r\nPassword: ")
+            writer.write(WELCOME)
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                line = line.decode("utf-8").strip()
+                delay = self.command_latency.get(line.partition(" ")[0], self.latency)
+                if delay:
+                    await asyncio.sleep(delay)
+                reply = self.vlc.handle(line)
+                writer.write((reply + "\r\n> " if reply else "> ").encode("utf-8"))
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+
+def parse_durations(values):
+    """Parse NAME=SECONDS pairs."""
+    durations = {}
+    for value in values:
+        name, _, seconds = value.partition("=")
+        durations[name] = float(seconds)
+    return durations
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake VLC telnet interface.")
+    parser.add_argument("--listen", default="127.0.0.1:4212", help="host:port or unix:/path")
+    parser.add_argument("--password", default="admin")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before every reply")
+    parser.add_argument("--command-latency", action="append", default=[], metavar="COMMAND=SECONDS")
+    parser.add_argument("--duration", action="append", default=[], metavar="CLIP=SECONDS")
+    parser.add_argument("--default-duration", type=float, default=10.0)
+    args = parser.parse_args()
+
+    async def run():
+        server = FakeVlcServer(FakeVlc(parse_durations(args.duration), args.default_duration),
+                               args.password, args.latency, parse_durations(args.command_latency))
+        print("Fake VLC listening on {0}".format(await server.start(args.listen)))
+        await server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+# License: GNU GPLv2, see LICENSE.txt
+import errno
+import fnmatch
+import glob
+import os
+import selectors
+import struct
+import time
+
+from . import inotify, log
+
+_log = log.get('input')
+
+# struct input_event from linux/input.h: struct timeval, type, code, value
+_EVENT = struct.Struct('llHHi')
+EV_KEY = 0x01
+
+# Joystick and gamepad button codes, named like the inputs library did.
+BUTTON_NAMES = {
+    0x120: 'BTN_TRIGGER', 0x121: 'BTN_THUMB', 0x122: 'BTN_THUMB2',
+    0x123: 'BTN_TOP', 0x124: 'BTN_TOP2', 0x125: 'BTN_PINKIE',
+    0x126: 'BTN_BASE', 0x127: 'BTN_BASE2', 0x128: 'BTN_BASE3',
+    0x129: 'BTN_BASE4', 0x12a: 'BTN_BASE5', 0x12b: 'BTN_BASE6',
+    0x12f: 'BTN_DEAD',
+    0x130: 'BTN_SOUTH', 0x131: 'BTN_EAST', 0x132: 'BTN_C',
+    0x133: 'BTN_NORTH', 0x134: 'BTN_WEST', 0x135: 'BTN_Z',
+    0x136: 'BTN_TL', 0x137: 'BTN_TR', 0x138: 'BTN_TL2', 0x139: 'BTN_TR2',
+    0x13a: 'BTN_SELECT', 0x13b: 'BTN_START', 0x13c: 'BTN_MODE',
+    0x13d: 'BTN_THUMBL', 0x13e: 'BTN_THUMBR',
+}
+_BUTTON_RANGE = range(0x120, 0x140)
+
+
+def button_name(code):
+    return BUTTON_NAMES.get(code, 'BTN_{0:#x}'.format(code))
+
+
+def has_buttons(path):
+    """True if the input device at `path` reports joystick or gamepad
+    buttons, judging by its key capabilities in sysfs."""
+    caps = '/sys/class/input/{0}/device/capabilities/key'.format(os.path.basename(path))
+    try:
+        with open(caps) as f:
+            words = f.read().split()
+    except OSError:
+        return False
+    # one hex word per long, most significant first
+    width = struct.calcsize('l') * 2
+    bits = int(''.join(word.zfill(width) for word in words) or '0', 16)
+    return any(bits >> code & 1 for code in _BUTTON_RANGE)
+
+
+class GamepadReader:
+    """Reads button presses from every matching /dev/input/event* device.
+
+    The devices are multiplexed with a selector (epoll on Linux) whose own
+    file descriptor can be watched by an event loop, so no thread has to
+    block on a device. Devices that are plugged in later are opened, and
+    unplugged ones are dropped, using inotify on the device directory.
+    Every key down calls on_press(button name, timestamp).
+    """
+
+    def __init__(self, on_press, pattern='/dev/input/event*', match=has_buttons):
+        self._on_press = on_press
+        self._pattern = pattern
+        self._match = match
+        self._selector = selectors.DefaultSelector()
+        self._devices = {}
+        self._inotify = None
+        self._bufsize = _EVENT.size * 64
+
+    @property
+    def devices(self):
+        return sorted(self._devices)
+
+    def fileno(self):
+        return self._selector.fileno()
+
+    def open(self):
+        """Open the matching devices and start watching for new ones."""
+        try:
+            self._inotify = inotify.Inotify()
+            self._inotify.add_watch(os.path.dirname(self._pattern),
+                                    inotify.IN_CREATE | inotify.IN_ATTRIB | inotify.IN_DELETE)
+            self._selector.register(self._inotify, selectors.EVENT_READ, self._hotplug)
+        except OSError as exc:
+            _log.warning('No input hotplug: {0}', exc)
+            if self._inotify is not None:
+                self._inotify.close()
+                self._inotify = None
+        for path in sorted(glob.glob(self._pattern)):
+            self._add_device(path)
+
+    def close(self):
+        for path in list(self._devices):
+            self._remove_device(path)
+        if self._inotify is not None:
+            self._selector.unregister(self._inotify)
+            self._inotify.close()
+            self._inotify = None
+        self._selector.close()
+
+    def _add_device(self, path):
+        if path in self._devices or not self._match(path):
+            return
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK | os.O_CLOEXEC)
+        except OSError:
+            # udev may not have set the permissions yet, retried on IN_ATTRIB
+            return
+        self._devices[path] = fd
+        self._selector.register(fd, selectors.EVENT_READ, path)
+        _log.info('Input device {0}', path)
+
+    def _remove_device(self, path):
+        fd = self._devices.pop(path, None)
+        if fd is not None:
+            self._selector.unregister(fd)
+            os.close(fd)
+            _log.info('Input device {0} removed', path)
+
+    def _hotplug(self):
+        directory = os.path.dirname(self._pattern)
+        for _, mask, _, name in self._inotify.read():
+            path = os.path.join(directory, name)
+            if not fnmatch.fnmatch(path, self._pattern):
+                continue
+            if mask & inotify.IN_DELETE:
+                self._remove_device(path)
+            else:
+                self._add_device(path)
+
+    def _read_device(self, path):
+        fd = self._devices[path]
+        try:
+            data = os.read(fd, self._bufsize)
+        except BlockingIOError:
+            return
+        except OSError as exc:
+            if exc.errno == errno.ENODEV:
+                self._remove_device(path)
+                return
+            raise
+        if not data:
+            self._remove_device(path)
+            return
+        now = time.monotonic()
+        for _, _, ev_type, code, value in _EVENT.iter_unpack(data):
+            # value 1 is key down, 2 autorepeat and 0 key up
+            if ev_type == EV_KEY and value == 1:
+                self._on_press(button_name(code), now)
+
+    def poll(self, timeout=0):
+        """Handle the pending input, waiting up to `timeout` seconds (None
+        waits forever)."""
+        for key, _ in self._selector.select(timeout):
+            if key.data == self._hotplug:
+                self._hotplug()
+            elif key.data in self._devices:
+                self._read_device(key.data)
+
+    def run(self, running, timeout=0.5):
+        """Handle input until running() returns False, for use without an
+        event loop."""
+        while running():
+            self.poll(timeout)
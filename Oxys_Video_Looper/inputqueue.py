@@ -0,0 +1,130 @@
+# License: GNU GPLv2, see LICENSE.txt
+import asyncio
+import collections
+import time
+
+BUSY_POLICIES = ('ignore', 'preempt', 'queue-next')
+# buttons whose last press is kept before those out of their debounce
+# window are forgotten, codes from the control socket can be anything
+PRUNE_AT = 64
+
+
+class InputQueue:
+    """Bounded queue of button presses between the input reader and the
+    player. Must be created and used on the event loop.
+
+    - Presses of a button within its debounce window after the last accepted
+      press of that button are dropped.
+    - A press of a button that is already waiting in the queue is merged
+      into it.
+    - When the queue is full the oldest press is dropped, the latest press
+      always gets in.
+    """
+
+    def __init__(self, maxsize=4, debounce=0.3, button_debounce=None, clock=time.monotonic):
+        self._pending = collections.deque()
+        self._maxsize = max(1, maxsize)
+        self._debounce = debounce
+        self._button_debounce = button_debounce or {}
+        self._clock = clock
+        self._last = {}
+        self._prune_at = PRUNE_AT
+        # created by get(), on the event loop
+        self._ready = None
+        # counters
+        self.received = 0
+        self.debounced = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def put(self, code, timestamp=None):
+        """Queue a press of button `code`. Returns False if it was dropped or
+        merged into a waiting press."""
+        now = self._clock() if timestamp is None else timestamp
+        self.received += 1
+        last = self._last.get(code)
+        if last is not None and now - last < self._button_debounce.get(code, self._debounce):
+            self.debounced += 1
+            return False
+        self._last[code] = now
+        if len(self._last) > self._prune_at:
+            self._prune(now)
+        if code in self._pending:
+            self.coalesced += 1
+            return False
+        if len(self._pending) >= self._maxsize:
+            self._pending.popleft()
+            self.dropped += 1
+        self._pending.append(code)
+        if self._ready is not None:
+            self._ready.set()
+        return True
+
+    def _prune(self, now):
+        """Forget the presses that can no longer debounce the next one."""
+        self._last = {code: last for code, last in self._last.items()
+                      if now - last < self._button_debounce.get(code, self._debounce)}
+        self._prune_at = max(PRUNE_AT, 2 * len(self._last))
+
+    async def get(self):
+        """Wait for the oldest waiting press and return its button code."""
+        if self._ready is None:
+            self._ready = asyncio.Event()
+        while not self._pending:
+            self._ready.clear()
+            await self._ready.wait()
+        return self._pending.popleft()
+
+    def take_latest(self, code):
+        """Return the most recent waiting press, or `code` if there is none,
+        and the presses it replaced, `code` and those in between, which
+        count as dropped."""
+        replaced = []
+        if self._pending:
+            replaced = [code] + list(self._pending)[:-1]
+            self.dropped += len(replaced)
+            code = self._pending.pop()
+            self._pending.clear()
+        return code, replaced
+
+    def configure(self, maxsize=4, debounce=0.3, button_debounce=None):
+        """Change the queue size and debounce windows, waiting presses stay."""
+        self._maxsize = max(1, maxsize)
+        self._debounce = debounce
+        self._button_debounce = button_debounce or {}
+        while len(self._pending) > self._maxsize:
+            self._pending.popleft()
+            self.dropped += 1
+
+    def drop(self, count=1):
+        """Count presses the player could not take."""
+        self.dropped += count
+
+    def stats(self):
+        return {
+            'received': self.received,
+            'debounced': self.debounced,
+            'coalesced': self.coalesced,
+            'dropped': self.dropped,
+            'waiting': len(self._pending),
+        }
+
+
+def input_queue_settings(config):
+    """Queue size, debounce and per button debounce from the [input] section
+    of the config."""
+    default = config.getfloat('input', 'debounce', fallback=0.3)
+    button_debounce = {}
+    if config.has_section('input'):
+        for key, value in config.items('input'):
+            if key.startswith('debounce_'):
+                button_debounce[key[len('debounce_'):].upper()] = float(value)
+    return config.getint('input', 'queue_size', fallback=4), default, button_debounce
+
+
+def create_input_queue(config):
+    """Create the input queue from the [input] section of the config."""
+    return InputQueue(*input_queue_settings(config))
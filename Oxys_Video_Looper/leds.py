@@ -0,0 +1,175 @@
+# License: GNU GPLv2, see LICENSE.txt
+import asyncio
+import math
+import time
+
+# Button -> GPIO pin of its LED
+DEFAULT_PINS = {
+    'BTN_TRIGGER': 21, # 1 Orange
+    'BTN_THUMB': 20, # 2 Green striped
+    'BTN_THUMB2': 16, # 3 Green
+    'BTN_TOP': 13, # 4 Blue striped
+    'BTN_TOP2': 19, # 5 Blue
+    'BTN_PINKIE': 26, # 6 Brown striped
+}
+
+# Brightness (0..1) of a pattern, t seconds after it started
+PATTERNS = {
+    'on': lambda t: 1.0,
+    'off': lambda t: 0.0,
+    'blink': lambda t: 1.0 if t % 1.0 < 0.5 else 0.0,
+    'breathe': lambda t: 0.5 - 0.5 * math.cos(2 * math.pi * t / 3.0),
+}
+ANIMATED = ('blink', 'breathe')
+
+
+def gpio_led_factory(pin, pwm=False):
+    """Real LED on a GPIO pin, gpiozero is only needed on the Pi."""
+    import gpiozero
+    return gpiozero.PWMLED(pin) if pwm else gpiozero.LED(pin)
+
+
+class MockLed:
+    """Stands in for a gpiozero LED, counts what is written to it."""
+
+    def __init__(self, pin, pwm=False):
+        self.pin = pin
+        self.pwm = pwm
+        self.writes = 0
+        self._value = 0.0
+
+    @property
+    def value(self):
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        self._value = value
+        self.writes += 1
+
+    def close(self):
+        pass
+
+
+def mock_led_factory(pin, pwm=False):
+    return MockLed(pin, pwm)
+
+
+PIN_FACTORIES = {
+    'gpio': gpio_led_factory,
+    'mock': mock_led_factory,
+}
+
+
+class LedController:
+    """Drives the button LEDs from the player state: `show('LOOP')` in the
+    loop, `show(button)` while the clip of a button plays.
+
+    Only pins whose level actually changes are written. Blinking and
+    breathing patterns are rendered by one scheduler, run(), which sleeps
+    until the next state change when nothing is animated.
+    """
+
+    def __init__(self, pins, factory=gpio_led_factory, loop_pattern='on', clip_pattern='on', frame_rate=30):
+        for pattern in (loop_pattern, clip_pattern):
+            if pattern not in PATTERNS:
+                raise ValueError('Unknown LED pattern {0}'.format(pattern))
+        self._pwm = 'breathe' in (loop_pattern, clip_pattern)
+        self._leds = {button: factory(pin, self._pwm) for button, pin in pins.items()}
+        self._levels = dict.fromkeys(self._leds)
+        self._loop_pattern = loop_pattern
+        self._clip_pattern = clip_pattern
+        self._frame = 1.0 / frame_rate
+        self._since = time.monotonic()
+        self._wake = None
+        self.state = None
+        self.writes = 0
+
+    @property
+    def buttons(self):
+        return list(self._leds)
+
+    def _pattern(self, button):
+        if self.state == 'LOOP':
+            return self._loop_pattern
+        return self._clip_pattern if button == self.state else 'off'
+
+    def _animated(self):
+        if self.state == 'LOOP':
+            return self._loop_pattern in ANIMATED
+        return self.state in self._leds and self._clip_pattern in ANIMATED
+
+    def _write(self, button, level):
+        if not self._pwm:
+            level = 1.0 if level >= 0.5 else 0.0
+        if self._levels[button] != level:
+            self._leds[button].value = level
+            self._levels[button] = level
+            self.writes += 1
+
+    def _render(self, now):
+        t = now - self._since
+        for button in self._leds:
+            self._write(button, PATTERNS[self._pattern(button)](t))
+
+    def show(self, state):
+        """Switch to 'LOOP' or the button whose clip plays."""
+        if state == self.state:
+            return
+        self.state = state
+        self._since = time.monotonic()
+        self._render(self._since)
+        if self._wake is not None:
+            self._wake.set()
+
+    async def run(self):
+        """Render animated patterns until cancelled."""
+        self._wake = asyncio.Event()
+        try:
+            while True:
+                if self._animated():
+                    try:
+                        await asyncio.wait_for(self._wake.wait(), self._frame)
+                    except asyncio.TimeoutError:
+                        pass
+                else:
+                    await self._wake.wait()
+                self._wake.clear()
+                self._render(time.monotonic())
+        finally:
+            self._wake = None
+
+    def close(self):
+        for led in self._leds.values():
+            led.close()
+
+
+def led_pins(config):
+    """Button -> GPIO pin from the [leds] section of the config."""
+    if config.has_section('leds'):
+        configured = {key.upper(): int(value) for key, value in config.items('leds') if key.startswith('btn_')}
+        if configured:
+            return configured
+    return dict(DEFAULT_PINS)
+
+
+def led_settings(config):
+    """Pin factory, loop and clip pattern and frame rate from the [leds]
+    section of the config, raises ValueError for unknown ones."""
+    factory = config.get('leds', 'pin_factory', fallback='gpio')
+    if factory not in PIN_FACTORIES:
+        raise ValueError('Unknown LED pin_factory {0}, must be one of {1}'.format(factory, ', '.join(PIN_FACTORIES)))
+    loop_pattern = config.get('leds', 'loop_pattern', fallback='on')
+    clip_pattern = config.get('leds', 'clip_pattern', fallback='on')
+    for pattern in (loop_pattern, clip_pattern):
+        if pattern not in PATTERNS:
+            raise ValueError('Unknown LED pattern {0}, must be one of {1}'.format(pattern, ', '.join(PATTERNS)))
+    frame_rate = config.getfloat('leds', 'frame_rate', fallback=30)
+    if frame_rate <= 0:
+        raise ValueError('LED frame_rate must be above 0')
+    return PIN_FACTORIES[factory], loop_pattern, clip_pattern, frame_rate
+
+
+def create_led_controller(config):
+    """Create the LED controller from the [leds] section of the config."""
+    return LedController(led_pins(config), *led_settings(config))
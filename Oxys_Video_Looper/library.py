@@ -0,0 +1,277 @@
+# License: GNU GPLv2, see LICENSE.txt
+"""Index of the movie files in the [directory] path.
+
+The directory is listed with os.scandir and every movie file is recorded
+with its size and mtime. The index is saved to a cache file, on the next
+start only files whose size or mtime changed are probed again. Lookups are
+answered from memory, the USB stick is only touched again for a name that
+is not in the index, and not again for a name that was not on it either
+until the next scan or refresh.
+"""
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from . import log
+from .model import Movie
+from .mp4info import Mp4Error
+
+_log = log.get('library')
+
+CACHE_VERSION = 1
+# names remembered as not on disk, any code can be sent over the control socket
+MAX_MISSING = 1024
+
+
+class LibraryEntry:
+    """A movie file in the library."""
+
+    __slots__ = ('name', 'path', 'size', 'mtime_ns', 'metadata')
+
+    def __init__(self, name, path, size, mtime_ns, metadata=None):
+        self.name = name
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.metadata = metadata or {}
+
+    @property
+    def stem(self):
+        return os.path.splitext(self.name)[0]
+
+    @property
+    def duration(self):
+        """Length in seconds from the metadata, or None."""
+        duration_us = self.metadata.get('duration_us')
+        return duration_us / 1000000.0 if duration_us else None
+
+    def movie(self, title=None, repeats=1):
+        """Return a Movie of this file."""
+        return Movie(self.stem, title, repeats, self.duration)
+
+    def __repr__(self):
+        return 'LibraryEntry({0!r}, size={1}, mtime_ns={2})'.format(self.name, self.size, self.mtime_ns)
+
+
+class MediaLibrary:
+    """Movie files in `path` with one of `extensions`, by file name and by
+    name without extension (the button code for button clips).
+
+    `probe` is called with the path of every new or changed file and returns
+    a dict of metadata to keep with it. A scan runs it on up to `workers`
+    files at once.
+    """
+
+    def __init__(self, path, extensions=('mp4',), cache_path=None, probe=None, workers=4):
+        self.path = path
+        self.extensions = tuple('.' + ext.lower().lstrip('.') for ext in extensions)
+        self.cache_path = cache_path
+        self.probe = probe
+        self.workers = workers
+        self._entries = {}
+        self._stems = {}
+        # names that were not on disk when they were looked up
+        self._missing = set()
+        # counters of the last scan
+        self.scanned = 0
+        self.probed = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(sorted(self._entries.values(), key=lambda entry: entry.name))
+
+    def __contains__(self, name):
+        return name in self._entries or name in self._stems
+
+    def is_movie(self, name):
+        return not name.startswith('.') and name.lower().endswith(self.extensions)
+
+    @staticmethod
+    def _index(entries, stems, entry):
+        entries[entry.name] = entry
+        # the first file in name order wins when stems collide, e.g. a.mov and a.mp4
+        stem = entry.stem
+        if stem not in stems or entry.name < stems[stem].name:
+            stems[stem] = entry
+
+    def _add(self, entry):
+        self._index(self._entries, self._stems, entry)
+
+    def _remove(self, name):
+        entry = self._entries.pop(name, None)
+        if entry is not None and self._stems.get(entry.stem) is entry:
+            del self._stems[entry.stem]
+            for other in self._entries.values():
+                if other.stem == entry.stem:
+                    self._add(other)
+        return entry
+
+    @staticmethod
+    def _unchanged(entry, stat):
+        return entry is not None and entry.size == stat.st_size and entry.mtime_ns == stat.st_mtime_ns
+
+    def _probe(self, path):
+        if self.probe is None:
+            return {}
+        self.probed += 1
+        try:
+            return self.probe(path) or {}
+        except (OSError, Mp4Error) as exc:
+            # indexed without metadata, a damaged file does not stop the scan
+            _log.warning('Could not read {0}: {1}', path, exc)
+            return {}
+
+    def _entry(self, name, stat, previous=None):
+        """Entry of a file, reusing `previous` if size and mtime match."""
+        if self._unchanged(previous, stat):
+            return previous
+        path = os.path.join(self.path, name)
+        return LibraryEntry(name, path, stat.st_size, stat.st_mtime_ns, self._probe(path))
+
+    def scan(self):
+        """List the directory and update the index. Returns the names of the
+        files that were added or changed and of those that were removed.
+        Can run in a worker thread, the new index replaces the old one only
+        once it is complete."""
+        self.scanned = 0
+        self.probed = 0
+        self._missing = set()
+        old = self._entries
+        entries = {}
+        stems = {}
+        pending = []
+        try:
+            with os.scandir(self.path) as it:
+                for dirent in it:
+                    if not self.is_movie(dirent.name):
+                        continue
+                    try:
+                        if not dirent.is_file():
+                            continue
+                        stat = dirent.stat()
+                    except OSError:
+                        continue
+                    self.scanned += 1
+                    previous = old.get(dirent.name)
+                    if self._unchanged(previous, stat):
+                        self._index(entries, stems, previous)
+                    else:
+                        pending.append((dirent.name, stat))
+        except OSError as exc:
+            _log.warning('Could not list {0}: {1}', self.path, exc)
+        # probing reads the files, do it for the new and changed ones only
+        paths = [os.path.join(self.path, name) for name, stat in pending]
+        if self.probe is not None and len(paths) > 1 and self.workers > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                metadata = list(pool.map(self._probe, paths))
+        else:
+            metadata = [self._probe(path) for path in paths]
+        for (name, stat), path, data in zip(pending, paths, metadata):
+            self._index(entries, stems, LibraryEntry(name, path, stat.st_size, stat.st_mtime_ns, data))
+        self._entries, self._stems = entries, stems
+        removed = [name for name in old if name not in entries]
+        return [name for name, stat in pending], removed
+
+    def get(self, name):
+        """Return the entry of a file name from the index, without looking
+        on disk."""
+        return self._entries.get(name)
+
+    def may_exist(self, name):
+        """False for a name that cannot be a movie in the directory or was
+        not on disk since the last scan or refresh."""
+        return bool(name) and '/' not in name and not name.startswith('.') and name not in self._missing
+
+    def lookup(self, name, disk=True):
+        """Return the entry of a file name or a name without extension, or
+        None if there is no such movie file. Names missing from the index
+        are looked for on disk, so files copied since the last scan are
+        found. That stats and probes the file, from the event loop pass
+        `disk` False and run it in a worker thread instead."""
+        entry = self._entries.get(name) or self._stems.get(name)
+        if entry is not None or not disk or not self.may_exist(name):
+            return entry
+        candidates = [name] if self.is_movie(name) else [name + ext for ext in self.extensions]
+        for candidate in candidates:
+            try:
+                stat = os.stat(os.path.join(self.path, candidate))
+            except OSError:
+                continue
+            entry = self._entry(candidate, stat)
+            self._add(entry)
+            return entry
+        if len(self._missing) >= MAX_MISSING:
+            self._missing = set()
+        self._missing.add(name)
+        return None
+
+    def refresh(self, name):
+        """Update the entry of one file after it was added, changed or removed.
+        Returns the new entry or None if it is gone."""
+        self._missing = set()
+        try:
+            stat = os.stat(os.path.join(self.path, name))
+        except OSError:
+            self._remove(name)
+            return None
+        entry = self._entry(name, stat, self._entries.get(name))
+        self._add(entry)
+        return entry
+
+    def load_cache(self):
+        """Fill the index from the cache file, if it belongs to this path.
+        Returns True if it was loaded."""
+        if not self.cache_path:
+            return False
+        try:
+            with open(self.cache_path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if data.get('version') != CACHE_VERSION or data.get('path') != self.path:
+            return False
+        entries = {}
+        stems = {}
+        for name, (size, mtime_ns, metadata) in data.get('entries', {}).items():
+            self._index(entries, stems, LibraryEntry(name, os.path.join(self.path, name), size, mtime_ns, metadata))
+        self._entries, self._stems = entries, stems
+        return True
+
+    def save_cache(self):
+        """Write the index to the cache file."""
+        if not self.cache_path:
+            return
+        data = {
+            'version': CACHE_VERSION,
+            'path': self.path,
+            'entries': {entry.name: [entry.size, entry.mtime_ns, entry.metadata] for entry in self._entries.values()},
+        }
+        tmp = '{0}.{1}.tmp'.format(self.cache_path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(self.cache_path) or '.', exist_ok=True)
+            with open(tmp, 'w') as f:
+                json.dump(data, f, separators=(',', ':'))
+            os.replace(tmp, self.cache_path)
+        except OSError as exc:
+            _log.warning('Could not write library cache {0}: {1}', self.cache_path, exc)
+
+    def update(self):
+        """Load the cache, rescan and save the cache again if anything
+        changed. Meant to run once at startup."""
+        self.load_cache()
+        changed, removed = self.scan()
+        if changed or removed:
+            self.save_cache()
+        return changed, removed
+
+
+def create_library(config, probe=None):
+    """Create the media library of the [directory] section of the config."""
+    extensions = config.get('directory', 'extensions', fallback='mp4, m4v, mov, mkv')
+    cache_path = config.get('directory', 'index_cache', fallback='~/.cache/video_looper/library.json')
+    return MediaLibrary(config.get('directory', 'path'),
+                        [ext.strip() for ext in extensions.split(',') if ext.strip()],
+                        os.path.expanduser(cache_path) if cache_path else None,
+                        probe)
@@ -0,0 +1,236 @@
+# License: GNU GPLv2, see LICENSE.txt
+"""Events of the looper in a ring buffer, written out in batches.
+
+Logging an event appends a tuple of the time, level, source, message and
+its arguments to a bounded deque, nothing is formatted. Events at or above
+the emission level are also written to stdout or a file: on the event
+loop they are collected and written with one write per loop iteration,
+before the loop runs or from other threads they are handed over to it.
+The ring keeps the last events of every level, DEBUG included, and is
+written to the dump file on SIGUSR1 or when the looper crashes:
+
+    kill -USR1 $(pgrep -f Oxys_Video_Looper.video_looper)
+"""
+import collections
+import sys
+import threading
+import time
+import traceback
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+_LEVEL_NAMES = {level: name.upper() for name, level in LEVELS.items()}
+
+DEFAULT_DUMP_FILE = '/tmp/video_looper_events.log'
+
+
+def format_event(event):
+    """One line of text of an event tuple."""
+    when, level, source, message, args = event
+    if args:
+        try:
+            message = message.format(*args)
+        except (IndexError, KeyError, ValueError):
+            message = '{0} {1!r}'.format(message, args)
+    return '{0}.{1:03d} {2:<7} {3}: {4}\n'.format(
+        time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(when)), int(when % 1 * 1000),
+        _LEVEL_NAMES.get(level, level), source, message)
+
+
+class Logger:
+    """Logs events of one source, messages are str.format() templates
+    that are filled in with the arguments only when they are written."""
+
+    __slots__ = ('_events', 'source')
+
+    def __init__(self, events, source):
+        self._events = events
+        self.source = source
+
+    def debug(self, message, *args):
+        self._events.event(DEBUG, self.source, message, args)
+
+    def info(self, message, *args):
+        self._events.event(INFO, self.source, message, args)
+
+    def warning(self, message, *args):
+        self._events.event(WARNING, self.source, message, args)
+
+    def error(self, message, *args):
+        self._events.event(ERROR, self.source, message, args)
+
+    def exception(self, message, *args):
+        """Log an error with the traceback of the exception being handled."""
+        self._events.event(ERROR, self.source, message + '\n{' + str(len(args)) + '}',
+                           args + (traceback.format_exc().rstrip(),))
+
+
+class EventLog:
+    """Ring buffer of the last `size` events. Events at or above `level`
+    are written to `stream`, None writes nothing."""
+
+    def __init__(self, size=2000, level=INFO, stream=sys.stdout):
+        self._ring = collections.deque(maxlen=size)
+        self._pending = collections.deque()
+        self.level = level
+        self.stream = stream
+        self.dump_file = DEFAULT_DUMP_FILE
+        self._owned = False
+        self._loop = None
+        self._thread = None
+        self._scheduled = False
+
+    def get(self, source):
+        return Logger(self, source)
+
+    def event(self, level, source, message, args=()):
+        """Record an event, deque appends need no lock."""
+        event = (time.time(), level, source, message, args)
+        self._ring.append(event)
+        if level >= self.level and self.stream is not None:
+            self._pending.append(event)
+            if not self._scheduled:
+                self._schedule()
+
+    def _schedule(self):
+        loop = self._loop
+        if loop is None:
+            self.flush()
+            return
+        self._scheduled = True
+        try:
+            if threading.get_ident() == self._thread:
+                loop.call_soon(self.flush)
+            else:
+                loop.call_soon_threadsafe(self.flush)
+        except RuntimeError:
+            # the loop is closed
+            self._scheduled = False
+            self.flush()
+
+    def flush(self):
+        """Write the pending events."""
+        self._scheduled = False
+        lines = []
+        while self._pending:
+            lines.append(format_event(self._pending.popleft()))
+        if lines and self.stream is not None:
+            try:
+                self.stream.write(''.join(lines))
+                self.stream.flush()
+            except (OSError, ValueError):
+                pass
+
+    def attach(self, loop):
+        """Write events from `loop`, the running event loop, from now on."""
+        self._loop = loop
+        self._thread = threading.get_ident()
+
+    def detach(self):
+        """Write events right away again, e.g. once the loop stopped."""
+        self._loop = None
+        self.flush()
+
+    def configure(self, level=INFO, output='stdout', size=2000, dump_file=DEFAULT_DUMP_FILE):
+        """Change the emission level, the output (stdout, stderr, a file
+        name or '' for none) and the ring size."""
+        self.flush()
+        if self._owned:
+            self.stream.close()
+        self._owned = False
+        if output == 'stdout':
+            self.stream = sys.stdout
+        elif output == 'stderr':
+            self.stream = sys.stderr
+        elif output:
+            try:
+                self.stream = open(output, 'a')
+                self._owned = True
+            except OSError as exc:
+                self.stream = sys.stderr
+                self.event(WARNING, 'log', 'Could not open {0}: {1}', (output, exc))
+        else:
+            self.stream = None
+        self.level = level
+        if size != self._ring.maxlen:
+            self._ring = collections.deque(self._ring, maxlen=size)
+        self.dump_file = dump_file
+
+    def events(self, count=None):
+        """The last `count` events, all of them by default, oldest first."""
+        events = list(self._ring)
+        return events if count is None else events[-count:]
+
+    def dump(self, path=None, count=None):
+        """Write the last events to `path`, the dump file by default.
+        Returns the path, or None if it could not be written."""
+        path = path or self.dump_file
+        if not path:
+            return None
+        try:
+            with open(path, 'w') as f:
+                f.writelines(format_event(event) for event in self.events(count))
+        except OSError:
+            return None
+        return path
+
+
+EVENTS = EventLog()
+
+
+def get(source):
+    """Logger for `source`, usually the module name."""
+    return EVENTS.get(source)
+
+
+def logging_settings(config):
+    """Level, output, ring size and dump file from the [logging] section of
+    the config. Without a level it is DEBUG with console_output and INFO
+    without, without an output stdout with console_output and nothing
+    without."""
+    console = config.getboolean('video_looper', 'console_output', fallback=False)
+    level = config.get('logging', 'level', fallback='debug' if console else 'info').strip().lower()
+    if level not in LEVELS:
+        raise RuntimeError('Unknown logging level {0}, must be one of {1}'.format(level, ', '.join(LEVELS)))
+    return (LEVELS[level], config.get('logging', 'output', fallback='stdout' if console else '').strip(),
+            config.getint('logging', 'events', fallback=2000),
+            config.get('logging', 'dump_file', fallback=DEFAULT_DUMP_FILE).strip())
+
+
+def configure_logging(config):
+    """Apply the [logging] section of the config."""
+    EVENTS.configure(*logging_settings(config))
+
+
+def install_crash_dump():
+    """Log uncaught exceptions, also of threads, and dump the ring."""
+    previous = sys.excepthook
+
+    def excepthook(kind, value, tb):
+        EVENTS.event(ERROR, 'crash', '{0}', (''.join(traceback.format_exception(kind, value, tb)).rstrip(),))
+        EVENTS.dump()
+        previous(kind, value, tb)
+
+    def thread_excepthook(args):
+        if args.exc_type is SystemExit:
+            return
+        EVENTS.event(ERROR, 'crash', 'Thread {0}: {1}', (
+            args.thread.name if args.thread is not None else '?',
+            ''.join(traceback.format_exception(args.exc_type, args.exc_value, args.exc_traceback)).rstrip()))
+        EVENTS.dump()
+
+    sys.excepthook = excepthook
+    threading.excepthook = thread_excepthook
+
+
+def asyncio_exception_handler(loop, context):
+    """Log exceptions of tasks that nobody awaited, instead of stderr."""
+    exc = context.get('exception')
+    if exc is not None:
+        EVENTS.event(ERROR, 'asyncio', '{0}\n{1}', (context.get('message'), ''.join(
+            traceback.format_exception(type(exc), exc, exc.__traceback__)).rstrip()))
+    else:
+        EVENTS.event(ERROR, 'asyncio', '{0}', (context.get('message'),))
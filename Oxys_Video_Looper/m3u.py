@@ -0,0 +1,183 @@
+# License: GNU GPLv2, see LICENSE.txt
+"""M3U/M3U8 playlists, read as a stream.
+
+iter_m3u() yields the Movies of a playlist while reading it line by line.
+M3uPlaylist is a sequence of Movies for model.Playlist that only keeps the
+file offset of every entry in memory, entries are parsed when they are
+accessed. load_playlist() keeps loaded playlists until their file changes.
+
+    #EXTM3U
+    #EXTINF:12,Title of the video
+    video.mp4
+    #EXTINF:8,Played three times in a row
+    intro_repeat_3x.mp4
+"""
+import array
+import os
+import re
+from collections import OrderedDict
+
+from . import log
+from .model import Movie
+
+_log = log.get('playlist')
+
+# e.g. movie_repeat_3x.mp4 is played three times in a row
+_match_repeats = re.compile(r'_repeat_([0-9]+)x', re.IGNORECASE)
+
+
+def _parse_extinf(line):
+    """Duration (None if unknown) and title of an #EXTINF line."""
+    info, _, title = line[len(b'#EXTINF:'):].partition(b',')
+    try:
+        duration = float(info.split()[0]) if info.split() else 0
+    except ValueError:
+        duration = 0
+    title = title.strip().decode('utf-8', 'replace')
+    return (duration if duration > 0 else None), (title or None)
+
+
+def _entries(f, parse=True):
+    """Yield (offset, duration, title, location) of the entries of a binary
+    playlist file, from its current position on. Without `parse` only the
+    offsets are filled in."""
+    offset = f.tell()
+    if offset == 0 and f.peek(3)[:3] == b'\xef\xbb\xbf':
+        # UTF-8 byte order mark
+        offset = len(f.read(3))
+    start = None
+    duration = title = None
+    for raw in f:
+        line_offset = offset
+        offset += len(raw)
+        line = raw.strip()
+        if not line:
+            continue
+        if line[:1] == b'#':
+            if line.startswith(b'#EXTINF:'):
+                start = line_offset
+                if parse:
+                    duration, title = _parse_extinf(line)
+            continue
+        yield (line_offset if start is None else start), duration, title, line.decode('utf-8', 'replace') if parse else None
+        start = None
+        duration = title = None
+
+
+def repeats(location):
+    """Times a movie is played in a row, from `_repeat_Nx` in its file name."""
+    match = _match_repeats.search(os.path.basename(location))
+    return max(1, int(match.group(1))) if match else 1
+
+
+def _movie(base_path, duration, title, location):
+    if '://' not in location and not os.path.isabs(location):
+        location = os.path.join(base_path, location)
+    return Movie(location, title, repeats(location), duration)
+
+
+def iter_m3u(path, base_path=None):
+    """Yield the Movies of a playlist file while reading it. Relative
+    locations are resolved against `base_path`, by default the directory
+    of the playlist."""
+    if base_path is None:
+        base_path = os.path.dirname(path)
+    with open(path, 'rb') as f:
+        for offset, duration, title, location in _entries(f):
+            yield _movie(base_path, duration, title, location)
+
+
+class M3uPlaylist:
+    """Movies of an M3U playlist file. Relative locations are resolved
+    against `base_path`.
+
+    Opening the playlist reads it once to record where every entry starts,
+    up to `cache_size` parsed Movies are kept.
+    """
+
+    def __init__(self, path, base_path=None, cache_size=64):
+        self.path = path
+        self.base_path = base_path if base_path is not None else os.path.dirname(path)
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._offsets = array.array('Q')
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self.mtime_ns, self.size = stat.st_mtime_ns, stat.st_size
+            for offset, duration, title, location in _entries(f, parse=False):
+                self._offsets.append(offset)
+
+    def stale(self):
+        """True if the playlist file changed or is gone since it was read."""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return True
+        return stat.st_mtime_ns != self.mtime_ns or stat.st_size != self.size
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self._offsets)
+        if not 0 <= index < len(self._offsets):
+            raise IndexError('playlist index out of range')
+        movie = self._cache.get(index)
+        if movie is not None:
+            self._cache.move_to_end(index)
+            return movie
+        with open(self.path, 'rb') as f:
+            f.seek(self._offsets[index])
+            offset, duration, title, location = next(_entries(f))
+        movie = self._cache[index] = _movie(self.base_path, duration, title, location)
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return movie
+
+    def __iter__(self):
+        return iter_m3u(self.path, self.base_path)
+
+    def find(self, names):
+        """Return a dict of name -> Movie for the entries whose file name,
+        with or without extension, is one of `names`. Reads the playlist
+        once and keeps only the matches."""
+        names = set(names)
+        found = {}
+        for movie in self:
+            base = os.path.basename(movie.filename)
+            for name in (base, os.path.splitext(base)[0]):
+                if name in names and name not in found:
+                    found[name] = movie
+        return found
+
+
+def _resolve(config):
+    path = config.get('playlist', 'path', fallback='').strip()
+    if not path:
+        return None, None
+    base_path = config.get('directory', 'path', fallback='')
+    if not os.path.isabs(path):
+        path = os.path.join(base_path, path)
+    return path, base_path
+
+
+_loaded = {}
+
+
+def load_playlist(config):
+    """Return the M3uPlaylist of the [playlist] path, or None if there is
+    none. The playlist is read again only when its file changed."""
+    path, base_path = _resolve(config)
+    if path is None:
+        return None
+    playlist = _loaded.get(path)
+    if playlist is None or playlist.base_path != base_path or playlist.stale():
+        try:
+            playlist = M3uPlaylist(path, base_path)
+        except OSError as exc:
+            _log.warning('Could not read playlist {0}: {1}', path, exc)
+            _loaded.pop(path, None)
+            return None
+        _loaded[path] = playlist
+    return playlist
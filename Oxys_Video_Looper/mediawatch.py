@@ -0,0 +1,130 @@
+# License: GNU GPLv2, see LICENSE.txt
+"""Notice movie files being added, changed and removed in a directory.
+
+The directory is watched with inotify. A file counts as complete when it
+is closed after writing or renamed into the directory, or else once it
+was not written to for `settle` seconds, so half copied clips are never
+reported. When the directory goes away, e.g. the USB stick is unmounted,
+it is watched again as soon as it is back and a rescan is reported, as
+when the kernel dropped events because too many came at once.
+"""
+import asyncio
+
+from . import inotify, log
+
+_log = log.get('media')
+
+_MASK = (inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO | inotify.IN_MOVED_FROM | inotify.IN_CREATE
+         | inotify.IN_MODIFY | inotify.IN_DELETE | inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF)
+
+
+class MediaWatcher:
+    """Calls `on_change(name, removed)` for every file in `path` that was
+    written or removed, and `on_change(None, False)` when the whole
+    directory must be scanned again. `on_change` may be a coroutine
+    function, calls are made one at a time."""
+
+    def __init__(self, path, on_change, settle=2.0, coalesce=0.1):
+        self.path = path
+        self.on_change = on_change
+        self.settle = settle
+        self.coalesce = coalesce
+        self._inotify = None
+        self._wd = None
+        # name -> (complete, time of the last event)
+        self._pending = {}
+        self._removed = set()
+        # events were lost, only a scan tells what changed
+        self._rescan = False
+        self._wake = None
+
+    def _add_watch(self):
+        try:
+            self._wd = self._inotify.add_watch(self.path, _MASK)
+        except OSError:
+            self._wd = None
+        return self._wd is not None
+
+    def _read_events(self):
+        now = asyncio.get_running_loop().time()
+        for wd, mask, cookie, name in self._inotify.read():
+            if mask & inotify.IN_Q_OVERFLOW:
+                _log.warning('Missed changes in {0}, scanning it again', self.path)
+                self._rescan = True
+                continue
+            if wd != self._wd:
+                continue
+            if mask & (inotify.IN_IGNORED | inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF):
+                _log.warning('Lost watch on {0}', self.path)
+                self._wd = None
+                self._pending.clear()
+            elif not name or mask & inotify.IN_ISDIR:
+                continue
+            elif mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+                self._pending.pop(name, None)
+                self._removed.add(name)
+            else:
+                self._removed.discard(name)
+                # closed after writing or renamed into place means complete,
+                # anything else means it is still being written
+                self._pending[name] = (bool(mask & (inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO)), now)
+        self._wake.set()
+
+    def _due(self, now):
+        """Names of the files that are complete now, and how long until the
+        next one may be."""
+        due = []
+        wait = None
+        for name, (complete, since) in list(self._pending.items()):
+            delay = self.coalesce if complete else self.settle
+            if now - since >= delay:
+                del self._pending[name]
+                due.append(name)
+            else:
+                remaining = since + delay - now
+                wait = remaining if wait is None else min(wait, remaining)
+        return sorted(due), wait
+
+    async def _notify(self, name, removed):
+        try:
+            result = self.on_change(name, removed)
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception as exc:
+            _log.error('Handling change of {0} failed: {1!r}', name or self.path, exc)
+
+    async def run(self):
+        """Watch the directory until cancelled."""
+        loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        self._inotify = inotify.Inotify()
+        loop.add_reader(self._inotify.fileno(), self._read_events)
+        try:
+            self._add_watch()
+            while True:
+                if self._wd is None:
+                    # gone, look for it again every settle period
+                    await asyncio.sleep(self.settle)
+                    if self._add_watch():
+                        _log.info('Watching {0} again', self.path)
+                        await self._notify(None, False)
+                    continue
+                self._wake.clear()
+                if self._rescan:
+                    self._rescan = False
+                    await self._notify(None, False)
+                now = loop.time()
+                removed, self._removed = self._removed, set()
+                for name in sorted(removed):
+                    await self._notify(name, True)
+                due, wait = self._due(now)
+                for name in due:
+                    await self._notify(name, False)
+                try:
+                    await asyncio.wait_for(self._wake.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            loop.remove_reader(self._inotify.fileno())
+            self._inotify.close()
+            self._inotify = None
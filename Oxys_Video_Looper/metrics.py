@@ -0,0 +1,315 @@
+# License: GNU GPLv2, see LICENSE.txt
+"""Counters, gauges and histograms in Prometheus text format.
+
+Samples go into preallocated arrays, recording one allocates nothing.
+Metrics can have labels, each label combination gets its own child the
+first time it is used. The registry is rendered to a text file for the
+node exporter's textfile collector and/or served over HTTP on localhost.
+"""
+import array
+import asyncio
+import bisect
+import os
+
+from . import log
+
+_log = log.get('metrics')
+
+# Round trips on the Pi are in the milliseconds, a clip start is at most seconds.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = ['{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Value:
+    """Single float in a preallocated array."""
+
+    __slots__ = ('_value',)
+
+    def __init__(self):
+        self._value = array.array('d', (0.0,))
+
+    @property
+    def value(self):
+        return self._value[0]
+
+
+class CounterChild(_Value):
+    __slots__ = ()
+
+    def inc(self, amount=1):
+        self._value[0] += amount
+
+
+class GaugeChild(_Value):
+    __slots__ = ()
+
+    def set(self, value):
+        self._value[0] = value
+
+    def inc(self, amount=1):
+        self._value[0] += amount
+
+    def dec(self, amount=1):
+        self._value[0] -= amount
+
+
+class HistogramChild:
+    __slots__ = ('_bounds', '_counts', '_sum')
+
+    def __init__(self, bounds):
+        self._bounds = bounds
+        # one slot per bucket plus +Inf
+        self._counts = array.array('Q', bytes(8 * (len(bounds) + 1)))
+        self._sum = array.array('d', (0.0,))
+
+    def observe(self, value):
+        self._counts[bisect.bisect_left(self._bounds, value)] += 1
+        self._sum[0] += value
+
+    @property
+    def count(self):
+        return sum(self._counts)
+
+    @property
+    def sum(self):
+        return self._sum[0]
+
+
+class Metric:
+    """A metric family, call labels() for the child of a label combination
+    or use the metric itself when it has no labels."""
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError('{0} takes labels {1}'.format(self.name, self.labelnames))
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _samples(self, values, child):
+        yield self.name + _format_labels(self.labelnames, values), child.value
+
+    def render(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.documentation),
+                 '# TYPE {0} {1}'.format(self.name, self.kind)]
+        for values, child in list(self._children.items()):
+            for name, value in self._samples(values, child):
+                lines.append('{0} {1}'.format(name, _format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return CounterChild()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def _new_child(self):
+        return GaugeChild()
+
+    def set(self, value):
+        self._default.set(value)
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def dec(self, amount=1):
+        self._default.dec(amount)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def _samples(self, values, child):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), child._counts):
+            cumulative += count
+            le = 'le="{0}"'.format('+Inf' if bound == float('inf') else _format_value(bound))
+            yield self.name + '_bucket' + _format_labels(self.labelnames, values, le), cumulative
+        labels = _format_labels(self.labelnames, values)
+        yield self.name + '_sum' + labels, child.sum
+        yield self.name + '_count' + labels, cumulative
+
+
+class CallbackMetric(Metric):
+    """Metric whose values are read from a function when rendered. The
+    function returns a number, or a dict of label values -> number."""
+
+    def __init__(self, name, documentation, kind, function, labelnames=()):
+        self.kind = kind
+        self._function = function
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return GaugeChild()
+
+    def render(self):
+        result = self._function()
+        if not isinstance(result, dict):
+            result = {(): result}
+        for values, value in result.items():
+            if not isinstance(values, tuple):
+                values = (values,)
+            self.labels(*values).set(value)
+        return super().render()
+
+
+class Registry:
+    """Set of metrics rendered together."""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, metric):
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            if type(existing) is not type(metric):
+                raise ValueError('Metric {0} already registered as {1}'.format(metric.name, existing.kind))
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def callback(self, name, documentation, kind, function, labelnames=()):
+        """Register or replace a metric read from `function` at render time."""
+        metric = CallbackMetric(name, documentation, kind, function, labelnames)
+        self._metrics[name] = metric
+        return metric
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+async def timed(timings, name, awaitable):
+    """Await `awaitable`, record the seconds it took in timings[name] and
+    return its result."""
+    started = asyncio.get_running_loop().time()
+    try:
+        return await awaitable
+    finally:
+        timings[name] = asyncio.get_running_loop().time() - started
+
+
+async def export_textfile(path, interval, registry=REGISTRY):
+    """Rewrite the metrics text file every `interval` seconds."""
+    loop = asyncio.get_running_loop()
+    while True:
+        text = registry.render()
+        await loop.run_in_executor(None, _replace_file, path, text)
+        await asyncio.sleep(interval)
+
+
+def _replace_file(path, text):
+    """Write `text` to `path` atomically, readers never see half a file."""
+    tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, path)
+    except OSError as exc:
+        _log.warning('Could not write metrics to {0}: {1}', path, exc)
+
+
+async def serve_http(port, host='127.0.0.1', registry=REGISTRY):
+    """Serve the metrics on http://host:port/metrics."""
+
+    async def handle(reader, writer):
+        try:
+            request = await reader.readline()
+            # skip the headers
+            while (await reader.readline()).strip():
+                pass
+            path = request.split()[1] if len(request.split()) > 1 else b'/'
+            if path in (b'/', b'/metrics'):
+                status, body = b'200 OK', registry.render().encode('utf-8')
+            else:
+                status, body = b'404 Not Found', b'not found\n'
+            writer.write(b'HTTP/1.0 ' + status + b'\r\n'
+                         b'Content-Type: text/plain; version=0.0.4\r\n'
+                         b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+async def run_exporters(config, registry=REGISTRY):
+    """Run the exporters configured in the [metrics] section until
+    cancelled."""
+    textfile = config.get('metrics', 'textfile', fallback='')
+    http_port = config.get('metrics', 'http_port', fallback='')
+    server = None
+    try:
+        if http_port:
+            server = await serve_http(int(http_port), registry=registry)
+        if textfile:
+            await export_textfile(textfile, config.getfloat('metrics', 'interval', fallback=15), registry)
+        else:
+            await asyncio.Event().wait()
+    finally:
+        if server is not None:
+            server.close()
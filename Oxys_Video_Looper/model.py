@@ -1,19 +1,21 @@
 # Copyright 2015 Adafruit Industries.
 # Author: Tony DiCola
 # License: GNU GPLv2, see LICENSE.txt
-import random
 from typing import Optional
 
-random.seed()
+from .scheduler import Scheduler
 
 class Movie:
     """Representation of a movie"""
 
-    def __init__(self, filename: str, title: Optional[str] = None, repeats: int = 1):
+    def __init__(self, filename: str, title: Optional[str] = None, repeats: int = 1,
+                 duration: Optional[float] = None):
         """Create a playlist from the provided list of movies."""
         self.filename = filename
         self.title = title
         self.repeats = int(repeats)
+        # length in seconds, if known from the file or the playlist
+        self.duration = duration
         self.playcount = 0
 
     def was_played(self):
@@ -41,33 +43,45 @@ class Movie:
 class Playlist:
     """Representation of a playlist of movies."""
 
-    def __init__(self, movies):
-        """Create a playlist from the provided list of movies."""
+    def __init__(self, movies, order='sequential'):
+        """Create a playlist from the provided list of movies, played in
+        `order`, see scheduler.ORDERS."""
         self._movies = movies
-        self._index = None
+        self._scheduler = Scheduler(movies, order)
+        # used instead when get_next() is asked for a random movie
+        self._shuffle = None
+        # index of the last movie and how often it played in a row, the
+        # movies of an M3uPlaylist are parsed again after they were evicted
+        self._current = None
+        self.playcount = 0
 
     def get_next(self, is_random) -> Movie:
         """Get the next movie in the playlist. Will loop to start of playlist
         after reaching end.
         """
+        scheduler = self._scheduler
+        if is_random and scheduler.order == 'sequential':
+            if self._shuffle is None:
+                self._shuffle = Scheduler(self._movies, 'shuffle')
+            scheduler = self._shuffle
+        index = scheduler.next()
         # Check if no movies are in the playlist and return nothing.
-        if len(self._movies) == 0:
+        if index is None:
             return None
-        # Start Random movie
-        if is_random:
-            self._index = random.randrange(0, self.length())
-        else:
-            # Start at the first movie and increment through them in order.
-            if self._index is None:
-                self._index = 0
-            else:
-                self._index += 1
-            # Wrap around to the start after finishing.
-            if self._index >= self.length():
-                self._index = 0
-
-        return self._movies[self._index]
+        movie = self._movies[index]
+        self.playcount = self.playcount + 1 if index == self._current else 1
+        self._current = index
+        movie.playcount = self.playcount
+        return movie
 
     def length(self):
         """Return the number of movies in the playlist."""
         return len(self._movies)
+
+    def state(self):
+        """Position in the rotation, see Scheduler.state()."""
+        return self._scheduler.state()
+
+    def restore(self, state):
+        """Continue the rotation from a state(), returns True if it fit."""
+        return self._scheduler.restore(state)
@@ -0,0 +1,231 @@
+# License: GNU GPLv2, see LICENSE.txt
+"""Duration, codec, resolution and frame rate of MP4 files.
+
+The file is memory mapped and only the headers of the boxes on the way to
+the video track are read (ftyp, moov/mvhd and trak/mdia/.../stsd), the
+media data in mdat is skipped. Reading a 4K clip touches a few pages, even
+when moov is at the end of the file.
+
+    python3 -m Oxys_Video_Looper.mp4info /mnt/usb/video
+"""
+import mmap
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+_HEADER = struct.Struct('>I4s')
+_LARGE_SIZE = struct.Struct('>Q')
+_U16 = struct.Struct('>H')
+_U32 = struct.Struct('>I')
+_U64 = struct.Struct('>Q')
+
+# Containers on the way from moov to the sample description of a track
+_CONTAINERS = {b'moov', b'trak', b'mdia', b'minf', b'stbl'}
+
+# What the Raspberry Pi 4 decodes in hardware: codec -> max width, height, fps
+DECODER_LIMITS = {
+    'hvc1': (4096, 2160, 60),
+    'hev1': (4096, 2160, 60),
+    'avc1': (1920, 1080, 60),
+    'avc3': (1920, 1080, 60),
+}
+
+
+class Mp4Error(ValueError):
+    """The file is not an MP4 file we can read."""
+
+
+def _boxes(data, start, end):
+    """Yield (type, payload start, box end) of the boxes between start and end."""
+    offset = start
+    while offset + 8 <= end:
+        size, kind = _HEADER.unpack_from(data, offset)
+        header = 8
+        if size == 1:
+            if offset + 16 > end:
+                raise Mp4Error('truncated box header at {0}'.format(offset))
+            size = _LARGE_SIZE.unpack_from(data, offset + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header or offset + size > end:
+            raise Mp4Error('bad size of {0} box at {1}'.format(kind.decode('latin-1'), offset))
+        yield kind, offset + header, offset + size
+        offset += size
+
+
+def _need(kind, start, length, end):
+    """Raise Mp4Error unless the payload of a box from start to end has
+    `length` bytes, a half copied file ends in the middle of a box."""
+    if start + length > end:
+        raise Mp4Error('truncated {0} box at {1}'.format(kind, start))
+
+
+def _time_box(data, kind, start, end):
+    """Timescale and duration of an mvhd or mdhd box."""
+    _need(kind, start, 1, end)
+    version = data[start]
+    if version == 1:
+        _need(kind, start, 32, end)
+        return _U32.unpack_from(data, start + 20)[0], _U64.unpack_from(data, start + 24)[0]
+    _need(kind, start, 20, end)
+    return _U32.unpack_from(data, start + 12)[0], _U32.unpack_from(data, start + 16)[0]
+
+
+def _sample_count(data, start, end):
+    """Number of samples in an stts box."""
+    _need('stts', start, 8, end)
+    entries = _U32.unpack_from(data, start + 4)[0]
+    _need('stts', start, 8 + 8 * entries, end)
+    return sum(_U32.unpack_from(data, start + 8 + 8 * i)[0] for i in range(entries))
+
+
+def _track(data, start, end, info):
+    """Fill info from a trak box if it is the first video track."""
+    timescale = duration = samples = None
+    handler = codec = size = None
+    stack = [(start, end)]
+    while stack:
+        box_start, box_end = stack.pop()
+        for kind, payload, box_end in _boxes(data, box_start, box_end):
+            if kind in _CONTAINERS:
+                stack.append((payload, box_end))
+            elif kind == b'mdhd':
+                timescale, duration = _time_box(data, 'mdhd', payload, box_end)
+            elif kind == b'hdlr':
+                _need('hdlr', payload, 12, box_end)
+                handler = bytes(data[payload + 8:payload + 12])
+            elif kind == b'stsd':
+                _need('stsd', payload, 8, box_end)
+                entries = _U32.unpack_from(data, payload + 4)[0]
+                if entries:
+                    _need('stsd', payload, 16, box_end)
+                    codec = bytes(data[payload + 12:payload + 16]).decode('latin-1')
+                    # VisualSampleEntry: width and height after 24 bytes of fields
+                    if payload + 44 <= box_end:
+                        size = (_U16.unpack_from(data, payload + 40)[0], _U16.unpack_from(data, payload + 42)[0])
+            elif kind == b'stts':
+                samples = _sample_count(data, payload, box_end)
+    if handler != b'vide':
+        return
+    info['codec'] = codec
+    if size is not None:
+        info['width'], info['height'] = size
+    if timescale and duration:
+        info['track_duration_us'] = duration * 1000000 // timescale
+        if samples:
+            info['fps'] = round(samples * timescale / duration, 3)
+
+
+def read_info(path):
+    """Return a dict with the brand, duration_us, codec, width, height and
+    fps of an MP4 file, or raise Mp4Error."""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < 8:
+            raise Mp4Error('too small to be an MP4 file')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return parse(data)
+
+
+def parse(data):
+    """Parse the boxes in a bytes-like object, see read_info()."""
+    info = {}
+    moov = False
+    for kind, payload, end in _boxes(data, 0, len(data)):
+        if kind == b'ftyp':
+            _need('ftyp', payload, 4, end)
+            info['brand'] = bytes(data[payload:payload + 4]).decode('latin-1')
+        elif kind == b'moov':
+            moov = True
+            for inner, inner_payload, inner_end in _boxes(data, payload, end):
+                if inner == b'mvhd':
+                    timescale, duration = _time_box(data, 'mvhd', inner_payload, inner_end)
+                    if timescale:
+                        info['duration_us'] = duration * 1000000 // timescale
+                elif inner == b'trak' and 'codec' not in info:
+                    _track(data, inner_payload, inner_end, info)
+    if 'brand' not in info and not moov:
+        raise Mp4Error('no ftyp or moov box')
+    if not moov:
+        raise Mp4Error('no moov box, the file may be incomplete')
+    # the movie duration can be missing in fragmented files
+    if not info.get('duration_us') and 'track_duration_us' in info:
+        info['duration_us'] = info['track_duration_us']
+    info.pop('track_duration_us', None)
+    return info
+
+
+def unsupported(info):
+    """Return why the Pi would not play a clip with this info smoothly, or
+    None if it can."""
+    codec = info.get('codec')
+    if codec is None:
+        return 'no video track'
+    limits = DECODER_LIMITS.get(codec)
+    if limits is None:
+        return 'codec {0} is not decoded in hardware'.format(codec)
+    width, height, fps = limits
+    if info.get('width', 0) > width or info.get('height', 0) > height:
+        return '{0}x{1} {2} is larger than {3}x{4}'.format(info['width'], info['height'], codec, width, height)
+    if info.get('fps', 0) > fps + 0.5:
+        return '{0} fps {1} is faster than {2} fps'.format(info['fps'], codec, fps)
+    return None
+
+
+def read_many(paths, workers=4):
+    """Read the info of many files with a thread pool. Returns a dict of
+    path -> info, or the exception raised for that file."""
+    def read(path):
+        try:
+            return read_info(path)
+        except (OSError, ValueError) as exc:
+            return exc
+    paths = list(paths)
+    if len(paths) < 2 or workers < 2:
+        return {path: read(path) for path in paths}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return dict(zip(paths, pool.map(read, paths)))
+
+
+def scan_directory(path, extensions=('mp4', 'm4v', 'mov'), workers=4):
+    """Read the info of every file in a directory with one of the extensions."""
+    suffixes = tuple('.' + ext.lower() for ext in extensions)
+    with os.scandir(path) as it:
+        paths = sorted(dirent.path for dirent in it
+                       if dirent.name.lower().endswith(suffixes) and dirent.is_file())
+    return read_many(paths, workers)
+
+
+def main():
+    # only needed on the command line
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Show the duration, codec and resolution of MP4 files.")
+    parser.add_argument('paths', nargs='+', help="files or directories")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    args = parser.parse_args()
+
+    results = {}
+    for path in args.paths:
+        if os.path.isdir(path):
+            results.update(scan_directory(path, workers=args.workers))
+        else:
+            results.update(read_many([path]))
+    if args.json:
+        print(json.dumps({path: info if isinstance(info, dict) else {'error': str(info)}
+                          for path, info in results.items()}, indent=2))
+        return
+    for path, info in results.items():
+        if not isinstance(info, dict):
+            print('{0}: {1}'.format(path, info))
+            continue
+        print('{0}: {1} {2}x{3} {4} fps {5:.3f} s{6}'.format(
+            path, info.get('codec'), info.get('width'), info.get('height'), info.get('fps'),
+            info.get('duration_us', 0) / 1000000.0,
+            '' if unsupported(info) is None else ' (' + unsupported(info) + ')'))
+
+
+if __name__ == '__main__':
+    main()
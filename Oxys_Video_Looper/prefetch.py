@@ -0,0 +1,325 @@
+# License: GNU GPLv2, see LICENSE.txt
+"""Keep the loop and the start of the button clips in the page cache.
+
+A clip read from a USB 2 stick stalls on its first frames when the kernel
+has to fetch them first. The Prefetcher reads the loop and the first `head`
+bytes of every button clip ahead of time, up to `budget` bytes in total.
+When they do not all fit the clips played most often, and then most
+recently, are kept and the others dropped again with POSIX_FADV_DONTNEED.
+
+Which pages are resident is asked with mincore(), so only missing parts
+are read and every play counts as a hit when the head of the clip was in
+memory. After a clip played the part of it beyond the head is dropped and
+whatever the clip pushed out is read again. Nothing is read while a clip
+plays, VLC needs the bandwidth of the stick.
+
+    python3 -m Oxys_Video_Looper.prefetch /mnt/usb/video/*.mp4
+"""
+import asyncio
+import collections
+import ctypes
+import ctypes.util
+import mmap
+import os
+
+from . import log, metrics
+
+_log = log.get('prefetch')
+
+PAGE_SIZE = mmap.PAGESIZE
+CHUNK = 1 << 20
+MIB = 1 << 20
+
+_PROT_READ = 1
+_MAP_SHARED = 1
+
+PREFETCH_PLAYS = metrics.REGISTRY.counter(
+    'looper_prefetch_plays_total', 'Clips started by whether their head was in the page cache.', ('result',))
+PREFETCH_BYTES = metrics.REGISTRY.gauge('looper_prefetch_bytes', 'Bytes of movies kept in the page cache.')
+PREFETCH_READ_BYTES = metrics.REGISTRY.counter(
+    'looper_prefetch_read_bytes_total', 'Bytes read from the media to bring them into the page cache.')
+
+_libc = None
+
+
+def _lib():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.mmap.restype = ctypes.c_void_p
+        libc.mmap.argtypes = (ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int,
+                              ctypes.c_long)
+        libc.mincore.argtypes = (ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p)
+        libc.munmap.argtypes = (ctypes.c_void_p, ctypes.c_size_t)
+        _libc = libc
+    return _libc
+
+
+def residency(fd, length):
+    """Return one byte per page of the first `length` bytes of a file, zero
+    for the pages that are not in the page cache. None if that cannot be
+    told on this system."""
+    if length <= 0:
+        return b''
+    try:
+        libc = _lib()
+    except (OSError, AttributeError):
+        return None
+    addr = libc.mmap(None, length, _PROT_READ, _MAP_SHARED, fd, 0)
+    if addr is None or addr == ctypes.c_void_p(-1).value:
+        return None
+    try:
+        vec = (ctypes.c_ubyte * ((length + PAGE_SIZE - 1) // PAGE_SIZE))()
+        if libc.mincore(addr, length, vec) != 0:
+            return None
+        return bytes(vec)
+    finally:
+        libc.munmap(addr, length)
+
+
+def resident_fraction(path, length=None):
+    """Fraction of the first `length` bytes of a file, all of it by default,
+    that is in the page cache, or None if unknown."""
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        length = size if length is None else min(length, size)
+        pages = residency(f.fileno(), length)
+    if pages is None:
+        return None
+    return (len(pages) - pages.count(0)) / len(pages) if pages else 1.0
+
+
+def _advise(fd, offset, length, advice):
+    try:
+        os.posix_fadvise(fd, offset, length, advice)
+    except (AttributeError, OSError):
+        pass
+
+
+class _Clip:
+    __slots__ = ('path', 'size', 'plays', 'last')
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.plays = 0
+        self.last = 0
+
+
+class Prefetcher:
+    """Keeps the loop and the first `head` bytes of the clips in the page
+    cache, at most `budget` bytes. run() does the reading and must run on
+    the event loop, the other methods are called by the player."""
+
+    def __init__(self, budget, head):
+        self.budget = budget
+        self.head = head
+        self._loop = None
+        self._clips = {}
+        # path -> bytes kept in the page cache
+        self._warm = {}
+        self._played = []
+        # path -> clips started from it that have not finished yet
+        self._playing = collections.Counter()
+        self._plays = 0
+        # created by run(), on the event loop
+        self._wake = None
+        self.hits = 0
+        self.misses = 0
+
+    def _wakeup(self):
+        if self._wake is not None:
+            self._wake.set()
+
+    def configure(self, budget, head):
+        self.budget = budget
+        self.head = head
+        self._wakeup()
+
+    def set_files(self, loop, clips):
+        """Set the loop and the clips to keep, as (path, size) pairs. The
+        play counts of clips that stay are kept."""
+        self._loop = _Clip(*loop) if loop is not None else None
+        previous = self._clips
+        self._clips = {}
+        for path, size in clips:
+            clip = self._clips[path] = _Clip(path, size)
+            if path in previous:
+                clip.plays, clip.last = previous[path].plays, previous[path].last
+        self._wakeup()
+
+    def _length(self, path):
+        if self._loop is not None and path == self._loop.path:
+            return self._loop.size
+        clip = self._clips.get(path)
+        return min(clip.size, self.head) if clip is not None else self.head
+
+    def started(self, path):
+        """Count a clip being started, before VLC reads it. Whether its head
+        was in the page cache is looked up in a worker thread, mincore()
+        has to map the file."""
+        self._playing[path] += 1
+        self._plays += 1
+        clip = self._clips.get(path)
+        if clip is not None:
+            clip.plays += 1
+            clip.last = self._plays
+        future = asyncio.get_running_loop().run_in_executor(None, self._resident, path, self._length(path))
+        future.add_done_callback(lambda future: future.cancelled() or self._count(path, future.result()))
+
+    @staticmethod
+    def _resident(path, length):
+        try:
+            return resident_fraction(path, length)
+        except OSError:
+            return None
+
+    def _count(self, path, fraction):
+        hit = path in self._warm if fraction is None else fraction >= 1.0
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+            _log.info('Prefetch miss for {0}: {1} resident', os.path.basename(path), 'unknown' if fraction is None else '{0:.0%}'.format(fraction))
+        PREFETCH_PLAYS.labels('hit' if hit else 'miss').inc()
+
+    def finished(self, path):
+        """A clip ended or was replaced, its tail is dropped and the page
+        cache filled again."""
+        self._playing[path] -= 1
+        if self._playing[path] <= 0:
+            del self._playing[path]
+        self._played.append(path)
+        self._wakeup()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'bytes': sum(self._warm.values()),
+                'files': len(self._warm)}
+
+    def plan(self):
+        """Return path -> bytes to keep: the loop, then the heads of the
+        clips by plays and recency while they fit in the budget."""
+        plan = {}
+        left = self.budget
+        if self._loop is not None and left > 0:
+            plan[self._loop.path] = min(self._loop.size, left)
+            left -= plan[self._loop.path]
+        for clip in sorted(self._clips.values(), key=lambda clip: (-clip.plays, -clip.last, clip.path)):
+            length = min(clip.size, self.head)
+            if length <= left and clip.path not in plan:
+                plan[clip.path] = length
+                left -= length
+        return plan
+
+    def _busy(self):
+        return bool(self._playing)
+
+    def _apply(self, plan, evicted, played):
+        """Drop what is no longer wanted and read what is missing. Runs in
+        a worker thread, stops early when a clip starts. Returns the number
+        of bytes read and whether it got through everything."""
+        for path, length in evicted.items():
+            self._drop(path, 0, length)
+        for path in played:
+            # what VLC read beyond the head is not part of the budget
+            self._drop(path, plan.get(path, 0), 0)
+        read = 0
+        for path, length in plan.items():
+            if self._busy():
+                return read, False
+            try:
+                read += self._read(path, length)
+            except OSError as exc:
+                _log.warning('Could not prefetch {0}: {1}', path, exc)
+        return read, not self._busy()
+
+    @staticmethod
+    def _drop(path, offset, length):
+        """Tell the kernel the range is not needed, 0 for `length` means up
+        to the end of the file."""
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            _advise(fd, offset, length, getattr(os, 'POSIX_FADV_DONTNEED', 4))
+        finally:
+            os.close(fd)
+
+    def _read(self, path, length):
+        """Bring the first `length` bytes of a file into the page cache,
+        reading only the chunks with missing pages."""
+        read = 0
+        with open(path, 'rb', buffering=0) as f:
+            fd = f.fileno()
+            length = min(length, os.fstat(fd).st_size)
+            pages = residency(fd, length)
+            per_chunk = CHUNK // PAGE_SIZE
+            missing = [offset for offset in range(0, length, CHUNK)
+                       if pages is None or 0 in pages[offset // PAGE_SIZE:offset // PAGE_SIZE + per_chunk]]
+            if not missing:
+                return 0
+            _advise(fd, missing[0], length - missing[0], getattr(os, 'POSIX_FADV_WILLNEED', 3))
+            buffer = bytearray(CHUNK)
+            for offset in missing:
+                if self._busy():
+                    break
+                read += os.preadv(fd, [memoryview(buffer)[:min(CHUNK, length - offset)]], offset)
+        return read
+
+    async def run(self):
+        """Keep the page cache filled until cancelled."""
+        loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        self._wake.set()
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            if self._busy():
+                # finished() wakes us again
+                continue
+            plan = self.plan()
+            evicted = {path: length for path, length in self._warm.items()
+                       if path not in plan and path not in self._playing}
+            played, self._played = self._played, []
+            read, complete = await loop.run_in_executor(None, self._apply, plan, evicted, played)
+            self._warm = plan
+            PREFETCH_BYTES.set(sum(plan.values()))
+            PREFETCH_READ_BYTES.inc(read)
+            if read:
+                _log.debug('Prefetched {0:.1f} MiB', read / MIB)
+            if not complete:
+                self._wake.set()
+
+
+def create_prefetcher(config):
+    """Create the prefetcher of the [prefetch] section of the config."""
+    budget, head = prefetch_settings(config)
+    return Prefetcher(budget, head)
+
+
+def prefetch_settings(config):
+    """Budget and head size in bytes from the [prefetch] section."""
+    return (int(config.getfloat('prefetch', 'budget', fallback=256) * MIB),
+            int(config.getfloat('prefetch', 'head', fallback=32) * MIB))
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Show how much of files is in the page cache.")
+    parser.add_argument('paths', nargs='+')
+    parser.add_argument('--head', type=float, help="only look at the first HEAD MiB")
+    args = parser.parse_args()
+    length = int(args.head * MIB) if args.head else None
+    for path in args.paths:
+        try:
+            fraction = resident_fraction(path, length)
+        except OSError as exc:
+            print('{0}: {1}'.format(path, exc))
+            continue
+        print('{0}: {1}'.format(path, 'unknown' if fraction is None else '{0:.1%} resident'.format(fraction)))
+
+
+if __name__ == '__main__':
+    main()
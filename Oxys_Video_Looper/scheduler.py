@@ -0,0 +1,127 @@
+# License: GNU GPLv2, see LICENSE.txt
+"""Order in which the movies of a playlist are played.
+
+sequential plays the movies in playlist order, shuffle draws them from a
+bag so every movie plays once before any plays again, and weighted picks
+movies at random with a probability proportional to their repeats. In
+sequential and shuffle order a movie is played `repeats` times in a row.
+
+Every pick takes constant time, the state is a few numbers plus one index
+per movie for the shuffle bag and the weight tables.
+"""
+import array
+import random
+
+ORDERS = ('sequential', 'shuffle', 'weighted')
+
+
+class Scheduler:
+    """Picks the index of the next movie of `movies`, a sequence of Movies."""
+
+    def __init__(self, movies, order='sequential', rng=None):
+        if order not in ORDERS:
+            raise ValueError('Unknown playlist order {0}, must be one of {1}'.format(order, ', '.join(ORDERS)))
+        self.order = order
+        self._movies = movies
+        self._size = len(movies)
+        self._rng = rng or random.Random()
+        self.current = None
+        self._plays_left = 0
+        # shuffle: the bag is a permutation, the first _drawn are played
+        self._bag = None
+        self._drawn = 0
+        # weighted: alias tables
+        self._probability = None
+        self._alias = None
+
+    def __len__(self):
+        return self._size
+
+    def next(self):
+        """Return the index of the movie to play next, None if there are none."""
+        if self._size == 0:
+            return None
+        if self.current is not None and self._plays_left > 0:
+            self._plays_left -= 1
+            return self.current
+        if self.order == 'sequential':
+            index = 0 if self.current is None else (self.current + 1) % self._size
+        elif self.order == 'shuffle':
+            index = self._draw()
+        else:
+            index = self._weighted()
+        self.current = index
+        if self.order != 'weighted':
+            self._plays_left = max(1, self._movies[index].repeats) - 1
+        return index
+
+    def _draw(self):
+        """Next movie from the bag, a step of a Fisher-Yates shuffle."""
+        size = self._size
+        if self._bag is None:
+            self._bag = array.array('L', range(size))
+        if self._drawn >= size:
+            self._drawn = 0
+        bag = self._bag
+        pick = self._rng.randrange(self._drawn, size)
+        if self._drawn == 0 and size > 1 and bag[pick] == self.current:
+            # a new bag must not start with the movie the last one ended with
+            pick = (pick + self._rng.randrange(1, size)) % size
+        bag[self._drawn], bag[pick] = bag[pick], bag[self._drawn]
+        self._drawn += 1
+        return bag[self._drawn - 1]
+
+    def _build_alias(self):
+        """Vose's alias tables for the weights, the repeats of the movies."""
+        size = self._size
+        weights = [max(1, movie.repeats) for movie in self._movies]
+        total = float(sum(weights))
+        scaled = [weight * size / total for weight in weights]
+        self._probability = array.array('d', bytes(8 * size))
+        self._alias = array.array('L', range(size))
+        small = [i for i, value in enumerate(scaled) if value < 1.0]
+        large = [i for i, value in enumerate(scaled) if value >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self._probability[less] = scaled[less]
+            self._alias[less] = more
+            scaled[more] -= 1.0 - scaled[less]
+            (small if scaled[more] < 1.0 else large).append(more)
+        for i in small + large:
+            self._probability[i] = 1.0
+
+    def _weighted(self):
+        if self._probability is None:
+            self._build_alias()
+        for _ in range(8):
+            column = self._rng.randrange(self._size)
+            index = column if self._rng.random() < self._probability[column] else self._alias[column]
+            # avoid playing a movie twice in a row, unless it is all there is
+            if index != self.current or self._size == 1:
+                break
+        return index
+
+    def state(self):
+        """Position in the rotation, as a dict that can be saved as JSON."""
+        return {
+            'order': self.order,
+            'size': self._size,
+            'current': self.current,
+            'plays_left': self._plays_left,
+            'bag': list(self._bag) if self._bag is not None else None,
+            'drawn': self._drawn,
+        }
+
+    def restore(self, state):
+        """Continue from a state(). Returns False, and changes nothing, if
+        it was saved for another order or number of movies."""
+        if not state or state.get('order') != self.order or state.get('size') != self._size:
+            return False
+        bag = state.get('bag')
+        if bag is not None and sorted(bag) != list(range(self._size)):
+            return False
+        self.current = state.get('current')
+        self._plays_left = state.get('plays_left', 0)
+        self._bag = array.array('L', bag) if bag is not None else None
+        self._drawn = state.get('drawn', 0)
+        return True
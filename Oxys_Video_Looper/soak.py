@@ -0,0 +1,338 @@
+# License: GNU GPLv2, see LICENSE.txt
+"""Long-run soak test of a whole VideoLooper against the fake VLC server.
+
+Button presses are recorded from the real input devices into a trace
+file, one `seconds code` line per press, or generated at random. A trace
+is replayed, repeated as often as needed, against a VideoLooper with mock
+LEDs and no input devices, `speed` times faster than real time: clips
+and the gaps between presses are shortened by that factor, the loop plays
+at its real length as it only repeats.
+
+Every `sample` simulated seconds the replay pauses until the clips have
+ended and the loop plays again, then the traced Python memory, RSS, open
+file descriptors, threads, asyncio tasks and the size of the VLC playlist
+are sampled. The pause is not counted as simulated time. After a warm-up
+the samples of the last quarter must not be above those of the middle of
+the run by more than a small tolerance, and the playlist must end the
+size it started, otherwise it fails.
+
+    python3 -m Oxys_Video_Looper.soak record presses.txt
+    python3 -m Oxys_Video_Looper.soak generate presses.txt --hours 10 --rate 120
+    python3 -m Oxys_Video_Looper.soak replay presses.txt --days 3 --speed 2000
+
+Presses that replace clips while they are being started, without the
+clip bank, are the hardest on the playlist:
+
+    python3 -m Oxys_Video_Looper.soak generate busy.txt --hours 2 --rate 3000
+    python3 -m Oxys_Video_Looper.soak replay busy.txt --days 0.25 --speed 200 --busy-policy preempt --no-clip-bank
+"""
+import asyncio
+import gc
+import os
+import random
+import sys
+import tempfile
+import threading
+import tracemalloc
+
+from .bench import BUTTONS, make_config, make_media
+from .fakevlc import FakeVlc, FakeVlcServer
+
+# sample -> (relative, absolute) growth allowed from the middle of the run
+# to its end
+TOLERANCES = {
+    'traced': (0.05, 256 << 10),
+    'rss': (0.05, 2 << 20),
+    'fds': (0.0, 2),
+    'threads': (0.0, 2),
+    'tasks': (0.0, 2),
+    'playlist': (0.0, 1),
+}
+MIN_SAMPLES = 8
+# of every value in the middle and the last quarter of the run
+MIN_COMPARED = 2
+
+
+def read_trace(path):
+    """Return the (seconds, code) presses of a trace file, from 0 on."""
+    presses = []
+    with open(path) as f:
+        for line in f:
+            line = line.split('#', 1)[0].split()
+            if len(line) >= 2:
+                presses.append((float(line[0]), line[1]))
+    presses.sort()
+    if presses:
+        start = presses[0][0]
+        presses = [(seconds - start, code) for seconds, code in presses]
+    return presses
+
+
+def repeat_trace(presses, duration):
+    """Yield the presses again and again until `duration` seconds."""
+    if not presses:
+        return
+    period = presses[-1][0] + max(1.0, presses[-1][0] / len(presses))
+    offset = 0.0
+    while True:
+        for seconds, code in presses:
+            if offset + seconds >= duration:
+                return
+            yield offset + seconds, code
+        offset += period
+
+
+def sample_process():
+    """RSS, open fds and threads of this process from /proc."""
+    sample = {'threads': threading.active_count()}
+    try:
+        with open('/proc/self/statm') as f:
+            sample['rss'] = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        sample['fds'] = len(os.listdir('/proc/self/fd'))
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('Threads:'):
+                    sample['threads'] = int(line.split()[1])
+    except OSError:
+        pass
+    return sample
+
+
+def check_growth(samples, warmup=0.25):
+    """Return a message for every value that grew from the middle of the
+    run to its last quarter by more than TOLERANCES allows, or that was
+    not sampled often enough to tell."""
+    failures = []
+    samples = samples[int(len(samples) * warmup):]
+    middle, end = samples[:len(samples) // 2], samples[len(samples) * 3 // 4:]
+    for name, (relative, absolute) in TOLERANCES.items():
+        before = [sample[name] for sample in middle if sample.get(name) is not None]
+        after = [sample[name] for sample in end if sample.get(name) is not None]
+        if len(before) < MIN_COMPARED or len(after) < MIN_COMPARED:
+            failures.append('{0} has only {1} samples in the middle and {2} at the end, at least {3} are needed'.format(
+                name, len(before), len(after), MIN_COMPARED))
+            continue
+        limit = max(before) * (1 + relative) + absolute
+        if max(after) > limit:
+            failures.append('{0} grew from {1} to {2}'.format(name, max(before), max(after)))
+    return failures
+
+
+class Soak:
+    """Replays presses against a VideoLooper and samples it."""
+
+    def __init__(self, presses, duration, speed=1.0, sample_interval=600.0, clip_length=20.0, loop_length=60.0,
+                 clip_bank=True, busy_policy='ignore'):
+        self.presses = presses
+        self.duration = duration
+        self.speed = speed
+        self.sample_interval = sample_interval
+        self.clip_length = clip_length
+        self.loop_length = loop_length
+        self.clip_bank = clip_bank
+        self.busy_policy = busy_policy
+        self.samples = []
+        self.pressed = 0
+        self.playlist = None
+        self.vlc = None
+        self.looper = None
+        self.snapshots = []
+
+    def _config(self, server, media):
+        config = make_config(server, self.clip_bank, media)
+        config['input']['busy_policy'] = self.busy_policy
+        config['input']['debounce'] = str(0.3 / self.speed)
+        # the watchdog runs in real time, a loop that is interrupted by a
+        # clip many times a second would look stalled
+        config['vlc']['stall_timeout'] = str(5.0 * self.speed)
+        return config
+
+    def _in_loop(self):
+        player = self.looper._player
+        return player.current is None and player.playing_file == 'LOOP'
+
+    def sample(self, elapsed):
+        """Take a sample at `elapsed` simulated seconds, once settled."""
+        # what the fake VLC keeps for the benchmark would count as a leak
+        del self.vlc.history[:], self.vlc.commands[:]
+        gc.collect()
+        sample = {'time': elapsed, 'presses': self.pressed, 'traced': tracemalloc.get_traced_memory()[0],
+                  'tasks': len(asyncio.all_tasks()), 'playlist': len(self.vlc.items)}
+        sample.update(sample_process())
+        self.samples.append(sample)
+        print('{0:>8.1f} h {1:>7} presses  traced {2:>7.0f} KiB  rss {3:>6.1f} MiB  fds {4:>3}  threads {5:>3}  '
+              'tasks {6:>3}  playlist {7}'.format(
+                  elapsed / 3600, self.pressed, sample['traced'] / 1024, sample.get('rss', 0) / (1 << 20),
+                  sample.get('fds'), sample['threads'], sample['tasks'], sample['playlist']))
+        if len(self.samples) == max(1, int(self.duration / self.sample_interval / 4)):
+            # end of the warm-up, compared with the end of the run
+            self.snapshots.append(tracemalloc.take_snapshot())
+
+    async def _settle(self):
+        """Wait until the presses are played and the player is back in the
+        loop."""
+        while (not self._in_loop() or self.looper._player.loop_index is None
+               or len(self.looper._presses)):
+            current = self.looper._player.current
+            if current is not None:
+                await asyncio.gather(current.task, return_exceptions=True)
+            await asyncio.sleep(0.05)
+
+    async def _sample_at(self, started, elapsed):
+        """Settle and sample at `elapsed` simulated seconds after `started`,
+        returns `started` moved on by the time spent settling."""
+        loop = asyncio.get_running_loop()
+        delay = started + elapsed / self.speed - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        paused = loop.time()
+        await self._settle()
+        self.sample(elapsed)
+        return started + loop.time() - paused
+
+    async def run(self):
+        from .video_looper import VideoLooper
+        loop = asyncio.get_running_loop()
+        with tempfile.TemporaryDirectory() as media:
+            make_media(media)
+            self.vlc = FakeVlc({'loop': self.loop_length}, self.clip_length / self.speed)
+            server = FakeVlcServer(self.vlc)
+            address = await server.start()
+            ini = os.path.join(media, 'video_looper.ini')
+            with open(ini, 'w') as f:
+                self._config(address, media).write(f)
+            try:
+                self.looper = VideoLooper(ini)
+                runner = asyncio.create_task(self.looper.run_async())
+                while self.looper._player.changed is None:
+                    await asyncio.sleep(0.01)
+                await self._settle()
+                self.playlist = len(self.vlc.items)
+                started = loop.time()
+                next_sample = self.sample_interval
+                for seconds, code in repeat_trace(self.presses, self.duration):
+                    while next_sample <= seconds:
+                        started = await self._sample_at(started, next_sample)
+                        next_sample += self.sample_interval
+                    delay = started + seconds / self.speed - loop.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    self.looper._handle_button(code, None)
+                    self.pressed += 1
+                    if runner.done():
+                        break
+                while next_sample < self.duration and not runner.done():
+                    started = await self._sample_at(started, next_sample)
+                    next_sample += self.sample_interval
+                if not runner.done():
+                    await self._sample_at(started, self.duration)
+                self.snapshots.append(tracemalloc.take_snapshot())
+                self.looper.quit()
+                await runner
+            finally:
+                await server.close()
+
+    def failures(self):
+        if len(self.samples) < MIN_SAMPLES:
+            return ['only {0} samples, at least {1} are needed'.format(len(self.samples), MIN_SAMPLES)]
+        failures = check_growth(self.samples)
+        final = self.samples[-1]['playlist']
+        if final != self.playlist:
+            failures.append('playlist has {0} items in the loop, {1} at the start'.format(final, self.playlist))
+        return failures
+
+
+def generate(path, hours, rate, seed=None):
+    """Write a trace of random presses, `rate` per hour on average."""
+    rng = random.Random(seed)
+    seconds = 0.0
+    with open(path, 'w') as f:
+        f.write('# {0} random presses per hour for {1} hours\n'.format(rate, hours))
+        while True:
+            seconds += rng.expovariate(rate / 3600.0)
+            if seconds >= hours * 3600:
+                break
+            f.write('{0:.3f} {1}\n'.format(seconds, rng.choice(BUTTONS)))
+
+
+async def record(path, devices):
+    """Append the presses of the real buttons to a trace until cancelled."""
+    from .gamepad import GamepadReader
+    loop = asyncio.get_running_loop()
+    start = []
+
+    with open(path, 'w') as f:
+        def on_press(code, timestamp):
+            if not start:
+                start.append(timestamp)
+            f.write('{0:.3f} {1}\n'.format(timestamp - start[0], code))
+            f.flush()
+            print(code)
+
+        gamepad = GamepadReader(on_press, devices)
+        gamepad.open()
+        loop.add_reader(gamepad.fileno(), gamepad.poll)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            loop.remove_reader(gamepad.fileno())
+            gamepad.close()
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Record button presses and replay them in a long run.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    parser_record = commands.add_parser('record', help="record the presses of the buttons, until Ctrl-C")
+    parser_record.add_argument('trace')
+    parser_record.add_argument('--devices', default='/dev/input/event*')
+    parser_generate = commands.add_parser('generate', help="write a trace of random presses")
+    parser_generate.add_argument('trace')
+    parser_generate.add_argument('--hours', type=float, default=10)
+    parser_generate.add_argument('--rate', type=float, default=60, help="presses per hour")
+    parser_generate.add_argument('--seed', type=int)
+    parser_replay = commands.add_parser('replay', help="replay a trace and look for leaks")
+    parser_replay.add_argument('trace')
+    parser_replay.add_argument('--days', type=float, default=1, help="simulated days to run")
+    parser_replay.add_argument('--speed', type=float, default=1000, help="times faster than real time")
+    parser_replay.add_argument('--sample', type=float, default=900, help="simulated seconds between samples")
+    parser_replay.add_argument('--clip-length', type=float, default=20.0)
+    parser_replay.add_argument('--loop-length', type=float, default=60.0)
+    parser_replay.add_argument('--no-clip-bank', dest='clip_bank', action='store_false')
+    parser_replay.add_argument('--busy-policy', default='ignore')
+    parser_replay.add_argument('--top', type=int, default=10, help="memory growth by line to show on failure")
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        generate(args.trace, args.hours, args.rate, args.seed)
+        return
+    if args.command == 'record':
+        try:
+            asyncio.run(record(args.trace, args.devices))
+        except KeyboardInterrupt:
+            pass
+        return
+
+    presses = read_trace(args.trace)
+    if not presses:
+        sys.exit('No presses in {0}'.format(args.trace))
+    tracemalloc.start()
+    soak = Soak(presses, args.days * 86400, args.speed, args.sample, args.clip_length, args.loop_length,
+                args.clip_bank, args.busy_policy)
+    asyncio.run(soak.run())
+    failures = soak.failures()
+    if not failures:
+        print('No growth over {0:g} days and {1} presses'.format(args.days, soak.pressed))
+        return
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    if len(soak.snapshots) >= 2 and args.top:
+        print('Largest memory growth since the warm-up:', file=sys.stderr)
+        for stat in soak.snapshots[-1].compare_to(soak.snapshots[0], 'lineno')[:args.top]:
+            print('  {0}'.format(stat), file=sys.stderr)
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,21 +2,30 @@
 # Author: Tony DiCola
 # License: GNU GPLv2, see LICENSE.txt
 
+import time
+
+# start of the startup timing report
+IMPORT_STARTED = time.monotonic()
+
+import asyncio
 import configparser
 import importlib
+import json
 import os
-import re
-import subprocess
 import sys
 import signal
-import time
-import threading
-from inputs import get_gamepad
-from gpiozero import LED
-
-
 
+from .analytics import create_play_log
+from .control import create_control_server
+from .configwatch import ConfigWatcher, diff_config, read_config
+from .gamepad import GamepadReader
+from .inputqueue import BUSY_POLICIES, create_input_queue, input_queue_settings
+from .leds import create_led_controller, led_pins, led_settings
+from .mediawatch import MediaWatcher
+from .prefetch import prefetch_settings
+from . import log, m3u, metrics
 from .model import Playlist, Movie
+from .scheduler import ORDERS
 
 
 # Basic video looper architecure:
@@ -42,40 +51,141 @@ from .model import Playlist, Movie
 # - Future file readers and video players can be provided and referenced in the
 #   config to extend the video player use to read from different file sources
 #   or use different video players.
+#
+# - Everything runs on one asyncio event loop: the gamepad reader feeds button
+#   presses into a queue, a player task takes them from there, and an LED
+#   task waits for the player to signal a change of the playing file.
+#
+# - Startup does not wait for fixed times: VLC is connected to as soon as it
+#   listens, and the LEDs and input devices are set up in worker threads
+#   meanwhile. The time each phase took is logged once the loop plays.
+#
+# - Messages go through log.py: events are kept in a ring buffer and written
+#   out in batches from the event loop, SIGUSR1 or a crash dumps the last
+#   ones to a file.
+#
+# - Changes to the config file are applied while running. Only the settings
+#   in RESTART_OPTIONS make the looper exit, supervisord then starts it again.
+RESTART_OPTIONS = {
+    ('video_looper', 'video_player'),
+    ('vlc', 'server'),
+    ('vlc', 'password'),
+}
+
+_log = log.get('looper')
+
+STARTUP_SECONDS = metrics.REGISTRY.gauge('looper_startup_seconds', 'Time each phase of the startup took.', ('phase',))
+
+
 class VideoLooper:
 
     def __init__(self, config_path):
         """Create an instance of the main video looper application class. Must
         pass path to a valid video looper ini configuration file.
         """
+        self._timings = {'imports': time.monotonic() - IMPORT_STARTED}
+        started = time.monotonic()
         # Load the configuration.
+        self._config_path = config_path
         self._config = configparser.ConfigParser()
         if len(self._config.read(config_path)) == 0:
             raise RuntimeError('Failed to find configuration file at {0}, is the application properly installed?'.format(config_path))
-        self._console_output = self._config.getboolean('video_looper', 'console_output')
+        # non-zero asks supervisord to start the looper again
+        self.exit_code = 0
+        log.configure_logging(self._config)
+        _log.info('Starting Oxys Video Looper.')
         # Load other configuration values.
         self._running = True
+        self._busy_policy = self._config.get('input', 'busy_policy', fallback='ignore')
+        if self._busy_policy not in BUSY_POLICIES:
+            raise RuntimeError('Unknown busy_policy {0}, must be one of {1}'.format(self._busy_policy, ', '.join(BUSY_POLICIES)))
 
         # Load configured video player and file reader modules.
         self._player = self._load_player()
 
-        # Init LEDs
-        self.init_leds()
+        # LEDs are set up by run_async(), gpiozero is slow to import
+        self._leds = None
+        self._buttons = list(led_pins(self._config))
 
-        # Set up USB button control
-        self._keyboard_thread = threading.Thread(target=self._handle_keyboard_shortcuts, daemon=True)
-        self._keyboard_thread.start()
+        # Titles and lengths of the button clips from the fixed playlist
+        self._playlist = None
+        self._button_movies = {}
+        self._load_playlist()
 
-    def _print(self, message):
-        """Print message to standard output if console output is enabled."""
-        if self._console_output:
-            print(message)
+        # Event loop state, created by run_async()
+        self._loop = None
+        self._stopped = None
+        self._presses = None
+        self._gamepad = None
+        self._play_log = None
+        # when the last press came or the last clip ended, and the clip of
+        # the playlist playing while nobody pressed a button
+        self._idle_since = 0.0
+        self._idle_handle = None
+        # play logs replaced by a reload, closed once their clips are over
+        self._old_play_logs = []
+        self._tasks = {}
+        self._timings['config'] = time.monotonic() - started
 
     def _load_player(self):
         """Load the configured video player and return an instance of it."""
         module = self._config.get('video_looper', 'video_player')
         return importlib.import_module('.' + module, 'Oxys_Video_Looper').create_player(self._config)
 
+    def _load_playlist(self):
+        """Load the fixed playlist, if one is configured, and pick out the
+        entries of the button clips."""
+        movies = m3u.load_playlist(self._config)
+        if movies is None:
+            self._playlist = None
+            self._button_movies = {}
+            return
+        default = 'shuffle' if self._config.getboolean('video_looper', 'is_random', fallback=False) else 'sequential'
+        order = self._config.get('playlist', 'order', fallback=default)
+        if order not in ORDERS:
+            raise RuntimeError('Unknown playlist order {0}, must be one of {1}'.format(order, ', '.join(ORDERS)))
+        self._playlist = Playlist(movies, order)
+        resumed = self._playlist.restore(self._read_playlist_state())
+        self._button_movies = movies.find(self._buttons)
+        _log.info('Playlist {0}: {1} movies, {2} button clips, {3} order{4}',
+                  movies.path, self._playlist.length(), len(self._button_movies), order,
+                  ', resumed' if resumed else '')
+
+    def _playlist_state_path(self):
+        path = self._config.get('playlist', 'state_file', fallback='')
+        return os.path.expanduser(path) if path else None
+
+    def _read_playlist_state(self):
+        path = self._playlist_state_path()
+        if path is None:
+            return None
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save_playlist_state(self):
+        """Save the position in the playlist rotation for the next start."""
+        path = self._playlist_state_path()
+        if path is None or self._playlist is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            with open(path + '.tmp', 'w') as f:
+                json.dump(self._playlist.state(), f)
+            os.replace(path + '.tmp', path)
+        except OSError as exc:
+            _log.warning('Could not save playlist state to {0}: {1}', path, exc)
+
+    def _movie(self, code):
+        """Movie of a button clip, with title and length from the playlist.
+        The player only uses that length for files it could not probe."""
+        entry = self._button_movies.get(code)
+        if entry is None:
+            return Movie(code)
+        return Movie(code, entry.title, entry.repeats, entry.duration)
+
     def _is_number(self, s):
         try:
             float(s) 
@@ -83,83 +193,410 @@ class VideoLooper:
         except ValueError:
             return False
 
-    def _handle_keyboard_shortcuts(self):
-        while self._running:
-            events = get_gamepad()
-            for event in events:
-                if event.ev_type == 'Key' and event.state:
-                    self._player.play(Movie( event.code ))
-                    print(event.code)
-                    # BTN_TRIGGER
-                    # BTN_THUMB
-                    # BTN_THUMB2
-                    # BTN_TOP
-                    # BTN_TOP2
-                    # BTN_PINKIE
+    def _handle_button(self, code, timestamp):
+        """Called by the gamepad reader for every button press."""
+        # BTN_TRIGGER
+        # BTN_THUMB
+        # BTN_THUMB2
+        # BTN_TOP
+        # BTN_TOP2
+        # BTN_PINKIE
+        return self._presses.put(code, timestamp)
 
-    def run(self):
+    async def _play_presses(self):
+        """Play the clip of every button press. What happens to a press while
+        a clip is playing depends on the busy policy."""
+        while True:
+            code = await self._presses.get()
+            self._idle_since = self._loop.time()
+            current = self._player.current
+            preempt = self._busy_policy == 'preempt'
+            if current is not None and current is self._idle_handle:
+                # a press always replaces the playlist
+                preempt = True
+            elif current is not None:
+                if self._busy_policy == 'ignore':
+                    self._presses.drop()
+                    if self._play_log is not None:
+                        self._play_log.track(code, None)
+                    continue
+                if self._busy_policy == 'queue-next':
+                    # presses while waiting are merged, the latest one wins
+                    await asyncio.gather(current.task, return_exceptions=True)
+                    code, replaced = self._presses.take_latest(code)
+                    if self._play_log is not None:
+                        for press in replaced:
+                            self._play_log.track(press, None)
+            movie = self._movie(code)
+            _log.debug('Press {0}', movie)
+            handle = self._player.play(movie, preempt=preempt)
+            if handle is not None:
+                handle.task.add_done_callback(self._clip_ended)
+            if self._play_log is not None:
+                self._play_log.track(code, handle)
+
+    def _clip_ended(self, task):
+        self._idle_since = self._loop.time()
+
+    async def _play_playlist(self, idle):
+        """Play the next movie of the playlist whenever the loop played for
+        `idle` seconds without a press."""
+        while True:
+            wait = self._idle_since + idle - self._loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            current = self._player.current
+            if current is not None:
+                # its end starts the idle time again
+                await asyncio.wait([current.task])
+                continue
+            self._idle_since = self._loop.time()
+            entry = self._playlist.get_next(False) if self._playlist is not None else None
+            if entry is None:
+                continue
+            # the player knows the movies of the directory by file name
+            movie = Movie(os.path.basename(entry.filename), entry.title, entry.repeats, entry.duration)
+            _log.debug('Idle, playing {0}', movie)
+            handle = self._player.play(movie)
+            if handle is not None:
+                handle.task.add_done_callback(self._clip_ended)
+                self._idle_handle = handle
+
+    def _play_when_idle(self):
+        """Play the playlist while nobody presses a button, if enabled."""
+        idle = self._config.getfloat('playlist', 'idle', fallback=0)
+        if idle <= 0:
+            task = self._tasks.pop('playlist', None)
+            if task is not None:
+                task.cancel()
+            return
+        self._idle_since = self._loop.time()
+        self._start_task('playlist', self._play_playlist(idle))
+
+    def _press_counts(self):
+        stats = self._presses.stats()
+        accepted = stats['received'] - stats['debounced'] - stats['coalesced'] - stats['dropped'] - stats['waiting']
+        return {'accepted': accepted, 'debounced': stats['debounced'],
+                'coalesced': stats['coalesced'], 'dropped': stats['dropped']}
+
+    async def _update_leds(self):
+        """Follow the playing file on the LEDs."""
+        while True:
+            await self._player.changed.wait()
+            self._player.changed.clear()
+            if self._leds.state != self._player.playing_file:
+                _log.debug('LEDs: {0}', self._player.playing_file)
+                self._leds.show(self._player.playing_file)
+
+    def _start_task(self, name, coro):
+        """Run `coro` as the task `name`, replacing the task running as it."""
+        previous = self._tasks.get(name)
+        if previous is not None:
+            previous.cancel()
+        self._tasks[name] = asyncio.create_task(coro)
+
+    def _create_gamepad(self):
+        """Open the USB buttons, can run in a worker thread."""
+        gamepad = GamepadReader(self._handle_button,
+                                self._config.get('input', 'devices', fallback='/dev/input/event*'))
+        gamepad.open()
+        return gamepad
 
+    def _open_gamepad(self, gamepad=None):
+        """Set up USB button control, the reader's epoll fd is watched by the loop"""
+        self._gamepad = gamepad or self._create_gamepad()
+        self._loop.add_reader(self._gamepad.fileno(), self._gamepad.poll)
+
+    def _close_gamepad(self):
+        if self._gamepad is not None:
+            self._loop.remove_reader(self._gamepad.fileno())
+            self._gamepad.close()
+            self._gamepad = None
+
+    async def _reload_config(self):
+        """Apply the changes of the config file to the running looper."""
+        try:
+            config = read_config(self._config_path)
+        except (OSError, configparser.Error) as exc:
+            _log.warning('Not reloading {0}: {1}', self._config_path, exc)
+            return
+        changed = diff_config(self._config, config)
+        if not changed:
+            return
+        _log.info('Config changed: {0}', ', '.join('{0}.{1}'.format(*item) for item in sorted(changed)))
+        if changed & RESTART_OPTIONS:
+            _log.info('Restarting for {0}', ', '.join('{0}.{1}'.format(*item) for item in sorted(changed & RESTART_OPTIONS)))
+            self.exit_code = 1
+            self.quit()
+            return
+        try:
+            self._check_config(config)
+        except (ValueError, RuntimeError) as exc:
+            _log.warning('Not reloading, {0}', exc)
+            return
+        log.configure_logging(config)
+        sections = {section for section, option in changed}
+        previous, self._config = self._config, config
+        self._busy_policy = config.get('input', 'busy_policy', fallback='ignore')
+        if 'input' in sections:
+            self._presses.configure(*input_queue_settings(config))
+            if ('input', 'devices') in changed:
+                self._close_gamepad()
+                self._open_gamepad(await self._loop.run_in_executor(None, self._create_gamepad))
+        if 'leds' in sections:
+            self._replace_leds(previous)
+        if 'metrics' in sections:
+            self._start_task('metrics', metrics.run_exporters(config))
+        if 'directory' in sections:
+            self._watch_media()
+        if 'control' in sections:
+            self._serve_control()
+        if 'analytics' in sections:
+            self._log_plays()
+        if 'playlist' in sections or 'directory' in sections or ('video_looper', 'is_random') in changed:
+            self._save_playlist_state()
+            try:
+                self._load_playlist()
+            except RuntimeError as exc:
+                _log.warning('{0}', exc)
+        if ('playlist', 'idle') in changed:
+            self._play_when_idle()
+        await self._player.reconfigure(config, changed)
+
+    def _check_config(self, config):
+        """Raise ValueError or RuntimeError for a wrong setting of those a
+        reload applies, before any of them is applied."""
+        busy_policy = config.get('input', 'busy_policy', fallback='ignore')
+        if busy_policy not in BUSY_POLICIES:
+            raise RuntimeError('Unknown busy_policy {0}, must be one of {1}'.format(busy_policy, ', '.join(BUSY_POLICIES)))
+        log.logging_settings(config)
+        input_queue_settings(config)
+        led_pins(config)
+        led_settings(config)
+        prefetch_settings(config)
+        config.getfloat('playlist', 'idle', fallback=0)
+
+    def _replace_leds(self, previous):
+        """Set up the LEDs of the changed [leds] section. Their pins are only
+        free once the old LEDs are closed, if the new ones cannot be set up
+        those of the `previous` config are set up again."""
+        self._leds.close()
+        try:
+            leds = create_led_controller(self._config)
+        except Exception as exc:
+            _log.error('Could not set up the LEDs, keeping the old ones: {0!r}', exc)
+            leds = create_led_controller(previous)
+        self._leds = leds
+        self._buttons = leds.buttons
+        self._leds.show(self._player.playing_file)
+        self._start_task('leds', self._leds.run())
+
+    def _control_trigger(self, request):
+        code = request.get('code')
+        if not isinstance(code, str) or not code:
+            raise ValueError('trigger needs a button code')
+        loop = self._config.get('video_looper', 'loop')
+        if code in (loop, os.path.splitext(loop)[0], 'LOOP'):
+            raise ValueError('{0} is the loop, not a clip'.format(code))
+        # the same way as a press of a physical button
+        return {'queued': self._handle_button(code, None)}
+
+    def _control_status(self, request):
+        current = self._player.current
+        return {
+            'playing': self._player.playing_file,
+            'clip': current.movie.filename if current is not None else None,
+            'waiting': len(self._presses),
+            'presses': self._press_counts(),
+            'outputs': [{'server': output.server, 'up': output.up, 'loop_index': output.loop_index,
+                         'playing_index': output.playing_index} for output in self._player.outputs],
+        }
+
+    def _control_loop(self, request):
+        current = self._player.current
+        if current is not None:
+            # the clip task goes back to the loop when cancelled
+            current.cancel()
+        return {'clip': current.movie.filename if current is not None else None}
+
+    def _control_stop(self, request):
+        self.quit()
+        return {}
+
+    def _serve_control(self):
+        """Accept requests on the control socket, if enabled."""
+        server = create_control_server(self._config, {
+            'trigger': self._control_trigger,
+            'status': self._control_status,
+            'loop': self._control_loop,
+            'stop': self._control_stop,
+        })
+        if server is None:
+            task = self._tasks.pop('control', None)
+            if task is not None:
+                task.cancel()
+            return
+        self._start_task('control', server.run())
+
+    def _log_plays(self):
+        """Record the presses in the play log, if enabled. A log replaced by
+        a reload still records the clips that are playing."""
+        if self._play_log is not None:
+            self._old_play_logs.append(self._play_log)
+        self._play_log = create_play_log(self._config)
+        if self._play_log is None and not self._old_play_logs:
+            task = self._tasks.pop('analytics', None)
+            if task is not None:
+                task.cancel()
+            return
+        self._start_task('analytics', self._write_plays())
+
+    async def _write_plays(self):
+        """Close the replaced play logs once their clips are over, then
+        write the current one."""
+        while self._old_play_logs:
+            await self._old_play_logs[0].close()
+            del self._old_play_logs[0]
+        if self._play_log is not None:
+            await self._play_log.run()
+
+    def _watch_media(self):
+        """Follow changes to the movies in the directory, if enabled."""
+        if not self._config.getboolean('directory', 'watch', fallback=True):
+            task = self._tasks.pop('media', None)
+            if task is not None:
+                task.cancel()
+            return
+        watcher = MediaWatcher(self._config.get('directory', 'path'), self._player.media_changed,
+                               self._config.getfloat('directory', 'settle', fallback=2.0))
+        self._start_task('media', watcher.run())
+
+    def run(self):
         """Main program loop.  Will never return!"""
-        # Main loop to play videos in the playlist and listen for file changes.
+        asyncio.run(self.run_async())
 
-        while self._running:
-            # Just wait for inputs
+    async def run_async(self):
+        """Start the player and run the input, player and LED tasks until
+        quit() is called."""
+        self._stopped = asyncio.Event()
+        self._presses = create_input_queue(self._config)
+        metrics.REGISTRY.callback('looper_presses_total', 'Button presses by what happened to them.', 'counter',
+                                  self._press_counts, ('result',))
+        self._loop = asyncio.get_running_loop()
+        self._loop.set_exception_handler(log.asyncio_exception_handler)
+        log.EVENTS.attach(self._loop)
+        try:
+            await self._run()
+        finally:
+            log.EVENTS.detach()
+
+    async def _run(self):
+        if not self._running:
+            return
+        # VLC, the LEDs and the input devices come up at the same time
+        timings = self._timings
+        started = self._loop.time()
+        _, _, gamepad = await asyncio.gather(
+            self._player.start(self._buttons, timings),
+            metrics.timed(timings, 'leds', self._loop.run_in_executor(None, self.init_leds)),
+            metrics.timed(timings, 'input', self._loop.run_in_executor(None, self._create_gamepad)))
+        timings['startup'] = self._loop.time() - started
+        self._report_startup(timings)
 
-            # Give the CPU some time to do other tasks. low values increase "responsiveness to changes" and reduce the pause between files
-            # but increase CPU usage
-            # since keyboard commands are handled in a seperate thread this sleeptime mostly influences the pause between files
-            if self.led_state != self._player.playing_file:
-                if self._player.playing_file == 'LOOP':
-                    self.reset_leds()
-                else:
-                    self.single_led(self._player.playing_file)
+        self._open_gamepad(gamepad)
+        self._start_task('presses', self._play_presses())
+        self._play_when_idle()
+        self._start_task('update_leds', self._update_leds())
+        self._start_task('leds', self._leds.run())
+        self._start_task('metrics', metrics.run_exporters(self._config))
+        self._start_task('prefetch', self._player.prefetch.run())
+        self._start_task('watchdog', self._player.watch())
+        self._watch_media()
+        self._serve_control()
+        self._log_plays()
+        if self._config.getboolean('video_looper', 'watch_config', fallback=True):
+            self._start_task('config', ConfigWatcher(self._config_path, self._reload_config).run())
+        try:
+            await self._stopped.wait()
+        finally:
+            self._close_gamepad()
+            tasks = list(self._tasks.values())
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self._tasks = {}
+            if self._player is not None:
+                current = self._player.current
+                await self._player.stop()
+                play_logs = self._old_play_logs + ([self._play_log] if self._play_log is not None else [])
+                if current is not None and play_logs:
+                    # record the clip that was cut short
+                    await asyncio.gather(current.task, return_exceptions=True)
+                    for play_log in play_logs:
+                        await play_log.flush()
+            self._save_playlist_state()
 
-            time.sleep(0.5)
+    def _report_startup(self, timings):
+        for phase, seconds in timings.items():
+            STARTUP_SECONDS.labels(phase).set(seconds)
+        _log.info('Startup: {0}, loop playing {1:.0f} ms after the imports started',
+                  ', '.join('{0} {1:.0f} ms'.format(phase, seconds * 1000) for phase, seconds in timings.items()
+                            if phase != 'startup'),
+                  (time.monotonic() - IMPORT_STARTED) * 1000)
 
     def init_leds(self):
-        """Shut down the program"""
-        self.leds = {
-            'BTN_TRIGGER': LED(21), # 1 Orange
-            'BTN_THUMB': LED(20), # 2 Green striped
-            'BTN_THUMB2': LED(16), # 3 Green
-            'BTN_TOP': LED(13), # 4 Blue striped
-            'BTN_TOP2': LED(19), # 5 Blue
-            'BTN_PINKIE': LED(26) # 6 Brown striped
-        }
-        self.reset_leds()
-
-    def reset_leds(self):
-        self.led_state = 'LOOP'
-        print('ALL LED ON!')
-        for key in self.leds:
-            self.leds[key].on()
-
-    def single_led(self, led):
-        print('SINGLE LED: ' + led)
-        self.led_state = led
-        for key in self.leds:
-            if led == key:
-                self.leds[key].on()
-            else:
-                print(key + ' off')
-                self.leds[key].off()
+        """Set up the button LEDs, all on for the loop"""
+        self._leds = create_led_controller(self._config)
+        self._leds.show('LOOP')
 
     def quit(self):
         """Shut down the program"""
-        self._print("quitting Video Looper")
+        _log.info('Quitting')
         self._running = False
-        if self._player is not None:
-            self._player.stop()
+        # the player is stopped by run_async() once the tasks are done
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stopped.set)
 
 
     def signal_quit(self, signal, frame):
-        """Shut down the program, meant to by called by signal handler."""
-        self._print("received signal to quit")
+        """Shut down the program, meant to by called by signal handler. The
+        signal is logged on the event loop."""
+        if self._loop is None:
+            self._running = False
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._quit_on_signal, signal)
+        except RuntimeError:
+            # the loop is closed already
+            self._running = False
+
+    def _quit_on_signal(self, signal):
+        _log.info('Received signal {0}, quitting', signal)
         self.quit()
 
+    def signal_dump(self, signal, frame):
+        """Write the last events to the dump file, meant to be called by
+        signal handler. The file is written from the event loop."""
+        if self._loop is None:
+            # not started yet, the ring holds little worth dumping
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._dump_events)
+        except RuntimeError:
+            # the loop is closed
+            pass
+
+    def _dump_events(self):
+        """Write the dump file in a worker thread."""
+        def dumped(future):
+            if not future.cancelled():
+                _log.info('Events written to {0}', future.result() or 'nowhere, no dump_file')
+        self._loop.run_in_executor(None, log.EVENTS.dump).add_done_callback(dumped)
+
 # Main entry point.
 if __name__ == '__main__':
-    print('Starting Oxys Video Looper.')
+    log.install_crash_dump()
     # Default config path to /boot.
     config_path = '/boot/video_looper.ini'
     # Override config path if provided as parameter.
@@ -170,5 +607,8 @@ if __name__ == '__main__':
     # Configure signal handlers to quit on TERM or INT signal.
     signal.signal(signal.SIGTERM, videolooper.signal_quit)
     signal.signal(signal.SIGINT, videolooper.signal_quit)
+    # and write the last events to the dump file on USR1
+    signal.signal(signal.SIGUSR1, videolooper.signal_dump)
     # Run the main loop.
     videolooper.run()
+    sys.exit(videolooper.exit_code)
@@ -1,65 +1,861 @@
 # Copyright 2015 Adafruit Industries.
 # Author: Tony DiCola
 # License: GNU GPLv2, see LICENSE.txt
+import asyncio
 import os
-import subprocess
-import time
-from .vlcclient import VLCClient
+from . import log, metrics, mp4info
+from .library import create_library
+from .prefetch import create_prefetcher, prefetch_settings
+from .vlcclient import AsyncVLCClient, WrongPasswordError
+
+_log = log.get('vlc')
+
+COMMAND_SECONDS = metrics.REGISTRY.histogram(
+    'looper_vlc_command_seconds', 'Round trip time of VLC telnet commands.', ('command',))
+PRESS_TO_PLAY_SECONDS = metrics.REGISTRY.histogram(
+    'looper_press_to_play_seconds', 'Time from play() until VLC was told to play the clip.')
+LOOP_GAP_SECONDS = metrics.REGISTRY.histogram(
+    'looper_loop_gap_seconds', 'Time from the detected end of a clip until the player is back in the loop.')
+END_OVERRUN_SECONDS = metrics.REGISTRY.histogram(
+    'looper_clip_end_overrun_seconds', 'Detected end of a clip minus its expected end.')
+CLIPS = metrics.REGISTRY.counter('looper_clips_total', 'Clips started.', ('clip',))
+CLIPS_PREEMPTED = metrics.REGISTRY.counter('looper_clips_preempted_total', 'Clips replaced by another clip.')
+SEARCH_MISSES = metrics.REGISTRY.counter(
+    'looper_playlist_search_misses_total', 'Lookups of the loop or a clip that were not in the playlist.')
+CLIP_PLAYING = metrics.REGISTRY.gauge('looper_clip_playing', '1 while a clip plays, 0 in the loop.')
+TRIGGER_SKEW_SECONDS = metrics.REGISTRY.histogram(
+    'looper_trigger_skew_seconds', 'Time between the first and the last VLC instance starting a clip.')
+OUTPUT_LAG_SECONDS = metrics.REGISTRY.gauge(
+    'looper_output_lag_seconds', 'How much later than the first instance each VLC instance started the last clip.',
+    ('output',))
+VLC_FAILURES = metrics.REGISTRY.counter(
+    'looper_vlc_failures_total', 'Lost connections, restarts and stalls of VLC instances.', ('output', 'reason'))
+VLC_RECOVERY_SECONDS = metrics.REGISTRY.histogram(
+    'looper_vlc_recovery_seconds', 'Time from noticing a VLC failure until the loop played again.',
+    buckets=(0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 300.0))
+VLC_RESTORE_SECONDS = metrics.REGISTRY.histogram(
+    'looper_vlc_restore_seconds', 'Time from reconnecting to VLC until the loop played again.')
+VLC_UP = metrics.REGISTRY.gauge('looper_vlc_up', '1 while the VLC instance is connected and playing.', ('output',))
+
+
+def _observe_command(line, seconds):
+    COMMAND_SECONDS.labels(line.partition(' ')[0]).observe(seconds)
+    _log.debug('> {0} ({1:.1f} ms)', line, seconds * 1000)
+
+class PlayHandle:
+    """A clip started by VlcPlayer.play(). Await it to wait for the clip to
+    end and the player to be back in the loop."""
+
+    def __init__(self, movie):
+        self.movie = movie
+        self.path = None
+        # playlist index of the clip on the first VLC instance, and on each
+        # of them by output
+        self.index = None
+        self.indices = {}
+        # event loop times: when play() was called, when the clip was
+        # started, when it is expected to end (from get_length/get_time), when
+        # the end was detected and when it stopped playing for any reason
+        self.requested = None
+        self.started = None
+        # clip length from the file, makes the deadline exact
+        self.duration = None
+        self.deadline = None
+        self.ended = None
+        self.stopped = None
+        # seconds between the first and the last instance starting the clip
+        self.skew = None
+        self.preempted = False
+        # clips this one replaced, deleted from the playlist once it plays
+        self.stale = []
+        # True until VLC was told to play the clip, cancel() waits for that
+        self.starting = False
+        self.cancelled = False
+        self.task = None
+
+    def done(self):
+        return self.task is not None and self.task.done()
+
+    def cancel(self):
+        """Stop the clip. While it is being started the task is cancelled
+        once its playlist indices are known, or the item VLC added would be
+        left behind."""
+        if self.task is None:
+            return
+        if self.starting:
+            self.cancelled = True
+        else:
+            self.task.cancel()
+
+    def __await__(self):
+        return self.task.__await__()
+
+
+class VlcOutput:
+    """One VLC instance driven by the player, with the playlist indices of
+    its loop and clip bank."""
+
+    def __init__(self, server, password):
+        self.server = server
+        self.vlc = AsyncVLCClient(server, password=password, observer=_observe_command)
+        self.loop_index = None
+        self.playing_index = None
+        # Clip bank: clip name -> playlist index of the preloaded clips, and
+        # the indices of the copies of the loop that follow each of them.
+        self.bank = {}
+        self.loop_indices = set()
+        # False from a failure until the watchdog restored the instance, set
+        # check to make the watchdog look right away, created by start() on
+        # the event loop
+        self.up = False
+        self.check = None
+        # loop time the watchdog noticed the failure it recovers from
+        self.down_since = None
+
+    async def connect(self, delay=0.05, max_delay=0.5, timeout=None):
+        """Connect to VLC, trying again while it does not accept connections
+        yet. The wait between tries doubles up to `max_delay` seconds. With
+        a `timeout` the last error is raised once it has passed and a wrong
+        password right away, else it tries forever."""
+        loop = asyncio.get_running_loop()
+        give_up = None if timeout is None else loop.time() + timeout
+        while True:
+            try:
+                await self.vlc.connect()
+                return
+            except WrongPasswordError:
+                if give_up is not None:
+                    raise
+                _log.error('VLC {0}: wrong password', self.server)
+                delay = max_delay
+            except (OSError, EOFError, asyncio.TimeoutError):
+                if give_up is not None and loop.time() + delay > give_up:
+                    raise
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_delay)
+
+    def set_up(self, up):
+        self.up = up
+        VLC_UP.labels(self.server).set(1 if up else 0)
+
+    def intact(self):
+        """True if the playlist mirror still has the loop and the clip bank,
+        False after VLC restarted."""
+        items = self.vlc.playlist_mirror.items
+        return (self.loop_index in items and all(index in items for index in self.bank.values())
+                and all(index in items for index in self.loop_indices))
+
+    async def probe(self):
+        """Return the playing index, time, length and whether VLC plays,
+        in one round trip."""
+        async with self.vlc.batch() as batch:
+            index = batch.playing_index()
+            position = batch.get_time()
+            length = batch.get_length()
+            playing = batch.is_playing()
+        return index.value, position.value, length.value, playing.value
+
+    async def enqueue(self, paths, replace=False):
+        """Enqueue the movies and return their playlist indices. The playlist
+        is cleared first, or with `replace` the items that were there before
+        are returned as well, to be deleted once playback moved on."""
+        old = set(self.vlc.playlist_mirror.items) if replace else set()
+        async with self.vlc.batch() as batch:
+            if not replace:
+                batch.clear()
+            for path in paths:
+                batch.enqueue(path)
+            batch.playlist()
+        return sorted(set(self.vlc.playlist_mirror.items) - old), old
+
+    async def load_bank(self, names, paths, loop, replace=False):
+        """Enqueue the loop and clips of the clip bank and record their
+        indices, returns the indices of the items that were there before."""
+        indices, old = await self.enqueue(paths, replace)
+        self.bank = {}
+        self.loop_indices = set()
+        for name, index in zip(names, indices):
+            if name == loop:
+                self.loop_indices.add(index)
+            else:
+                self.bank[name] = index
+        self.loop_index = indices[0] if indices else None
+        return old
+
+    async def load_loop(self, path, replace=False):
+        """Enqueue only the loop, returns the indices of the old items."""
+        indices, old = await self.enqueue([path], replace)
+        self.bank = {}
+        self.loop_indices = set()
+        self.loop_index = indices[0] if indices else None
+        return old
+
+    async def play_loop(self, banked, delete=()):
+        """Play the loop, repeating it in clip bank mode or looping the
+        playlist otherwise, and delete the items in `delete`."""
+        async with self.vlc.batch() as batch:
+            if banked:
+                batch.unloop()
+                batch.set_repeat(True)
+            else:
+                batch.set_repeat(False)
+                batch.loop()
+            if self.loop_index is not None:
+                batch.goto(self.loop_index)
+            for index in sorted(delete):
+                batch.delete(index)
+        self.playing_index = self.loop_index
+
+    async def resume(self, banked, restart=False):
+        """Go on with the loop after a lost connection, the playlist is
+        still there. A loop that plays is not restarted unless `restart`,
+        anything else in the playlist is deleted."""
+        keep = {self.loop_index} | set(self.bank.values()) | self.loop_indices
+        extra = set(self.vlc.playlist_mirror.items) - keep
+        async with self.vlc.batch() as batch:
+            index = batch.playing_index()
+            playing = batch.is_playing()
+        if restart or not playing.value or index.value not in {self.loop_index} | self.loop_indices:
+            await self.play_loop(banked, extra)
+            return
+        async with self.vlc.batch() as batch:
+            if banked:
+                batch.unloop()
+                batch.set_repeat(True)
+            else:
+                batch.set_repeat(False)
+                batch.loop()
+            for item in sorted(extra):
+                batch.delete(item)
+        self.playing_index = index.value
+
+    async def ensure_loop(self, loop, path):
+        # The playlist mirror answers this without asking VLC
+        self.loop_index = await self.vlc.search(loop)
+        # Make sure we have the loop after this
+        if self.loop_index is None:
+            SEARCH_MISSES.inc()
+            _log.warning('No loop exists on {0}', self.server)
+            async with self.vlc.batch() as batch:
+                batch.enqueue(path)
+                batch.playlist()
+            self.loop_index = await self.vlc.search(loop)
+
+    async def trigger(self, clip, path):
+        """Start a clip with as few round trips as possible, returns the
+        event loop time VLC confirmed it."""
+        if clip in self.bank:
+            async with self.vlc.batch() as batch:
+                batch.set_repeat(False)
+                batch.goto(self.bank[clip])
+        else:
+            # add the clip and refresh the playlist mirror in one round trip
+            async with self.vlc.batch() as batch:
+                batch.add(path)
+                batch.playlist()
+        return asyncio.get_running_loop().time()
+
+    async def clip_index(self, clip, loop, loop_path):
+        """Playlist index of a clip that was just started."""
+        if clip in self.bank:
+            return self.bank[clip]
+        await self.ensure_loop(loop, loop_path)
+        index = await self.vlc.search(clip)
+        if index is None:
+            SEARCH_MISSES.inc()
+        return index
+
+    async def back_to_loop(self, clip_index, settle=1.0, poll=0.05):
+        """Keep repeating the copy of the loop VLC went on to after a clip of
+        the clip bank, or go back to the loop if it went somewhere else.
+        Waits up to `settle` seconds for VLC to leave the clip, other
+        instances may be a little behind the one that was polled."""
+        loop = asyncio.get_running_loop()
+        give_up = loop.time() + settle
+        while True:
+            index = await self.vlc.playing_index()
+            if index != clip_index or loop.time() >= give_up:
+                break
+            await asyncio.sleep(poll)
+        self.playing_index = index
+        async with self.vlc.batch() as batch:
+            batch.set_repeat(True)
+            if self.playing_index not in self.loop_indices:
+                batch.goto(self.loop_index)
+                self.playing_index = self.loop_index
+
+    async def bank_clip(self, clip, paths):
+        """Add a clip and a copy of the loop after it to the clip bank."""
+        indices, old = await self.enqueue(paths, replace=True)
+        if len(indices) == 2:
+            self.bank[clip] = indices[0]
+            self.loop_indices.add(indices[1])
+
+    async def unbank(self, clip):
+        """Delete a clip and the copy of the loop after it from the clip bank."""
+        index = self.bank.pop(clip, None)
+        if index is None:
+            return
+        following = [item for item in sorted(self.vlc.playlist_mirror.items) if item > index]
+        async with self.vlc.batch() as batch:
+            batch.delete(index)
+            if following and following[0] in self.loop_indices:
+                batch.delete(following[0])
+                self.loop_indices.discard(following[0])
+
 
 class VlcPlayer:
+    """Plays the loop and the button clips on one or more VLC instances.
+    The first instance is polled for the end of a clip, the others follow
+    it."""
 
     def __init__(self, config):
-        """Connect to VLC telnet instance run by supervisord
+        """Create the player, call start() from the event loop to connect
         """
         self.config=config
-        self._vlc = VLCClient('localhost')
-        time.sleep(2)
-        self._vlc.connect()
-        time.sleep(2)
-        self._vlc.clear()
-        self.loop_index = None
-        self.ensure_loop()
-        self._vlc.play()
-        self._vlc.loop()
-        self.playing_index = self.loop_index
+        servers = [server.strip() for server in config.get('vlc', 'server', fallback='localhost').split(',')]
+        password = config.get('vlc', 'password', fallback='admin')
+        self._outputs = [VlcOutput(server, password) for server in servers if server]
         self.playing_file='LOOP'
-        print("Loop index" + self.loop_index)
-
-    def play(self, movie, **kwargs):
-        """Play the provided movied file, if we are in the loop"""
-        self.playing_index=self._vlc.playing_index()
-        print("PLAY! Now paying " + self.playing_index)
-        if self.playing_index == self.loop_index:
-            self._vlc.add(self.config.get('directory', 'path') + '/' + movie.filename  + '.mp4')
-            self.ensure_loop()
-            index=self._vlc.search(movie.filename)
-            print("New index " + index)
-            self.playing_index=index
-            self.playing_file=movie.filename
-            while self.playing_index==index:
-                time.sleep(2)
-                self.playing_index=self._vlc.playing_index()
-
-            self.playing_file='LOOP'
-            print("Delete index " + index)
-            self._vlc.delete(index)
+        # set whenever playing_file changes
+        self.changed = None
+        self._current = None
+        # PlayHandle of the last clip while it takes VLC back to the loop
+        self._returning = None
+        # Polling interval while a clip plays, from max_poll far away from the
+        # end down to min_poll close to it.
+        self._min_poll = config.getfloat('vlc', 'min_poll', fallback=0.05)
+        self._max_poll = config.getfloat('vlc', 'max_poll', fallback=2.0)
+        self._use_clip_bank = config.getboolean('vlc', 'clip_bank', fallback=False)
+        self._default_clips = []
+        self.library = create_library(config, mp4info.read_info)
+        self._check_decoder = config.getboolean('vlc', 'check_decoder', fallback=True)
+        # The watchdog probes every VLC instance every watchdog_interval
+        # seconds, reconnects with a backoff doubling up to reconnect_max
+        # seconds and restarts playback that did not move for stall_timeout.
+        self._watchdog_interval = config.getfloat('vlc', 'watchdog_interval', fallback=1.0)
+        self._reconnect_max = config.getfloat('vlc', 'reconnect_max', fallback=0.5)
+        self._stall_timeout = config.getfloat('vlc', 'stall_timeout', fallback=5.0)
+        # keeps the loop and the button clips in the page cache, run() by the looper
+        self.prefetch = create_prefetcher(config)
+        # presses are refused while reconfigure() changes the playlist
+        self._reloading = False
+
+    @property
+    def _primary(self):
+        return self._outputs[0]
+
+    @property
+    def _vlc(self):
+        return self._primary.vlc
+
+    @property
+    def loop_index(self):
+        return self._primary.loop_index
+
+    @property
+    def playing_index(self):
+        return self._primary.playing_index
+
+    @property
+    def _bank(self):
+        return self._primary.bank
+
+    @property
+    def outputs(self):
+        return list(self._outputs)
+
+    def _live(self):
+        """The VLC instances that are connected and not being restored."""
+        return [output for output in self._outputs if output.up]
+
+    async def _each(self, call, outputs=None):
+        """Run `call(output)` on all live VLC instances at once and return
+        the results. An instance that lost its connection is left to the
+        watchdog and gets None, unless it is the first one."""
+        outputs = self._live() if outputs is None else outputs
+        results = await asyncio.gather(*(call(output) for output in outputs), return_exceptions=True)
+        for i, (output, result) in enumerate(zip(outputs, results)):
+            if isinstance(result, ConnectionError):
+                self._lost(output, result)
+                if output is self._primary:
+                    raise result
+                results[i] = None
+            elif isinstance(result, BaseException):
+                raise result
+        return results
+
+    def _lost(self, output, exc):
+        if output.up:
+            _log.warning('VLC {0}: {1}', output.server, exc)
+            output.set_up(False)
+        output.check.set()
+
+    def _forget_down(self):
+        """Make the watchdog reload the playlist of instances that miss a
+        change while they are down."""
+        for output in self._outputs:
+            if not output.up:
+                output.loop_index = None
+
+    def _playable(self, name):
+        """Library entry of a clip, None if it is missing or the Pi cannot
+        decode it. Only the index is looked at, a clip that is not in it is
+        looked for on disk in a worker thread for the next press."""
+        entry = self.library.lookup(name, disk=False)
+        if entry is None:
+            if self.library.may_exist(name):
+                asyncio.get_running_loop().run_in_executor(None, self.library.lookup, name)
+            _log.warning("No clip {0} in {1}", name, self.library.path)
+            return None
+        reason = mp4info.unsupported(entry.metadata) if self._check_decoder and entry.metadata else None
+        if reason is not None:
+            _log.warning("Not playing {0}: {1}", entry.name, reason)
+            return None
+        return entry
+
+    def _path(self, name):
+        """Path of a movie by file name or by name without extension."""
+        entry = self.library.lookup(name, disk=False)
+        return entry.path if entry is not None else os.path.join(self.library.path, name)
+
+    async def start(self, clips=(), timings=None):
+        """Connect to VLC telnet instance run by supervisord and start the loop.
+        With the clip bank enabled the configured clips, or else `clips`, are
+        preloaded. VLC may still be starting, it is tried every 0.2 s at most
+        for [vlc] connect_timeout seconds while the library is scanned. The
+        seconds each step took go into `timings`.
+        """
+        timings = {} if timings is None else timings
+        self.changed = asyncio.Event()
+        for output in self._outputs:
+            output.check = asyncio.Event()
+        self._default_clips = list(clips)
+        timeout = self.config.getfloat('vlc', 'connect_timeout', fallback=60)
+        (changed, removed), _ = await asyncio.gather(
+            metrics.timed(timings, 'library', asyncio.get_running_loop().run_in_executor(None, self.library.update)),
+            metrics.timed(timings, 'vlc connect', asyncio.gather(
+                *(output.connect(0.02, 0.2, timeout) for output in self._outputs))))
+        _log.info("Library: {0} movies, {1} new or changed, {2} removed", len(self.library), len(changed), len(removed))
+        for output in self._outputs:
+            output.set_up(True)
+        await metrics.timed(timings, 'playlist', self._load(replace=False))
+        self._set_playing('LOOP')
+        _log.info("Loop index {0}", self.loop_index)
+
+    def _configured_clips(self, clips=()):
+        configured = [name.strip() for name in self.config.get('vlc', 'clips', fallback='').split(',')]
+        return [name for name in configured if name] or list(clips)
+
+    async def _load(self, replace):
+        """Enqueue the loop, and the clip bank if enabled, on every instance
+        and play the loop. With `replace` the old items are deleted after
+        that, else the playlists are cleared first."""
+        self._forget_down()
+        await self._each(self._loader(replace))
+        self._prefetch_files()
+
+    def _loader(self, replace):
+        """Return the coroutine function that does what _load() does on one
+        instance."""
+        loop = self.config.get('video_looper', 'loop')
+        if self._use_clip_bank:
+            names = [loop]
+            for clip in self._configured_clips(self._default_clips):
+                if self._playable(clip) is not None:
+                    names += [clip, loop]
+            paths = [self._path(name) for name in names]
+
+            async def load(output):
+                old = await output.load_bank(names, paths, loop, replace)
+                await output.play_loop(True, old)
+        else:
+            path = self._path(loop)
+
+            async def load(output):
+                old = await output.load_loop(path, replace)
+                await output.play_loop(False, old)
+        return load
+
+    def _prefetch_files(self):
+        """Tell the prefetcher about the loop and the button clips."""
+        loop = self.library.lookup(self.config.get('video_looper', 'loop'), disk=False)
+        clips = [self.library.lookup(clip, disk=False) for clip in self._configured_clips(self._default_clips)]
+        self.prefetch.set_files((loop.path, loop.size) if loop is not None else None,
+                                [(entry.path, entry.size) for entry in clips if entry is not None])
+
+    async def load_clip_bank(self, clips):
+        """Clear the playlists and enqueue every clip once, each followed by a
+        copy of the loop, and record their indices. VLC moves on to the loop
+        by itself when a clip ends, and the playlist never changes after this.
+        """
+        self._use_clip_bank = True
+        self._default_clips = list(clips)
+        await self._load(replace=False)
+
+    async def reconfigure(self, config, changed):
+        """Apply a changed config, `changed` is the set of (section, option)
+        that differ. A playing clip is allowed to finish. When the loop, the
+        clips or the directory changed the new movies are enqueued, played
+        and only then the old ones deleted, the playlist is never cleared.
+        """
+        sections = {section for section, option in changed}
+        self.config = config
+        self._min_poll = config.getfloat('vlc', 'min_poll', fallback=0.05)
+        self._max_poll = config.getfloat('vlc', 'max_poll', fallback=2.0)
+        self._check_decoder = config.getboolean('vlc', 'check_decoder', fallback=True)
+        self._watchdog_interval = config.getfloat('vlc', 'watchdog_interval', fallback=1.0)
+        self._reconnect_max = config.getfloat('vlc', 'reconnect_max', fallback=0.5)
+        self._stall_timeout = config.getfloat('vlc', 'stall_timeout', fallback=5.0)
+        if 'prefetch' in sections:
+            self.prefetch.configure(*prefetch_settings(config))
+        reload = ('directory' in sections or ('video_looper', 'loop') in changed
+                  or ('vlc', 'clip_bank') in changed or ('vlc', 'clips') in changed)
+        if not reload:
+            return
+        self._reloading = True
+        try:
+            if self._current is not None:
+                await asyncio.gather(self._current.task, return_exceptions=True)
+            if 'directory' in sections:
+                self.library = create_library(config, mp4info.read_info)
+                await asyncio.get_running_loop().run_in_executor(None, self.library.update)
+            self._use_clip_bank = config.getboolean('vlc', 'clip_bank', fallback=False)
+            await self._load(replace=True)
+            _log.info("Reloaded, loop index {0}", self.loop_index)
+        finally:
+            self._reloading = False
+
+    async def media_changed(self, name, removed):
+        """Update the library and the playlist after the movie file `name`
+        in the directory was written or `removed`. None for `name` means
+        the whole directory has to be scanned again. Only what changed is
+        enqueued or deleted, the playlist is never cleared."""
+        loop = asyncio.get_running_loop()
+        if name is None:
+            written, gone = await loop.run_in_executor(None, self.library.scan)
+            changes = [(item, False) for item in written] + [(item, True) for item in gone]
+        elif self.library.is_movie(name):
+            previous = self.library.get(name)
+            entry = await loop.run_in_executor(None, self.library.refresh, name)
+            changes = [(name, removed)] if entry is not previous else []
+        else:
+            changes = []
+        if not changes:
+            return
+        self.library.save_cache()
+        self._prefetch_files()
+        wanted = set(self._configured_clips(self._default_clips)) if self._use_clip_bank else set()
+        loop_name = self.config.get('video_looper', 'loop')
+        for name, removed in changes:
+            _log.info("Media {0}: {1}", "removed" if removed else "written", name)
+            if name == loop_name:
+                if removed:
+                    _log.warning("The loop {0} was removed, VLC keeps playing it until it ends", name)
+                else:
+                    await self.reconfigure(self.config, {('video_looper', 'loop')})
+                continue
+            clip = os.path.splitext(name)[0]
+            if clip not in wanted:
+                continue
+            self._reloading = True
+            try:
+                if self._current is not None and self._current.movie.filename == clip:
+                    await asyncio.gather(self._current.task, return_exceptions=True)
+                self._forget_down()
+                await self._each(lambda output: output.unbank(clip))
+                if not removed and self._playable(clip) is not None:
+                    paths = [self._path(clip), self._path(loop_name)]
+                    await self._each(lambda output: output.bank_clip(clip, paths))
+            finally:
+                self._reloading = False
+
+    def _set_playing(self, filename):
+        self.playing_file = filename
+        CLIP_PLAYING.set(0 if filename == 'LOOP' else 1)
+        self.changed.set()
+
+    @property
+    def current(self):
+        """PlayHandle of the clip that is playing, None in the loop."""
+        return self._current
+
+    def play(self, movie, preempt=False, **kwargs):
+        """Play the provided movied file, if we are in the loop. Returns right
+        away with a PlayHandle, or None if a clip is already playing or the
+        clip cannot be played. With `preempt` a playing clip is replaced
+        instead."""
+        previous = self._current
+        if self._reloading or not self._primary.up or (previous is not None and not preempt):
+            return None
+        entry = self._playable(movie.filename)
+        if entry is None:
+            return None
+        if previous is not None:
+            previous.preempted = True
+            previous.cancel()
+            CLIPS_PREEMPTED.inc()
+        handle = PlayHandle(movie)
+        handle.requested = asyncio.get_running_loop().time()
+        handle.path = entry.path
+        self.prefetch.started(entry.path)
+        # the probed length of the file, the EXTINF one of a playlist is rounded
+        handle.duration = entry.duration or movie.duration
+        handle.starting = True
+        handle.task = asyncio.create_task(self._play(handle, previous))
+        self._current = handle
+        return handle
+
+    async def _trigger(self, handle, outputs):
+        """Start the clip on every instance at once and record when each of
+        them confirmed it. `started` stays None if none of them did."""
+        clip = handle.movie.filename
+        confirmed = await self._each(lambda output: output.trigger(clip, handle.path), outputs)
+        times = [when for when in confirmed if when is not None]
+        if not times:
+            return
+        handle.started = min(times)
+        handle.skew = max(times) - handle.started
+        if len(self._outputs) > 1:
+            TRIGGER_SKEW_SECONDS.observe(handle.skew)
+            for output, when in zip(outputs, confirmed):
+                if when is not None:
+                    OUTPUT_LAG_SECONDS.labels(output.server).set(when - handle.started)
+
+    async def _play(self, handle, previous=None):
+        loop = asyncio.get_running_loop()
+        movie = handle.movie
+        banked = movie.filename in self._bank
+        outputs = None
+        try:
+            try:
+                if previous is not None:
+                    # let the preempted clip finish its bookkeeping first, what
+                    # it did not get to delete is deleted by this one
+                    await asyncio.wait([previous.task])
+                    handle.stale, previous.stale = previous.stale + [previous], []
+                if self._returning is not None:
+                    # its repeat on must not come after our repeat off
+                    await asyncio.wait([self._returning.task])
+                if not handle.cancelled:
+                    outputs = self._live()
+                    await self._trigger(handle, outputs)
+                if handle.started is not None:
+                    loop_name = self.config.get('video_looper', 'loop')
+                    loop_path = self._path(loop_name)
+                    indices = await self._each(
+                        lambda output: output.clip_index(movie.filename, loop_name, loop_path), outputs)
+                    handle.indices = dict(zip(outputs, indices))
+                    handle.index = indices[0]
+            finally:
+                handle.starting = False
+            if handle.cancelled:
+                raise asyncio.CancelledError()
+            if handle.started is None:
+                _log.warning('No VLC instance is up to play {0}', movie.filename)
+                return
+            if handle.duration:
+                handle.deadline = handle.started + handle.duration
+            PRESS_TO_PLAY_SECONDS.observe(handle.started - handle.requested)
+            CLIPS.labels(movie.filename).inc()
+            _log.debug("New index {0}", handle.index)
+            if len(self._outputs) > 1:
+                _log.debug("Started on {0} outputs within {1:.1f} ms", len(outputs), handle.skew * 1000)
+            for output, index in handle.indices.items():
+                output.playing_index = index
+            self._set_playing(movie.filename)
+            if handle.stale:
+                # delete the preempted clips now that they are no longer
+                # playing, the next clip does it if this one is preempted first
+                stale = self._unbanked(handle.stale)
+                await self._each(lambda output: self._delete(output, stale))
+                handle.stale = []
+            await self._wait_for_end(handle)
+            handle.ended = loop.time()
+            if handle.deadline is not None:
+                END_OVERRUN_SECONDS.observe(max(0.0, handle.ended - handle.deadline))
+        except ConnectionError as exc:
+            # the watchdog brings VLC back to the loop
+            self._lost(self._primary, exc)
+        finally:
+            handle.stopped = loop.time()
+            self.prefetch.finished(handle.path)
+            if handle.preempted:
+                # the next clip takes over from here
+                return
+            self._current = None
+            self._returning = handle
+            self._set_playing('LOOP')
+            outputs = [output for output in outputs or self._live() if output.up]
+            # preempted clips are still there if this one never started
+            stale, handle.stale = self._unbanked(handle.stale + [handle]), []
+            try:
+                if banked:
+                    await self._each(lambda output: output.back_to_loop(
+                        handle.indices.get(output), 0 if output is self._primary else self._max_poll,
+                        self._min_poll), outputs)
+                if handle.ended is None and not banked and any(clip.indices for clip in stale):
+                    # cut short, VLC still plays a clip that is deleted
+                    await self._each(lambda output: output.play_loop(
+                        self._use_clip_bank, self._indices(output, stale)), outputs)
+                else:
+                    _log.debug("Delete index {0}", handle.index)
+                    await self._each(lambda output: self._delete(output, stale), outputs)
+            except ConnectionError:
+                pass
+            self._returning = None
+            if handle.ended is not None:
+                LOOP_GAP_SECONDS.observe(loop.time() - handle.ended)
+
+    def _unbanked(self, handles):
+        """The clips of `handles` that were added to the playlist to play
+        them, not taken from the clip bank."""
+        return [handle for handle in handles if handle.movie.filename not in self._bank]
+
+    @staticmethod
+    def _indices(output, handles):
+        return [handle.indices[output] for handle in handles if handle.indices.get(output) is not None]
+
+    async def _delete(self, output, handles):
+        """Delete the playlist items of clips on one instance."""
+        indices = self._indices(output, handles)
+        if indices:
+            async with output.vlc.batch() as batch:
+                for index in sorted(indices):
+                    batch.delete(index)
+
+    async def _wait_for_end(self, handle):
+        """Wait until VLC moves on from the clip. The expected end is the
+        length of the file or computed from get_length/get_time, polling
+        gets tighter as it comes closer."""
+        loop = asyncio.get_running_loop()
+        primary = self._primary
+        while True:
+            if handle.deadline is None or (not handle.duration and handle.deadline - loop.time() > 2 * self._max_poll):
+                async with primary.vlc.batch() as batch:
+                    index = batch.playing_index()
+                    length = batch.get_length()
+                    position = batch.get_time()
+                index = index.value
+                if length.value:
+                    handle.deadline = loop.time() + length.value - (position.value or 0)
+            else:
+                # close to the end only the current item matters
+                index = await primary.vlc.playing_index()
+            primary.playing_index = index
+            if index != handle.index:
+                return
+            if handle.duration:
+                remaining = handle.deadline - loop.time()
+            elif handle.deadline is not None:
+                # get_time has whole seconds, the clip may end a second early
+                remaining = handle.deadline - 1 - loop.time()
+            else:
+                # not opened yet
+                remaining = self._max_poll
+            await asyncio.sleep(min(max(remaining / 2, self._min_poll), self._max_poll))
 
     def is_playing(self):
         """Return true if the video player is running, false otherwise."""
         return True
 
-    def stop(self):
-        self._vlc.stop()
+    async def stop(self):
+        if self._current is not None:
+            self._current.cancel()
+        try:
+            await self._each(lambda output: output.vlc.stop())
+        except ConnectionError:
+            pass
 
-    def ensure_loop(self):
-        has_loop=self._vlc.search(self.config.get('video_looper', 'loop'))
-        # Make sure we have the loop after this
-        if not has_loop:
-            print('No loop exists')
-            self._vlc.enqueue(self.config.get('directory', 'path') + '/' + self.config.get('video_looper', 'loop'))
-            self.loop_index = self._vlc.search(self.config.get('video_looper', 'loop'))
-        else:
-            print('Loop exists at:' + has_loop)
+    async def watch(self):
+        """Watch every VLC instance until cancelled, see _watch_output()."""
+        await asyncio.gather(*(self._watch_output(output) for output in self._outputs))
+
+    async def _watch_output(self, output):
+        """Probe a VLC instance every watchdog_interval seconds. A lost
+        connection, a restarted VLC and playback that stopped or did not
+        move for stall_timeout seconds are recovered from. With an interval
+        of 0 nothing is probed, lost connections are still recovered from."""
+        loop = asyncio.get_running_loop()
+        last = None
+        stalled_since = None
+        while True:
+            try:
+                await asyncio.wait_for(output.check.wait(), self._watchdog_interval or None)
+            except asyncio.TimeoutError:
+                pass
+            output.check.clear()
+            reason = None
+            if not output.vlc.connected:
+                reason = 'connection'
+            elif not output.up:
+                reason = 'restore'
+            elif self._watchdog_interval > 0 and not self._reloading:
+                try:
+                    index, position, length, playing = await output.probe()
+                except ConnectionError as exc:
+                    self._lost(output, exc)
+                    reason = 'connection'
+                else:
+                    if not playing:
+                        moving = False
+                    elif last is None or (length or 0) < self._stall_timeout:
+                        # a loop shorter than the timeout may show the same whole second
+                        moving = True
+                    else:
+                        moving = (index, position) != last
+                    last = (index, position)
+                    if moving:
+                        stalled_since = None
+                    elif stalled_since is None:
+                        stalled_since = loop.time()
+                    elif loop.time() - stalled_since >= self._stall_timeout:
+                        reason = 'stalled'
+            if reason is not None:
+                await self._recover(output, reason)
+                last = stalled_since = None
+
+    async def _recover(self, output, reason):
+        """Reconnect with a backoff doubling up to reconnect_max seconds and
+        bring the playlist back without clearing it: after a lost
+        connection VLC usually still has it, after a restart the loop and
+        the clip bank are enqueued again. A failure is counted once, not
+        on every try to recover from it."""
+        loop = asyncio.get_running_loop()
+        if output.down_since is None:
+            output.down_since = loop.time()
+            VLC_FAILURES.labels(output.server, reason).inc()
+            _log.warning('VLC {0}: {1}, recovering', output.server, reason)
+        output.set_up(False)
+        if not output.vlc.connected:
+            await output.connect(0.05, self._reconnect_max)
+        connected = loop.time()
+        try:
+            await output.vlc.playlist()
+            if output is self._primary and self._current is not None:
+                # give up the clip, its task takes the other instances back to the loop
+                self._current.cancel()
+            if output.loop_index is not None and output.intact():
+                await output.resume(self._use_clip_bank, restart=reason == 'stalled')
+            else:
+                await self._loader(replace=True)(output)
+        except ConnectionError as exc:
+            _log.error('VLC {0}: {1}', output.server, exc)
+            # try again after a while, also when the watchdog does not probe
+            await asyncio.sleep(self._reconnect_max)
+            output.check.set()
+            return
+        output.set_up(True)
+        now = loop.time()
+        noticed, output.down_since = output.down_since, None
+        VLC_RECOVERY_SECONDS.observe(now - noticed)
+        VLC_RESTORE_SECONDS.observe(now - connected)
+        _log.info('VLC {0} recovered in {1:.0f} ms, {2:.0f} ms after it was back', output.server, (now - noticed) * 1000, (now - connected) * 1000)
+
+    async def ensure_loop(self):
+        loop = self.config.get('video_looper', 'loop')
+        path = self._path(loop)
+        await self._each(lambda output: output.ensure_loop(loop, path))
 
     @staticmethod
     def can_loop_count():
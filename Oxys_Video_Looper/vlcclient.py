@@ -16,6 +16,9 @@
 
     Replace --intf with --extraintf to start telnet and the regular GUI
 
+    A local socket works as well, connect to it with ``unix:/path``:
+    $ vlc --intf rc --rc-unix /tmp/vlc.sock --rc-fake-tty
+
     More information about the telnet interface:
     http://wiki.videolan.org/Documentation:Streaming_HowTo/VLM
 
@@ -125,104 +128,427 @@
 
 from __future__ import print_function
 
+import asyncio
 import sys
 import inspect
-import telnetlib
+import os
 import re
+import socket
+import time
+from collections import namedtuple
+from urllib.parse import unquote
+
+from . import log
 
 DEFAULT_PORT = 4212
 
+PROMPT = b"> "
+PASSWORD_PROMPT = b"Password: "
+
+_log = log.get('vlcclient')
+
+_match_version = re.compile(rb"VLC media player ([\d.]+)")
+# Telnet option negotiation (IAC WILL/WONT/DO/DONT <option>) sent around the
+# password prompt by VLC's telnet interface.
+_match_telnet_option = re.compile(rb"\xff[\xfb-\xfe].")
+# One node of the `playlist` tree, e.g. "|   *5 - loop.mp4 (00:00:30) [played 2 times]"
+_match_playlist_item = re.compile(
+    r"^\|( *)(\*?)(\d+) - (.*?)(?: \(([\d:]+|--:--:--)\))?(?: \[played \d+ times?\])?$")
+_match_new_input = re.compile(rb"\( new input: (.*) \)")
+
+
+def parse_address(server, port=DEFAULT_PORT):
+    """
+    Turn a server spec into a (socket family, address) tuple.
+
+    Accepts ``unix:/path/to/socket``, ``host:port`` or a bare ``host``
+    (which uses `port`).
+    """
+    if server.startswith("unix:"):
+        return socket.AF_UNIX, server[len("unix:"):]
+    host, sep, host_port = server.rpartition(":")
+    if sep and host_port.isdigit():
+        return socket.AF_INET, (host.strip("[]"), int(host_port))
+    return socket.AF_INET, (server, int(port))
+
+
+class ReplyBuffer(object):
+    """
+    Receive buffer for the VLC telnet (or rc) interface.
+
+    Received data lands in one reusable bytearray and replies are framed on
+    the ``> `` prompt VLC prints after every command, so reading a reply
+    costs a single copy of its payload. This class does no I/O, `Transport`
+    and `AsyncTransport` feed it from a socket or an asyncio stream.
+    """
+
+    def __init__(self, bufsize=16384):
+        self._buf = bytearray(bufsize)
+        self._start = 0  # first byte not yet handed out
+        self._end = 0    # end of received data
+        self._scan = 0   # bytes after _start already searched for a marker
+
+    def reset(self):
+        self._start = self._end = self._scan = 0
+
+    def _room(self, size=0):
+        """Make room at the end of the buffer, returns the free space."""
+        if self._end + size >= len(self._buf):
+            pending = self._end - self._start
+            if self._start:
+                self._buf[:pending] = self._buf[self._start:self._end]
+                self._start, self._end = 0, pending
+            if self._end + size >= len(self._buf):
+                self._buf.extend(bytes(max(len(self._buf), size)))
+        return len(self._buf) - self._end
+
+    def recv_from(self, sock):
+        """Receive straight into the buffer from a blocking socket."""
+        self._room()
+        with memoryview(self._buf) as view:
+            received = sock.recv_into(view[self._end:])
+        if not received:
+            raise EOFError("connection closed by VLC")
+        self._end += received
+
+    def feed(self, data):
+        """Append `data` read from a stream."""
+        if not data:
+            raise EOFError("connection closed by VLC")
+        self._room(len(data))
+        self._buf[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def _take(self, stop, consumed):
+        """Copy out buf[start:stop] and drop everything up to `consumed`."""
+        with memoryview(self._buf) as view:
+            data = bytes(view[self._start:stop])
+        if consumed == self._end:
+            self._start = self._end = 0
+        else:
+            self._start = consumed
+        self._scan = 0
+        return data
+
+    def _find_prompt(self, scan):
+        """Offset of a prompt at the start of a line at/after `scan`, or -1."""
+        buf = self._buf
+        while True:
+            idx = buf.find(PROMPT, scan, self._end)
+            if idx < 0 or idx == self._start or buf[idx - 1] == 0x0a:
+                return idx
+            scan = idx + 1
+
+    def _find(self, marker):
+        if marker == PROMPT:
+            return self._find_prompt(self._start + self._scan)
+        return self._buf.find(marker, self._start + self._scan, self._end)
+
+    def next_reply(self):
+        """
+        The reply to one command: everything up to the next prompt, without
+        the trailing line break. None if it has not been received completely.
+        """
+        idx = self._find_prompt(self._start + self._scan)
+        if idx < 0:
+            self._scan = max(0, self._end - self._start - len(PROMPT))
+            return None
+        stop = idx
+        while stop > self._start and self._buf[stop - 1] in b"\r\n":
+            stop -= 1
+        return self._take(stop, idx + len(PROMPT))
+
+    def next_match(self, markers):
+        """
+        Look for the first of `markers`. Returns the index of the marker and
+        the data before it, with telnet negotiation removed, or None.
+        """
+        found = []
+        for i, marker in enumerate(markers):
+            idx = self._find(marker)
+            if idx >= 0:
+                found.append((idx, i))
+        if not found:
+            longest = max(len(marker) for marker in markers)
+            self._scan = max(0, self._end - self._start - longest)
+            return None
+        idx, i = min(found)
+        data = self._take(idx, idx + len(markers[i]))
+        return i, _match_telnet_option.sub(b"", data)
+
+
+class Transport(object):
+    """
+    Blocking socket connection to the VLC telnet (or rc) interface.
+    """
+
+    def __init__(self, family, address, timeout=None):
+        self.family = family
+        self.address = address
+        self.timeout = timeout
+        self.sock = None
+        self.buffer = ReplyBuffer()
+
+    def open(self):
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self.timeout)
+            sock.connect(self.address)
+            if self.family != socket.AF_UNIX:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+        self.buffer.reset()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def read_reply(self):
+        """Read the reply to one command."""
+        reply = self.buffer.next_reply()
+        while reply is None:
+            self.buffer.recv_from(self.sock)
+            reply = self.buffer.next_reply()
+        return reply
+
+    def expect(self, markers):
+        """Read until one of `markers` shows up, see `ReplyBuffer.next_match`."""
+        match = self.buffer.next_match(markers)
+        while match is None:
+            self.buffer.recv_from(self.sock)
+            match = self.buffer.next_match(markers)
+        return match
+
+
+class AsyncTransport(object):
+    """
+    Connection to the VLC telnet (or rc) interface on asyncio streams.
+    """
+
+    def __init__(self, family, address, timeout=None):
+        self.family = family
+        self.address = address
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.buffer = ReplyBuffer()
+
+    async def open(self):
+        if self.family == socket.AF_UNIX:
+            connection = asyncio.open_unix_connection(self.address)
+        else:
+            connection = asyncio.open_connection(*self.address)
+        self.reader, self.writer = await asyncio.wait_for(connection, self.timeout)
+        sock = self.writer.get_extra_info("socket")
+        if self.family != socket.AF_UNIX and sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer.reset()
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+            self.reader = self.writer = None
+
+    async def send(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def _receive(self):
+        self.buffer.feed(await asyncio.wait_for(self.reader.read(65536), self.timeout))
+
+    async def read_reply(self):
+        """Read the reply to one command."""
+        reply = self.buffer.next_reply()
+        while reply is None:
+            await self._receive()
+            reply = self.buffer.next_reply()
+        return reply
+
+    async def expect(self, markers):
+        """Read until one of `markers` shows up, see `ReplyBuffer.next_match`."""
+        match = self.buffer.next_match(markers)
+        while match is None:
+            await self._receive()
+            match = self.buffer.next_match(markers)
+        return match
+
 
 class VLCClient(object):
     """
     Connection to a running VLC instance with telnet interface.
+
+    `server` is a host name, ``host:port`` or ``unix:/path/to/socket``.
+    If `observer` is given it is called with every command line and the
+    seconds it took until its reply arrived.
     """
 
-    def __init__(self, server, port=DEFAULT_PORT, password="admin", timeout=5):
+    def __init__(self, server, port=DEFAULT_PORT, password="admin", timeout=5, observer=None):
         self.server = server
         self.port = port
         self.password = password
         self.timeout = timeout
+        self.observer = observer
 
-        self.telnet = None
+        self._transport = None
         self.server_version = None
         self.server_version_tuple = ()
-        self.match_playing_index = re.compile('\|  \*(\d+)')
+        self.playlist_mirror = PlaylistMirror()
+
+    @property
+    def connected(self):
+        return self._transport is not None
+
+    def _lost(self, exc):
+        """Drop a broken connection, connect() can be called again."""
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+        return ConnectionLost("lost connection to VLC at {0}: {1}".format(self.server, exc or "not connected"))
 
     def connect(self):
         """
-        Connect to VLC and login
+        Connect to VLC and login. After a `ConnectionLost` this can be
+        called again, the playlist mirror starts over.
         """
-        assert self.telnet is None, "connect() called twice"
-
-        self.telnet = telnetlib.Telnet()
-        self.telnet.open(self.server, self.port, self.timeout)
-
-        # Parse version
-        result = self.telnet.expect([
-            r"VLC media player ([\d.]+)".encode("utf-8"),
-        ])
-        self.server_version = result[1].group(1)
-        self.server_version_tuple = self.server_version.decode("utf-8").split('.')
-
-        # Login
-        self.telnet.read_until("Password: ".encode("utf-8"))
-        self.telnet.write(self.password.encode("utf-8"))
-        self.telnet.write("\n".encode("utf-8"))
-
-        # Password correct?
-        result = self.telnet.expect([
-            "Password: ".encode("utf-8"),
-            ">".encode("utf-8")
-        ])
-        if "Password".encode("utf-8") in result[2]:
-            raise WrongPasswordError()
+        assert self._transport is None, "connect() called twice"
+
+        family, address = parse_address(self.server, self.port)
+        transport = Transport(family, address, self.timeout)
+        transport.open()
+        try:
+            # The telnet interface asks for a password, a local rc socket
+            # goes straight to the prompt.
+            which, banner = transport.expect([PASSWORD_PROMPT, PROMPT])
+            version = _match_version.search(banner)
+            if version:
+                self.server_version = version.group(1)
+                self.server_version_tuple = self.server_version.decode("utf-8").split('.')
+
+            if which == 0:
+                transport.send(self.password.encode("utf-8") + b"\n")
+                # Password correct?
+                which, _ = transport.expect([PASSWORD_PROMPT, PROMPT])
+                if which == 0:
+                    raise WrongPasswordError()
+        except BaseException:
+            transport.close()
+            raise
+        self._transport = transport
+        self.playlist_mirror = PlaylistMirror()
 
     def disconnect(self):
         """
         Disconnect and close connection
         """
-        self.telnet.close()
-        self.telnet = None
+        self._transport.close()
+        self._transport = None
 
     def _send_command(self, line):
         """
         Sends a command to VLC and returns the text reply.
         This command may block.
         """
-        print(line)
-        self.telnet.write((line + "\n").encode("utf-8"))
-        return self.telnet.read_until(">".encode("utf-8"))[1:-3]
-
+        _log.debug("vlc> {0}", line)
+        if self._transport is None:
+            raise self._lost(None)
+        started = time.monotonic()
+        try:
+            self._transport.send(line.encode("utf-8") + b"\n")
+            reply = self._transport.read_reply()
+        except (OSError, EOFError) as exc:
+            raise self._lost(exc) from exc
+        if self.observer is not None:
+            self.observer(line, time.monotonic() - started)
+        return reply
+
+
+    def _send_commands(self, lines):
+        """
+        Sends several commands in one write and returns their replies in
+        order. VLC answers each line with its own prompt.
+        """
+        for line in lines:
+            _log.debug("vlc> {0}", line)
+        if self._transport is None:
+            raise self._lost(None)
+        started = time.monotonic()
+        replies = []
+        try:
+            self._transport.send("".join(line + "\n" for line in lines).encode("utf-8"))
+            for line in lines:
+                replies.append(self._transport.read_reply())
+                if self.observer is not None:
+                    self.observer(line, time.monotonic() - started)
+        except (OSError, EOFError) as exc:
+            raise self._lost(exc) from exc
+        return replies
+
+    def _execute(self, line, parse=None):
+        """Run one command and return its (parsed) reply."""
+        reply = self._send_command(line)
+        return reply if parse is None else parse(reply)
+
+    def _run_batch(self, results):
+        """Send the commands of a batch and fill in their results."""
+        if results:
+            _set_replies(results, self._send_commands([result.command for result in results]))
+
+    def batch(self):
+        """
+        Start a pipeline of commands that are sent together, see `Batch`.
+        """
+        return Batch(self)
 
     def _parse_lines(self, input):
         return str(input, 'utf-8').split('\r\n')
 
+    def _parse_status(self, reply):
+        """Index of the item `status` reports as the current input."""
+        match = _match_new_input.search(reply)
+        if match is None:
+            return None
+        name = os.path.basename(unquote(str(match.group(1), 'utf-8')))
+        return self.playlist_mirror.set_current(name)
+
     #
     # Commands
     #
     def help(self):
         """Returns the full command reference"""
-        return self._send_command("help")
+        return self._execute("help")
 
     def status(self):
         """current playlist status"""
-        return self._send_command("status")
+        return self._execute("status")
 
     def info(self):
         """information about the current stream"""
-        return self._send_command("info")
+        return self._execute("info")
 
     def set_fullscreen(self, value):
         """set fullscreen on or off"""
         assert type(value) is bool
-        return self._send_command("fullscreen {}".format("on" if value else "off"))
+        return self._execute("fullscreen {}".format("on" if value else "off"))
 
     def raw(self, *args):
         """
         Send a raw telnet command
         """
-        return self._send_command(" ".join(args))
+        return self._execute(" ".join(args))
 
     #
     # Playlist
@@ -231,91 +557,129 @@ class VLCClient(object):
         """
         Add a file to the playlist and play it.
         This command always succeeds.
+
+        VLC does not report the index of the new item, the playlist mirror
+        picks it up on its next refresh (batch the add with `playlist()`).
         """
-        return self._send_command('add {0}'.format(filename))
+        def parse(reply):
+            self.playlist_mirror.expect(filename)
+            return reply
+        return self._execute('add {0}'.format(filename), parse)
 
     def enqueue(self, filename):
         """
         Add a file to the playlist. This command always succeeds.
         """
-        return self._send_command("enqueue {0}".format(filename))
+        def parse(reply):
+            self.playlist_mirror.expect(filename)
+            return reply
+        return self._execute("enqueue {0}".format(filename), parse)
 
     def delete(self, index):
-
-        return self._send_command("delete {0}".format(index))
+        """Delete item `index` from the playlist"""
+        def parse(reply):
+            self.playlist_mirror.remove(int(index))
+            return reply
+        return self._execute("delete {0}".format(index), parse)
 
     def search(self, query):
-        result=str(self._send_command("search {0}".format(query)), 'utf-8')
-        # reset search
-        self._send_command("search")
-        pattern = re.compile('(\d+) - ' + query)
-        index = pattern.search(result)
-        return None if index == None else index.group(1)
+        """
+        Index of the playlist item named `query` (with or without its
+        extension), or None. Answered from the playlist mirror, which is only
+        refreshed from VLC when it has been invalidated.
+        """
+        if not self.playlist_mirror.valid:
+            self.playlist()
+        return self.playlist_mirror.index_of(query)
 
     def seek(self, second):
         """
         Jump to a position at the current stream if supported.
         """
-        return self._send_command("seek {0}".format(second))
+        return self._execute("seek {0}".format(second))
 
     def goto(self, index):
-        return self._send_command("goto {0}".format(index))
+        """Play item `index` of the playlist"""
+        def parse(reply):
+            self.playlist_mirror.current = int(index)
+            return reply
+        return self._execute("goto {0}".format(index), parse)
 
     def play(self):
         """Start/Continue the current stream"""
-        return self._send_command("play")
+        return self._execute("play")
 
 
     def playing_index(self):
-        """Start/Continue the current stream"""
-        result=str(self._send_command("playlist"), 'utf-8')
-        index=self.match_playing_index.search(result)
-        return None if index == None else index.group(1)
+        """Index of the playlist item that is currently playing"""
+        return self._execute("status", self._parse_status)
 
     def playlist(self):
-        """Start/Continue the current stream"""
-        result=self._send_command("playlist")
-        return self._parse_lines(result)
+        """Lines of the current playlist, also refreshes the playlist mirror"""
+        def parse(reply):
+            self.playlist_mirror.load(reply)
+            return self._parse_lines(reply)
+        return self._execute("playlist", parse)
+
+    def get_time(self):
+        """Seconds elapsed since the beginning of the current stream"""
+        return self._execute("get_time", _parse_int)
+
+    def get_length(self):
+        """Length of the current stream in seconds"""
+        return self._execute("get_length", _parse_int)
+
+    def is_playing(self):
+        """True if a stream plays"""
+        return self._execute("is_playing", _parse_bool)
 
     def pause(self):
         """Pause playing"""
-        return self._send_command("pause")
+        return self._execute("pause")
 
     def stop(self):
         """Stop stream"""
-        return self._send_command("stop")
+        return self._execute("stop")
 
     def rewind(self):
         """Rewind stream"""
-        return self._send_command("rewind")
+        return self._execute("rewind")
 
     def next(self):
         """Play next item in playlist"""
-        return self._send_command("next")
+        return self._execute("next")
 
     def prev(self):
         """Play previous item in playlist"""
-        return self._send_command("prev")
+        return self._execute("prev")
 
     def clear(self):
         """Clear all items in playlist"""
-        return self._send_command("clear")
+        def parse(reply):
+            self.playlist_mirror.clear()
+            return reply
+        return self._execute("clear", parse)
 
     def loop(self):
         """Toggle loop"""
-        return self._send_command("loop on")
+        return self._execute("loop on")
 
     def unloop(self):
         """Toggle loop"""
-        return self._send_command("loop off")
+        return self._execute("loop off")
 
     def repeat(self):
         """Toggle repeat of a single item"""
-        return self._send_command("repeat")
+        return self._execute("repeat")
+
+    def set_repeat(self, value):
+        """set repeat of the current item on or off"""
+        assert type(value) is bool
+        return self._execute("repeat {}".format("on" if value else "off"))
 
     def random(self):
         """Toggle random playback"""
-        return self._send_command("random")
+        return self._execute("random")
 
     #
     # Volume
@@ -323,17 +687,400 @@ class VLCClient(object):
     def volume(self, vol=None):
         """Get the current volume or set it"""
         if vol:
-            return self._send_command("volume {0}".format(vol))
+            return self._execute("volume {0}".format(vol))
         else:
-            return self._send_command("volume").strip()
+            return self._execute("volume", bytes.strip)
 
     def volup(self, steps=1):
         """Increase the volume"""
-        return self._send_command("volup {0}".format(steps))
+        return self._execute("volup {0}".format(steps))
 
     def voldown(self, steps=1):
         """Decrease the volume"""
-        return self._send_command("voldown {0}".format(steps))
+        return self._execute("voldown {0}".format(steps))
+
+
+PlaylistItem = namedtuple("PlaylistItem", "index name duration")
+
+
+def _parse_duration(text):
+    """Seconds of a ``hh:mm:ss`` duration, None if VLC does not know it."""
+    if not text or not text[0].isdigit():
+        return None
+    seconds = 0
+    for part in text.split(":"):
+        seconds = seconds * 60 + int(part)
+    return seconds
+
+
+class PlaylistMirror(object):
+    """
+    Client-side copy of the VLC playlist.
+
+    Holds the index -> `PlaylistItem` map, a name -> indices map and the
+    current item, and is kept up to date from the replies to the playlist
+    commands sent through the client. Items are looked up both by the name
+    VLC shows and by the file name they were added with, with or without
+    extension. A file can be in the playlist more than once, `status` only
+    names the current input, so which of them plays is told from the
+    current index.
+    """
+
+    def __init__(self):
+        self.items = {}
+        self.current = None
+        self.valid = False
+        self._by_name = {}   # name -> indices, ascending
+        self._aliases = {}   # index -> file name it was added with
+        self._expected = []  # file names added since the last refresh
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, index):
+        return index in self.items
+
+    def _index_name(self, name, index):
+        for key in (name, os.path.splitext(name)[0]):
+            indices = self._by_name.setdefault(key, [])
+            if not indices or indices[-1] != index:
+                indices.append(index)
+
+    def _reindex(self):
+        self._by_name = {}
+        for index in sorted(self.items):
+            self._index_name(self.items[index].name, index)
+            if index in self._aliases:
+                self._index_name(self._aliases[index], index)
+
+    def load(self, reply):
+        """Replace the mirror with the output of the `playlist` command."""
+        items = {}
+        current = None
+        root_depth = None
+        for line in str(reply, 'utf-8').split('\r\n'):
+            match = _match_playlist_item.match(line)
+            if match is None:
+                continue
+            depth = len(match.group(1))
+            if root_depth is None:
+                # the "Playlist" node, the items are its children
+                root_depth = depth
+                continue
+            if depth <= root_depth:
+                # next top level node ("Media Library")
+                break
+            index = int(match.group(3))
+            items[index] = PlaylistItem(index, match.group(4), _parse_duration(match.group(5)))
+            if match.group(2):
+                current = index
+
+        # New items match the files added since the last refresh by the
+        # file name VLC shows for them. Those shown under a title of their
+        # own match the files left in order, unless an add failed and
+        # there are fewer of them than files.
+        if self._expected:
+            expected = list(self._expected)
+            titled = []
+            for index in sorted(items):
+                if index in self.items:
+                    continue
+                name = items[index].name
+                for i, filename in enumerate(expected):
+                    if name in (filename, os.path.splitext(filename)[0]):
+                        del expected[i]
+                        break
+                else:
+                    titled.append(index)
+            if expected and len(titled) >= len(expected):
+                for index, name in zip(titled[-len(expected):], expected):
+                    self._aliases[index] = name
+            self._expected = []
+        self._aliases = {index: name for index, name in self._aliases.items() if index in items}
+
+        self.items = items
+        self.current = current
+        self.valid = True
+        self._reindex()
+
+    def expect(self, filename):
+        """Note that `filename` was added, its index is known after a refresh."""
+        self._expected.append(os.path.basename(filename))
+        self.valid = False
+
+    def remove(self, index):
+        if self.items.pop(index, None) is not None:
+            self._aliases.pop(index, None)
+            if self.current == index:
+                self.current = None
+            self._reindex()
+
+    def clear(self):
+        self.items = {}
+        self.current = None
+        self.valid = True
+        self._by_name = {}
+        self._aliases = {}
+        self._expected = []
+
+    def invalidate(self):
+        self.valid = False
+
+    def index_of(self, name):
+        """Index of the item called `name`, or None. Of several items with
+        that name the current one, otherwise the one added last."""
+        indices = self._by_name.get(name)
+        if not indices:
+            return None
+        return self.current if self.current in indices else indices[-1]
+
+    def set_current(self, name):
+        """Mark the item called `name`, the input `status` reports, as
+        current and return its index. Of several items with that name the
+        current one stays current, otherwise VLC went on to the first of
+        them after the current item, or wrapped around to the first one."""
+        indices = self._by_name.get(name)
+        if not indices:
+            # something we do not know about, refresh on next lookup
+            self.valid = False
+            self.current = None
+        elif self.current not in indices:
+            following = [index for index in indices if self.current is not None and index > self.current]
+            self.current = following[0] if following else indices[0]
+        return self.current
+
+
+def _set_replies(results, replies):
+    """Fill in batch results, all of them even if a parser fails."""
+    errors = []
+    for result, reply in zip(results, replies):
+        try:
+            result.set_reply(reply)
+        except Exception as exc:
+            errors.append(exc)
+    if errors:
+        raise errors[0]
+
+
+def _parse_int(reply):
+    reply = reply.strip()
+    return int(reply) if reply.lstrip(b"-").isdigit() else None
+
+
+def _parse_bool(reply):
+    return reply.strip() == b"1"
+
+
+class CommandResult(object):
+    """
+    Reply to one command of a `Batch`. `raw` holds the reply bytes and
+    `value` the reply as the matching client method would return it.
+    Both are None until the batch has been sent.
+    """
+
+    __slots__ = ("command", "raw", "value", "_parse")
+
+    def __init__(self, command, parse=None):
+        self.command = command
+        self.raw = None
+        self.value = None
+        self._parse = parse
+
+    def set_reply(self, reply):
+        self.raw = reply
+        self.value = reply if self._parse is None else self._parse(reply)
+
+    def __repr__(self):
+        return "CommandResult({0!r}, {1!r})".format(self.command, self.value)
+
+
+class Batch(object):
+    """
+    Pipeline of commands written to VLC in a single send. The client's
+    command methods can be called on the batch; they queue the command and
+    return a `CommandResult` that is filled in when the batch is sent::
+
+        with vlc.batch() as batch:
+            batch.goto(4)
+            length = batch.get_length()
+        print(length.value)
+
+    The replies are read back in order, so the whole batch costs about one
+    round trip instead of one per command.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._pending = []
+        self.results = []
+
+    def _execute(self, line, parse=None):
+        result = CommandResult(line, parse)
+        self._pending.append(result)
+        self.results.append(result)
+        return result
+
+    def __getattr__(self, name):
+        # Reuse the client's command methods, queuing instead of sending.
+        attr = getattr(type(self._client), name, None)
+        if inspect.isfunction(attr):
+            return attr.__get__(self)
+        return getattr(self._client, name)
+
+    def search(self, query):
+        """
+        Queue a refresh of the playlist mirror. The result's value is the
+        index of the item named `query` once the batch was sent, items added
+        earlier in the same batch are found.
+        """
+        def parse(reply):
+            mirror = self._client.playlist_mirror
+            mirror.load(reply)
+            return mirror.index_of(query)
+        return self._execute("playlist", parse)
+
+    def send(self):
+        """
+        Send the queued commands and wait for all of their replies. For an
+        `AsyncVLCClient` this returns a coroutine.
+        """
+        pending, self._pending = self._pending, []
+        return self._client._run_batch(pending)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.send()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            await self.send()
+
+
+class AsyncVLCClient(VLCClient):
+    """
+    Connection to a running VLC instance built on asyncio streams.
+
+    Has the same commands as `VLCClient`, but they return coroutines::
+
+        vlc = AsyncVLCClient('localhost')
+        await vlc.connect()
+        await vlc.goto(4)
+        async with vlc.batch() as batch:
+            length = batch.get_length()
+
+    Commands are serialized on the connection, so several tasks can share
+    one client.
+    """
+
+    def __init__(self, server, port=DEFAULT_PORT, password="admin", timeout=5, observer=None):
+        super(AsyncVLCClient, self).__init__(server, port, password, timeout, observer)
+        # created by connect(), on the event loop
+        self._lock = None
+        # replies still on their way for commands whose caller was cancelled
+        self._unread = 0
+
+    def _lost(self, exc):
+        if self._transport is not None:
+            # the event loop closes the socket, nothing to wait for
+            self._transport.writer.close()
+            self._transport = None
+        return ConnectionLost("lost connection to VLC at {0}: {1}".format(self.server, exc or "not connected"))
+
+    async def connect(self):
+        """
+        Connect to VLC and login
+        """
+        assert self._transport is None, "connect() called twice"
+
+        family, address = parse_address(self.server, self.port)
+        transport = AsyncTransport(family, address, self.timeout)
+        await transport.open()
+        try:
+            which, banner = await transport.expect([PASSWORD_PROMPT, PROMPT])
+            version = _match_version.search(banner)
+            if version:
+                self.server_version = version.group(1)
+                self.server_version_tuple = self.server_version.decode("utf-8").split('.')
+
+            if which == 0:
+                await transport.send(self.password.encode("utf-8") + b"\n")
+                which, _ = await transport.expect([PASSWORD_PROMPT, PROMPT])
+                if which == 0:
+                    raise WrongPasswordError()
+        except BaseException:
+            await transport.close()
+            raise
+        self._transport = transport
+        self._unread = 0
+        self.playlist_mirror = PlaylistMirror()
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+    async def disconnect(self):
+        """
+        Disconnect and close connection
+        """
+        await self._transport.close()
+        self._transport = None
+
+    async def _send_command(self, line):
+        return (await self._send_commands([line]))[0]
+
+    async def _send_commands(self, lines):
+        for line in lines:
+            _log.debug("vlc> {0}", line)
+        data = "".join(line + "\n" for line in lines).encode("utf-8")
+        if self._lock is None:
+            raise self._lost(None)
+        async with self._lock:
+            if self._transport is None:
+                raise self._lost(None)
+            replies = []
+            sent = False
+            try:
+                while self._unread:
+                    await self._transport.read_reply()
+                    self._unread -= 1
+                started = time.monotonic()
+                # the data is written before send() first waits
+                sent = True
+                await self._transport.send(data)
+                for line in lines:
+                    replies.append(await self._transport.read_reply())
+                    if self.observer is not None:
+                        self.observer(line, time.monotonic() - started)
+            except asyncio.CancelledError:
+                # the replies are read before the next command
+                if sent and self._transport is not None:
+                    self._unread += len(lines) - len(replies)
+                raise
+            except (OSError, EOFError, asyncio.TimeoutError) as exc:
+                raise self._lost(exc) from exc
+            return replies
+
+    async def _execute(self, line, parse=None):
+        reply = await self._send_command(line)
+        return reply if parse is None else parse(reply)
+
+    async def _run_batch(self, results):
+        if results:
+            _set_replies(results, await self._send_commands([result.command for result in results]))
+
+    async def search(self, query):
+        if not self.playlist_mirror.valid:
+            await self.playlist()
+        return self.playlist_mirror.index_of(query)
+
+
+class ConnectionLost(ConnectionError):
+    """The connection to VLC broke or was never made."""
+    pass
 
 
 class WrongPasswordError(Exception):
@@ -346,28 +1093,51 @@ class OldServerVersion(Exception):
     pass
 
 
+def run_command_file(vlc, path):
+    """
+    Send the raw commands in `path` (one per line, ``-`` for stdin) as a
+    single batch and print each reply. Empty lines and lines starting with
+    ``#`` are skipped.
+    """
+    stream = sys.stdin if path == "-" else open(path)
+    try:
+        lines = [line.strip() for line in stream]
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+    with vlc.batch() as batch:
+        for line in lines:
+            if line and not line.startswith("#"):
+                batch.raw(line)
+    for result in batch.results:
+        print("> {0}".format(result.command))
+        if result.value:
+            print(str(result.value, "utf-8"))
+
+
 def main():
     """
     Run any commands via CLI interface
     """
     try:
         server = sys.argv[1]
-        if ':' in server:
-            server, port = server.split(':')
-        else:
-            port = DEFAULT_PORT
-
         command_name = sys.argv[2]
     except IndexError:
-        print("usage: vlcclient.py server[:port] command [argument]",
+        print("usage: vlcclient.py server[:port]|unix:/path command [argument]\n"
+              "       vlcclient.py server[:port]|unix:/path -f commandfile|-",
               file=sys.stderr)
         sys.exit(1)
 
-    vlc = VLCClient(server, int(port))
+    vlc = VLCClient(server)
     vlc.connect()
     print("Connected to VLC {0}\n".format(vlc.server_version),
           file=sys.stderr)
 
+    if command_name == "-f":
+        run_command_file(vlc, sys.argv[3] if len(sys.argv) > 3 else "-")
+        return
+
     try:
         command = getattr(vlc, command_name)
         argspec = inspect.getfullargspec(command)
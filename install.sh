@@ -20,7 +20,7 @@ echo "=================================="
 # change the directoy to the script location
 cd "$(dirname "$0")"
 
-pip3 install setuptools inputs
+pip3 install setuptools
 python3 setup.py install --force
 
 cp ./assets/video_looper.ini /boot/video_looper.ini
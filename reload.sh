@@ -6,5 +6,6 @@ if [ "$(id -u)" != "0" ]; then
   exit 1
 fi
 
-# reload settings by restarting the video_looper
+# restart the video_looper, changed settings are applied without this unless
+# watch_config is false
 supervisorctl restart video_looper
\ No newline at end of file
@@ -7,5 +7,5 @@ setup(name              = 'Oxys_Video_Looper',
       description       = 'Play H265 video using VLC on Rpi4',
       license           = 'GNU GPLv2',
       url               = 'https://github.com/Oxyssweden/rpi-video-looper',
-      install_requires  = ['pyudev', 'inputs'],
+      install_requires  = ['pyudev'],
       packages          = find_packages())
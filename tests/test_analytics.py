@@ -0,0 +1,102 @@
+# License: GNU GPLv2, see LICENSE.txt
+"""The play log ring file: wraparound, reopening and the totals."""
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+
+from Oxys_Video_Looper.analytics import HEADER_SIZE, PREEMPTED, RECORD, REFUSED, PlayLog, read_plays, rollup
+
+
+class PlayLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'plays.dat')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, play_log, first, count):
+        for i in range(first, first + count):
+            play_log.record('BTN_{0}'.format(i), 1000.0 + i, latency=0.25, watched=i)
+        asyncio.run(play_log.flush())
+
+    def codes(self):
+        return [play.code for play in read_plays(self.path)]
+
+    def test_before_full(self):
+        self.write(PlayLog(self.path, 5), 0, 3)
+        plays = list(read_plays(self.path))
+        self.assertEqual([play.code for play in plays], ['BTN_0', 'BTN_1', 'BTN_2'])
+        self.assertEqual((plays[2].time, plays[2].latency, plays[2].watched, plays[2].flags), (1002.0, 0.25, 2.0, 0))
+        self.assertEqual(os.path.getsize(self.path), HEADER_SIZE + 3 * RECORD.size)
+
+    def test_wraparound(self):
+        play_log = PlayLog(self.path, 5)
+        self.write(play_log, 0, 3)
+        # slots 3 and 4, then 0 and 1 again
+        self.write(play_log, 3, 4)
+        self.assertEqual(self.codes(), ['BTN_2', 'BTN_3', 'BTN_4', 'BTN_5', 'BTN_6'])
+        for first in range(7, 40, 3):
+            self.write(play_log, first, 3)
+        self.assertEqual(self.codes(), ['BTN_{0}'.format(i) for i in range(35, 40)])
+        self.assertEqual(os.path.getsize(self.path), HEADER_SIZE + 5 * RECORD.size)
+
+    def test_batch_larger_than_the_ring(self):
+        self.write(PlayLog(self.path, 5), 0, 12)
+        self.assertEqual(self.codes(), ['BTN_{0}'.format(i) for i in range(7, 12)])
+
+    def test_reopened_file_keeps_its_capacity(self):
+        self.write(PlayLog(self.path, 4), 0, 3)
+        self.write(PlayLog(self.path, 100), 3, 3)
+        self.assertEqual(self.codes(), ['BTN_2', 'BTN_3', 'BTN_4', 'BTN_5'])
+
+    def test_long_code_and_values(self):
+        play_log = PlayLog(self.path, 5)
+        play_log.record('BTN_' + 'X' * 30, 1.0, latency=-1, watched=1e12, flags=REFUSED)
+        asyncio.run(play_log.flush())
+        play, = read_plays(self.path)
+        self.assertEqual(play.code, ('BTN_' + 'X' * 30)[:16])
+        self.assertEqual(play.latency, 0)
+        self.assertEqual(play.watched, 0xffffffff / 1e3)
+
+    def test_not_a_play_log(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'something else'.ljust(HEADER_SIZE, b'\0'))
+        with self.assertRaises(ValueError):
+            list(read_plays(self.path))
+        play_log = PlayLog(self.path, 5)
+        play_log.record('BTN_TOP', 1.0)
+        # kept to try again
+        asyncio.run(play_log.flush())
+        self.assertEqual(len(play_log._pending), 1)
+
+
+class RollupTest(unittest.TestCase):
+
+    def test_by_day_and_button(self):
+        noon = time.mktime((2026, 3, 1, 12, 0, 0, 0, 0, -1))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'plays.dat')
+            play_log = PlayLog(path, 100)
+            play_log.record('BTN_TOP', noon, latency=0.1, watched=10)
+            play_log.record('BTN_TOP', noon + 60, latency=0.3, watched=5, flags=PREEMPTED)
+            play_log.record('BTN_TOP', noon + 120, flags=REFUSED)
+            play_log.record('BTN_TOP', noon + 86400, latency=0.2, watched=1)
+            play_log.record('BTN_THUMB', noon, latency=0.2, watched=2)
+            asyncio.run(play_log.flush())
+            totals = rollup(read_plays(path))
+            hours = rollup(read_plays(path), 'hour', since=noon + 60)
+        self.assertEqual([(day, code) for day, code, stats in totals],
+                         [('2026-03-01', 'BTN_THUMB'), ('2026-03-01', 'BTN_TOP'), ('2026-03-02', 'BTN_TOP')])
+        stats = totals[1][2]
+        self.assertEqual((stats['presses'], stats['plays'], stats['preempted'], stats['watched']), (3, 2, 1, 15.0))
+        self.assertAlmostEqual(stats['latency'], 0.2)
+        self.assertEqual([(hour, code, stats['presses']) for hour, code, stats in hours],
+                         [('2026-03-01 12:00', 'BTN_TOP', 2), ('2026-03-02 12:00', 'BTN_TOP', 1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+# License: GNU GPLv2, see LICENSE.txt
+"""Requests and answers of the control socket and its HTTP front."""
+import asyncio
+import json
+import os
+import socket
+import tempfile
+import unittest
+
+from Oxys_Video_Looper.control import ControlServer, parse_request
+
+
+def handlers(triggered):
+    def trigger(request):
+        code = request.get('code')
+        if not code:
+            raise ValueError('trigger needs a button code')
+        triggered.append(code)
+        return {'queued': True}
+    return {'trigger': trigger, 'status': lambda request: {'playing': 'LOOP'}}
+
+
+class ParseRequestTest(unittest.TestCase):
+
+    def test_words(self):
+        self.assertEqual(parse_request(b'trigger BTN_TOP\n'), {'cmd': 'trigger', 'code': 'BTN_TOP'})
+        self.assertEqual(parse_request(b'  status \r\n'), {'cmd': 'status'})
+
+    def test_json(self):
+        self.assertEqual(parse_request(b'{"cmd": "trigger", "code": "BTN_TOP", "id": 7}\n'),
+                         {'cmd': 'trigger', 'code': 'BTN_TOP', 'id': 7})
+
+    def test_bad(self):
+        for line in (b'\n', b'{"code": "BTN_TOP"}', b'{"cmd": 1}', b'{"cmd": ', b'\xff\xfe'):
+            with self.assertRaises(ValueError, msg=line):
+                parse_request(line)
+
+
+class DispatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.triggered = []
+        self.server = ControlServer(handlers(self.triggered), path=None)
+
+    def answer(self, line):
+        return json.loads(self.server.answer(line))
+
+    def test_answers(self):
+        self.assertEqual(self.answer(b'trigger BTN_TOP'), {'queued': True, 'ok': True})
+        self.assertEqual(self.answer(b'{"cmd": "status", "id": "a"}'), {'playing': 'LOOP', 'ok': True, 'id': 'a'})
+        self.assertEqual(self.triggered, ['BTN_TOP'])
+
+    def test_refused(self):
+        self.assertEqual(self.answer(b'{"cmd": "trigger", "id": 3}'),
+                         {'ok': False, 'error': 'trigger needs a button code', 'id': 3})
+        self.assertEqual(self.answer(b'reboot'), {'ok': False, 'error': 'unknown command reboot'})
+        self.assertFalse(self.answer(b'{"cmd": ')['ok'])
+        self.assertEqual(self.triggered, [])
+
+    def test_one_line_per_answer(self):
+        line = self.server.answer(b'{"cmd": "trigger", "code": "A\\nB"}')
+        self.assertTrue(line.endswith(b'\n'))
+        self.assertEqual(line.count(b'\n'), 1)
+
+
+class ServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'control.sock')
+        self.triggered = []
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def serve(self, client, http_port=None):
+        server = ControlServer(handlers(self.triggered), self.path, http_port)
+
+        async def run():
+            task = asyncio.ensure_future(server.run())
+            while not os.path.exists(self.path):
+                await asyncio.sleep(0.01)
+            try:
+                return await client()
+            finally:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        return asyncio.run(run())
+
+    def test_pipelined_requests(self):
+        async def client():
+            reader, writer = await asyncio.open_unix_connection(self.path)
+            writer.write(b'trigger BTN_TOP\n\n{"cmd": "status", "id": 2}\nnope\n')
+            answers = [json.loads(await reader.readline()) for _ in range(3)]
+            writer.close()
+            return answers
+        self.assertEqual(self.serve(client), [
+            {'queued': True, 'ok': True},
+            {'playing': 'LOOP', 'ok': True, 'id': 2},
+            {'ok': False, 'error': 'unknown command nope'}])
+        # the socket is removed when the server stops
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_http(self):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+
+        async def request(method, path):
+            # it listens a moment after the socket
+            for _ in range(100):
+                try:
+                    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                    break
+                except ConnectionRefusedError:
+                    await asyncio.sleep(0.01)
+            writer.write('{0} {1} HTTP/1.0\r\nHost: localhost\r\n\r\n'.format(method, path).encode())
+            status = (await reader.readline()).split(b' ', 1)[1].strip()
+            while (await reader.readline()).strip():
+                pass
+            body = json.loads(await reader.read())
+            writer.close()
+            return status, body
+
+        async def client():
+            return [await request('GET', '/status'), await request('POST', '/trigger/BTN_TOP'),
+                    await request('POST', '/trigger'), await request('GET', '/trigger/BTN_TOP'),
+                    await request('GET', '/nope')]
+        answers = self.serve(client, port)
+        self.assertEqual(answers[0], (b'200 OK', {'playing': 'LOOP', 'ok': True}))
+        self.assertEqual(answers[1], (b'200 OK', {'queued': True, 'ok': True}))
+        self.assertEqual(answers[2][0], b'400 Bad Request')
+        self.assertEqual(answers[3][0], b'405 Method Not Allowed')
+        self.assertEqual(answers[4][0], b'404 Not Found')
+        self.assertEqual(self.triggered, ['BTN_TOP'])
+
+    def test_leaves_other_files(self):
+        with open(self.path, 'w') as f:
+            f.write('not a socket')
+        server = ControlServer({}, self.path)
+        server._remove_socket()
+        self.assertTrue(os.path.isfile(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
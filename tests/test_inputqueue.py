@@ -0,0 +1,114 @@
+# License: GNU GPLv2, see LICENSE.txt
+"""Debouncing, merging and dropping of button presses by the input queue."""
+import asyncio
+import configparser
+import unittest
+
+from Oxys_Video_Looper.inputqueue import PRUNE_AT, InputQueue, input_queue_settings
+
+
+def drain(queue):
+    async def get_all():
+        return [await queue.get() for _ in range(len(queue))]
+    return asyncio.run(get_all())
+
+
+class InputQueueTest(unittest.TestCase):
+
+    def test_debounce(self):
+        queue = InputQueue(debounce=0.3)
+        self.assertTrue(queue.put('BTN_TOP', 10.0))
+        self.assertFalse(queue.put('BTN_TOP', 10.2))
+        # other buttons have their own window
+        self.assertTrue(queue.put('BTN_THUMB', 10.2))
+        self.assertEqual(drain(queue), ['BTN_TOP', 'BTN_THUMB'])
+        self.assertTrue(queue.put('BTN_TOP', 10.31))
+        self.assertEqual(queue.stats()['debounced'], 1)
+
+    def test_debounce_from_the_last_accepted_press(self):
+        queue = InputQueue(debounce=0.3)
+        for timestamp in (0.0, 0.2, 0.4):
+            queue.put('BTN_TOP', timestamp)
+            drain(queue)
+        # 0.2 was debounced, 0.4 is 0.4 after the accepted one
+        self.assertEqual(queue.stats()['debounced'], 1)
+
+    def test_button_debounce(self):
+        queue = InputQueue(debounce=0.3, button_debounce={'BTN_TRIGGER': 2.0})
+        queue.put('BTN_TRIGGER', 0.0)
+        queue.put('BTN_TOP', 0.0)
+        drain(queue)
+        self.assertFalse(queue.put('BTN_TRIGGER', 1.0))
+        self.assertTrue(queue.put('BTN_TOP', 1.0))
+
+    def test_coalesce(self):
+        queue = InputQueue(debounce=0)
+        queue.put('BTN_TOP', 0.0)
+        queue.put('BTN_THUMB', 1.0)
+        self.assertFalse(queue.put('BTN_TOP', 2.0))
+        self.assertEqual(drain(queue), ['BTN_TOP', 'BTN_THUMB'])
+        self.assertEqual(queue.stats()['coalesced'], 1)
+
+    def test_full_queue_drops_the_oldest(self):
+        queue = InputQueue(maxsize=2, debounce=0)
+        for i, code in enumerate(('A', 'B', 'C', 'D')):
+            self.assertTrue(queue.put(code, float(i)))
+        self.assertEqual(drain(queue), ['C', 'D'])
+        self.assertEqual(queue.stats()['dropped'], 2)
+
+    def test_take_latest(self):
+        queue = InputQueue(debounce=0)
+        self.assertEqual(queue.take_latest('A'), ('A', []))
+        for i, code in enumerate(('B', 'C', 'D')):
+            queue.put(code, float(i))
+        self.assertEqual(queue.take_latest('A'), ('D', ['A', 'B', 'C']))
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(queue.stats()['dropped'], 3)
+
+    def test_configure_keeps_the_newest(self):
+        queue = InputQueue(maxsize=4, debounce=0)
+        for i, code in enumerate(('A', 'B', 'C', 'D')):
+            queue.put(code, float(i))
+        queue.configure(maxsize=1, debounce=5)
+        self.assertEqual(queue.stats()['dropped'], 3)
+        self.assertFalse(queue.put('D', 7.0))
+        self.assertEqual(drain(queue), ['D'])
+
+    def test_counts_add_up(self):
+        queue = InputQueue(maxsize=2, debounce=0.5)
+        for code, timestamp in (('A', 0.0), ('A', 0.1), ('B', 1.0), ('A', 2.0), ('C', 3.0)):
+            queue.put(code, timestamp)
+        self.assertEqual(drain(queue), ['B', 'C'])
+        self.assertEqual(queue.stats(), {'received': 5, 'debounced': 1, 'coalesced': 1, 'dropped': 1, 'waiting': 0})
+
+    def test_prunes_old_presses(self):
+        queue = InputQueue(maxsize=1, debounce=0.3)
+        for i in range(PRUNE_AT * 4):
+            queue.put('CODE_{0}'.format(i), float(i))
+        self.assertLessEqual(len(queue._last), PRUNE_AT + 1)
+        # a pruned press could no longer debounce anyway
+        self.assertTrue(queue.put('CODE_0', float(PRUNE_AT * 4)))
+
+    def test_get_waits_for_a_press(self):
+        queue = InputQueue()
+
+        async def wait():
+            asyncio.get_running_loop().call_later(0.01, queue.put, 'BTN_TOP')
+            return await asyncio.wait_for(queue.get(), 1)
+
+        self.assertEqual(asyncio.run(wait()), 'BTN_TOP')
+
+
+class SettingsTest(unittest.TestCase):
+
+    def test_settings(self):
+        config = configparser.ConfigParser()
+        config.read_string('[input]\nqueue_size = 2\ndebounce = 0.5\ndebounce_BTN_TRIGGER = 1\n')
+        self.assertEqual(input_queue_settings(config), (2, 0.5, {'BTN_TRIGGER': 1.0}))
+
+    def test_defaults(self):
+        self.assertEqual(input_queue_settings(configparser.ConfigParser()), (4, 0.3, {}))
+
+
+if __name__ == '__main__':
+    unittest.main()
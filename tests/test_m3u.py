@@ -0,0 +1,76 @@
+# License: GNU GPLv2, see LICENSE.txt
+"""Parsing of M3U playlists, streamed and by index."""
+import os
+import tempfile
+import unittest
+
+from Oxys_Video_Looper.m3u import M3uPlaylist, iter_m3u, repeats
+
+PLAYLIST = (
+    b'\xef\xbb\xbf#EXTM3U\r\n'
+    b'#EXTINF:12.5,First title\r\n'
+    b'first.mp4\r\n'
+    b'\r\n'
+    b'# a comment\n'
+    b'#EXTINF:-1,\n'
+    b'sub/second_repeat_3x.mp4\n'
+    b'/media/third_REPEAT_2x.mp4\n'
+    b'#EXTINF:7,Caf\xc3\xa9\n'
+    b'http://example.com/fourth.mp4\n'
+)
+
+
+class M3uTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'list.m3u')
+        with open(self.path, 'wb') as f:
+            f.write(PLAYLIST)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def expected(self, base):
+        return [
+            (os.path.join(base, 'first.mp4'), 'First title', 1, 12.5),
+            (os.path.join(base, 'sub/second_repeat_3x.mp4'), None, 3, None),
+            ('/media/third_REPEAT_2x.mp4', None, 2, None),
+            ('http://example.com/fourth.mp4', 'Café', 1, 7.0),
+        ]
+
+    def test_iter(self):
+        movies = [(movie.filename, movie.title, movie.repeats, movie.duration) for movie in iter_m3u(self.path)]
+        self.assertEqual(movies, self.expected(self.directory.name))
+
+    def test_by_index(self):
+        playlist = M3uPlaylist(self.path, '/videos', cache_size=1)
+        self.assertEqual(len(playlist), 4)
+        # backwards, every entry is parsed from its offset
+        movies = [playlist[index] for index in (3, 2, 1, 0, -1)]
+        self.assertEqual([(movie.filename, movie.title, movie.repeats, movie.duration) for movie in movies],
+                         self.expected('/videos')[::-1] + [self.expected('/videos')[-1]])
+        with self.assertRaises(IndexError):
+            playlist[4]
+
+    def test_find(self):
+        found = M3uPlaylist(self.path).find(['first', 'second_repeat_3x.mp4', 'missing'])
+        self.assertEqual(sorted(found), ['first', 'second_repeat_3x.mp4'])
+        self.assertEqual(found['first'].title, 'First title')
+
+    def test_stale(self):
+        playlist = M3uPlaylist(self.path)
+        self.assertFalse(playlist.stale())
+        with open(self.path, 'ab') as f:
+            f.write(b'fifth.mp4\n')
+        self.assertTrue(playlist.stale())
+
+    def test_repeats(self):
+        self.assertEqual(repeats('clip.mp4'), 1)
+        self.assertEqual(repeats('clip_repeat_4x.mp4'), 4)
+        self.assertEqual(repeats('/a_repeat_5x/clip.mp4'), 1)
+        self.assertEqual(repeats('clip_repeat_0x.mp4'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
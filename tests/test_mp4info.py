@@ -0,0 +1,79 @@
+# License: GNU GPLv2, see LICENSE.txt
+"""Half copied and damaged MP4 files raise Mp4Error and nothing else."""
+import struct
+import unittest
+
+from Oxys_Video_Looper.mp4info import Mp4Error, parse
+
+
+def box(kind, payload):
+    return struct.pack('>I4s', 8 + len(payload), kind) + payload
+
+
+def full_box(kind, payload):
+    return box(kind, bytes(4) + payload)
+
+
+def make_mp4(cut=None, keep=None):
+    """A small HEVC file, 12 s at 25 fps. With `cut` the payload of the
+    first box of that kind is cut to `keep` bytes, its size still fits."""
+    def part(kind, payload, full=True):
+        if kind == cut:
+            payload = (bytes(4) + payload)[:keep] if full else payload[:keep]
+            return box(kind, payload)
+        return full_box(kind, payload) if full else box(kind, payload)
+
+    entry = box(b'hvc1', bytes(6) + struct.pack('>H', 1) + bytes(16) + struct.pack('>HH', 3840, 2160) + bytes(50))
+    stbl = box(b'stbl', part(b'stsd', struct.pack('>I', 1) + entry)
+               + part(b'stts', struct.pack('>III', 1, 300, 3600)))
+    mdia = box(b'mdia', part(b'mdhd', struct.pack('>IIII', 0, 0, 90000, 1080000) + bytes(4))
+               + part(b'hdlr', bytes(4) + b'vide' + bytes(13)) + box(b'minf', stbl))
+    moov = box(b'moov', part(b'mvhd', struct.pack('>IIII', 0, 0, 90000, 1080000) + bytes(80))
+               + box(b'trak', mdia))
+    return part(b'ftyp', b'isom' + bytes(4) + b'isom', full=False) + moov + box(b'mdat', bytes(64))
+
+
+class TruncatedBoxTest(unittest.TestCase):
+
+    def test_complete(self):
+        info = parse(make_mp4())
+        self.assertEqual(info['codec'], 'hvc1')
+        self.assertEqual((info['width'], info['height']), (3840, 2160))
+        self.assertEqual(info['duration_us'], 12000000)
+        self.assertEqual(info['fps'], 25.0)
+
+    def test_truncated_payloads(self):
+        # bytes of each payload needed to read what the parser takes from it
+        needed = {b'ftyp': 4, b'mvhd': 20, b'mdhd': 20, b'hdlr': 12, b'stsd': 16, b'stts': 16}
+        complete = parse(make_mp4())
+        for kind, need in needed.items():
+            for keep in range(0, 20):
+                with self.subTest(box=kind, keep=keep):
+                    if keep < need:
+                        with self.assertRaises(Mp4Error):
+                            parse(make_mp4(kind, keep))
+                        continue
+                    info = parse(make_mp4(kind, keep))
+                    if kind == b'stsd':
+                        # the size comes after the codec, the rest is there
+                        self.assertEqual(info, {key: value for key, value in complete.items()
+                                                if key not in ('width', 'height')})
+                    else:
+                        self.assertEqual(info, complete)
+
+    def test_truncated_file(self):
+        data = make_mp4()
+        complete = parse(data)
+        # the mdat box, 72 bytes, is not read: cut before its header is
+        # complete it is not seen at all, cut after that its size is wrong
+        moov_end = len(data) - 72
+        for length in range(len(data)):
+            with self.subTest(length=length):
+                if moov_end <= length < moov_end + 8:
+                    self.assertEqual(parse(data[:length]), complete)
+                else:
+                    with self.assertRaises(Mp4Error):
+                        parse(data[:length])
+
+if __name__ == '__main__':
+    unittest.main()
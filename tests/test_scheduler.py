@@ -0,0 +1,124 @@
+# License: GNU GPLv2, see LICENSE.txt
+"""Orders of the playlist scheduler and the rotation kept by Playlist."""
+import collections
+import itertools
+import os
+import random
+import tempfile
+import unittest
+
+from Oxys_Video_Looper.m3u import M3uPlaylist
+from Oxys_Video_Looper.model import Movie, Playlist
+from Oxys_Video_Looper.scheduler import Scheduler
+
+
+def movies(*repeats):
+    return [Movie('movie{0}.mp4'.format(i), repeats=count) for i, count in enumerate(repeats)]
+
+
+def picks(scheduler, count):
+    return [scheduler.next() for _ in range(count)]
+
+
+class SequentialTest(unittest.TestCase):
+
+    def test_order_and_wraparound(self):
+        self.assertEqual(picks(Scheduler(movies(1, 1, 1)), 7), [0, 1, 2, 0, 1, 2, 0])
+
+    def test_repeats_in_a_row(self):
+        self.assertEqual(picks(Scheduler(movies(1, 3, 2)), 12), [0, 1, 1, 1, 2, 2, 0, 1, 1, 1, 2, 2])
+
+    def test_empty(self):
+        self.assertIsNone(Scheduler([]).next())
+
+
+class ShuffleTest(unittest.TestCase):
+
+    def test_every_movie_once_per_bag(self):
+        scheduler = Scheduler(movies(*[1] * 10), 'shuffle', random.Random(1))
+        for _ in range(20):
+            self.assertEqual(sorted(picks(scheduler, 10)), list(range(10)))
+
+    def test_no_movie_twice_in_a_row(self):
+        scheduler = Scheduler(movies(1, 1, 1), 'shuffle', random.Random(2))
+        played = picks(scheduler, 3000)
+        self.assertFalse([i for i in range(1, len(played)) if played[i] == played[i - 1]])
+
+    def test_repeats_in_a_row(self):
+        scheduler = Scheduler(movies(2, 1, 3), 'shuffle', random.Random(3))
+        runs = [(index, len(list(group))) for index, group in itertools.groupby(picks(scheduler, 60))]
+        # the last run may be cut off
+        for index, length in runs[:-1]:
+            self.assertEqual(length, [2, 1, 3][index])
+
+    def test_single_movie(self):
+        self.assertEqual(picks(Scheduler(movies(1), 'shuffle'), 3), [0, 0, 0])
+
+
+class WeightedTest(unittest.TestCase):
+
+    def test_frequency_follows_repeats(self):
+        scheduler = Scheduler(movies(1, 2, 7), 'weighted', random.Random(4))
+        played = picks(scheduler, 20000)
+        counts = collections.Counter(played)
+        self.assertLess(counts[0], counts[1])
+        self.assertLess(counts[1], counts[2])
+        # a movie is not picked twice in a row, after movie 0 the others
+        # follow 2:7
+        after = collections.Counter(played[i] for i in range(1, len(played)) if played[i - 1] == 0)
+        self.assertAlmostEqual(after[2] / (after[1] + after[2]), 7 / 9, delta=0.03)
+
+    def test_rarely_twice_in_a_row(self):
+        scheduler = Scheduler(movies(1, 1, 1, 1), 'weighted', random.Random(5))
+        played = picks(scheduler, 2000)
+        self.assertFalse([i for i in range(1, len(played)) if played[i] == played[i - 1]])
+
+
+class StateTest(unittest.TestCase):
+
+    def test_restore_sequential(self):
+        first = Scheduler(movies(1, 2, 1, 1))
+        picks(first, 2)
+        second = Scheduler(movies(1, 2, 1, 1))
+        self.assertTrue(second.restore(first.state()))
+        self.assertEqual(picks(second, 6), [1, 2, 3, 0, 1, 1])
+
+    def test_restore_shuffle_finishes_the_bag(self):
+        first = Scheduler(movies(1, 1, 1, 1, 1), 'shuffle', random.Random(6))
+        played = picks(first, 2)
+        second = Scheduler(movies(1, 1, 1, 1, 1), 'shuffle', random.Random(7))
+        self.assertTrue(second.restore(first.state()))
+        self.assertEqual(sorted(played + picks(second, 3)), [0, 1, 2, 3, 4])
+
+    def test_restore_other_playlist(self):
+        state = Scheduler(movies(1, 1), 'shuffle').state()
+        scheduler = Scheduler(movies(1, 1, 1), 'shuffle')
+        self.assertFalse(scheduler.restore(state))
+        self.assertFalse(Scheduler(movies(1, 1), 'sequential').restore(state))
+
+
+class PlaylistTest(unittest.TestCase):
+
+    def test_playcount_survives_eviction(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'list.m3u')
+            with open(path, 'w') as f:
+                f.write('#EXTM3U\n')
+                for i in range(4):
+                    f.write('#EXTINF:10,Movie {0}\nmovie{0}_repeat_3x.mp4\n'.format(i))
+            entries = M3uPlaylist(path, cache_size=1)
+            playlist = Playlist(entries)
+            counts = []
+            for _ in range(7):
+                movie = playlist.get_next(False)
+                # evicts it, the next play parses the entry again
+                entries[3]
+                counts.append((os.path.basename(movie.filename), playlist.playcount, movie.playcount))
+            self.assertEqual(counts, [
+                ('movie0_repeat_3x.mp4', 1, 1), ('movie0_repeat_3x.mp4', 2, 2), ('movie0_repeat_3x.mp4', 3, 3),
+                ('movie1_repeat_3x.mp4', 1, 1), ('movie1_repeat_3x.mp4', 2, 2), ('movie1_repeat_3x.mp4', 3, 3),
+                ('movie2_repeat_3x.mp4', 1, 1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,297 @@
+# License: GNU GPLv2, see LICENSE.txt
+"""Reply framing, batches and the playlist mirror of the VLC client, the
+clients against the fake VLC server."""
+import asyncio
+import socket
+import threading
+import unittest
+
+from Oxys_Video_Looper.fakevlc import FakeVlc, FakeVlcServer
+from Oxys_Video_Looper.vlcclient import (PASSWORD_PROMPT, PROMPT, AsyncVLCClient, ConnectionLost, PlaylistMirror,
+                                         ReplyBuffer, VLCClient, WrongPasswordError)
+
+
+def replies(buffer):
+    """Every complete reply in the buffer."""
+    found = []
+    reply = buffer.next_reply()
+    while reply is not None:
+        found.append(reply)
+        reply = buffer.next_reply()
+    return found
+
+
+class ReplyBufferTest(unittest.TestCase):
+
+    def test_reply_split_across_reads(self):
+        buffer = ReplyBuffer()
+        for part in (b'hel', b'lo\r', b'\n', b'>'):
+            buffer.feed(part)
+            self.assertIsNone(buffer.next_reply())
+        buffer.feed(b' ')
+        self.assertEqual(buffer.next_reply(), b'hello')
+        self.assertIsNone(buffer.next_reply())
+
+    def test_several_replies_in_one_read(self):
+        buffer = ReplyBuffer()
+        buffer.feed(b'1\r\n> > two\r\nlines\r\n> 3')
+        self.assertEqual(replies(buffer), [b'1', b'', b'two\r\nlines'])
+        buffer.feed(b'\r\n> ')
+        self.assertEqual(replies(buffer), [b'3'])
+
+    def test_prompt_inside_a_line(self):
+        buffer = ReplyBuffer()
+        buffer.feed(b'a > b\r\n> ')
+        self.assertEqual(replies(buffer), [b'a > b'])
+
+    def test_grows_for_long_replies(self):
+        buffer = ReplyBuffer(bufsize=16)
+        data = bytes(range(32, 127)) * 20
+        stream = data + b'\r\n> ' + b'short\r\n> '
+        found = []
+        for offset in range(0, len(stream), 7):
+            buffer.feed(stream[offset:offset + 7])
+            found += replies(buffer)
+        self.assertEqual(found, [data, b'short'])
+
+    def test_reused_many_times(self):
+        buffer = ReplyBuffer(bufsize=32)
+        found = []
+        for i in range(500):
+            buffer.feed('{0}\r'.format(i).encode())
+            buffer.feed(b'\n> ')
+            found += replies(buffer)
+        self.assertEqual(found, [str(i).encode() for i in range(500)])
+
+    def test_next_match(self):
+        buffer = ReplyBuffer()
+        buffer.feed(b'VLC media player 3.0.18\r\nPass')
+        self.assertIsNone(buffer.next_match([PASSWORD_PROMPT, PROMPT]))
+        buffer.feed(b'word: \xff\xfb\x01')
+        self.assertEqual(buffer.next_match([PASSWORD_PROMPT, PROMPT]), (0, b'VLC media player 3.0.18\r\n'))
+        # the telnet negotiation is left out
+        buffer.feed(b'\xff\xfc\x01\r\nWelcome, Master\r\n> ')
+        self.assertEqual(buffer.next_match([PASSWORD_PROMPT, PROMPT]), (1, b'\r\nWelcome, Master\r\n'))
+
+    def test_closed(self):
+        with self.assertRaises(EOFError):
+            ReplyBuffer().feed(b'')
+
+    def test_recv_from(self):
+        buffer = ReplyBuffer(bufsize=8)
+        ours, theirs = socket.socketpair()
+        with ours, theirs:
+            theirs.sendall(b'status\r\n> ')
+            while buffer.next_reply() is None:
+                buffer.recv_from(ours)
+            theirs.close()
+            with self.assertRaises(EOFError):
+                buffer.recv_from(ours)
+
+
+class FakeServerThread:
+    """A FakeVlcServer on an event loop of its own thread, for the blocking
+    client."""
+
+    def __init__(self, vlc, password='admin'):
+        self.server = FakeVlcServer(vlc, password)
+        self.loop = asyncio.new_event_loop()
+        self.address = self.loop.run_until_complete(self.server.start())
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    async def _close(self):
+        await self.server.close()
+        # the connections too
+        clients = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in clients:
+            task.cancel()
+        await asyncio.gather(*clients, return_exceptions=True)
+        await asyncio.sleep(0)
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self._close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+class VLCClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.vlc = FakeVlc({'loop': 30, 'clip': 12})
+        self.server = FakeServerThread(self.vlc)
+        self.client = VLCClient(self.server.address)
+        self.client.connect()
+
+    def tearDown(self):
+        if self.client.connected:
+            self.client.disconnect()
+        self.server.close()
+
+    def test_commands(self):
+        self.assertEqual(self.client.server_version, b'3.0.18')
+        self.client.add('/media/loop.mp4')
+        self.assertEqual(self.client.get_length(), 30)
+        self.assertTrue(self.client.is_playing())
+        self.assertEqual(self.client.search('loop'), 3)
+        self.assertEqual(self.client.playing_index(), 3)
+
+    def test_batch(self):
+        with self.client.batch() as batch:
+            batch.enqueue('/media/loop.mp4')
+            batch.add('/media/clip.mp4')
+            length = batch.get_length()
+            index = batch.search('clip')
+            self.assertIsNone(length.value)
+        self.assertEqual((length.value, length.raw), (12, b'12'))
+        self.assertEqual(index.value, 4)
+        self.assertEqual([result.command for result in batch.results],
+                         ['enqueue /media/loop.mp4', 'add /media/clip.mp4', 'get_length', 'playlist'])
+        self.assertEqual(self.vlc.commands, [result.command for result in batch.results])
+
+    def test_batch_not_sent_on_error(self):
+        with self.assertRaises(KeyError):
+            with self.client.batch() as batch:
+                batch.add('/media/clip.mp4')
+                raise KeyError()
+        self.assertEqual(self.vlc.commands, [])
+
+    def test_wrong_password(self):
+        client = VLCClient(self.server.address, password='wrong')
+        with self.assertRaises(WrongPasswordError):
+            client.connect()
+        self.assertFalse(client.connected)
+
+    def test_lost_connection(self):
+        self.server.close()
+        with self.assertRaises(ConnectionLost):
+            self.client.get_length()
+        self.assertFalse(self.client.connected)
+        with self.assertRaises(ConnectionLost):
+            self.client.get_length()
+        # closed again by tearDown
+        self.server = FakeServerThread(self.vlc)
+
+
+class AsyncVLCClientTest(unittest.TestCase):
+
+    def run_client(self, test):
+        async def run():
+            server = FakeVlcServer(self.vlc)
+            address = await server.start()
+            client = AsyncVLCClient(address)
+            try:
+                await client.connect()
+                return await test(client)
+            finally:
+                if client.connected:
+                    await client.disconnect()
+                await server.close()
+        return asyncio.run(run())
+
+    def setUp(self):
+        self.vlc = FakeVlc({'loop': 30, 'clip': 12})
+
+    def test_batch(self):
+        async def test(client):
+            async with client.batch() as batch:
+                batch.add('/media/loop.mp4')
+                batch.enqueue('/media/clip.mp4')
+                index = batch.search('clip.mp4')
+                playing = batch.is_playing()
+            return index.value, playing.value, await client.playing_index()
+        self.assertEqual(self.run_client(test), (4, True, 3))
+
+    def test_concurrent_commands(self):
+        async def test(client):
+            await client.add('/media/clip.mp4')
+            # serialized on the connection, every caller gets its own reply
+            return await asyncio.gather(*(client.get_length() if i % 2 else client.is_playing()
+                                          for i in range(20)))
+        self.assertEqual(self.run_client(test), [True, 12] * 10)
+
+    def test_cancelled_command(self):
+        async def test(client):
+            await client.add('/media/clip.mp4')
+            task = asyncio.ensure_future(client.is_playing())
+            await asyncio.sleep(0)
+            task.cancel()
+            # the reply of the cancelled command is not taken for this one
+            return await client.get_length()
+        self.assertEqual(self.run_client(test), 12)
+
+
+def listing(items, current=None):
+    """Reply of the `playlist` command for (index, name) pairs."""
+    lines = ['+----[ Playlist - playlist ]', '| 1 - Playlist']
+    for index, name in items:
+        lines.append('|   {0}{1} - {2} (00:00:10)'.format('*' if index == current else '', index, name))
+    lines += ['| 2 - Media Library', '|   5 - other.mp4 (00:00:10)', '+----[ End of playlist ]']
+    return '\r\n'.join(lines).encode('utf-8')
+
+
+class PlaylistMirrorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mirror = PlaylistMirror()
+        self.mirror.load(listing([(3, 'loop.mp4')], current=3))
+
+    def test_load(self):
+        self.assertEqual(sorted(self.mirror.items), [3])
+        self.assertEqual(self.mirror.items[3].duration, 10)
+        self.assertEqual(self.mirror.current, 3)
+        self.assertEqual(self.mirror.index_of('loop'), 3)
+        # the media library is not part of the playlist
+        self.assertIsNone(self.mirror.index_of('other.mp4'))
+
+    def test_titled_item_by_file_name(self):
+        self.mirror.expect('/media/clip.mp4')
+        self.assertFalse(self.mirror.valid)
+        self.mirror.load(listing([(3, 'loop.mp4'), (4, 'My Clip')], current=3))
+        self.assertTrue(self.mirror.valid)
+        self.assertEqual(self.mirror.index_of('My Clip'), 4)
+        self.assertEqual(self.mirror.index_of('clip.mp4'), 4)
+        self.assertEqual(self.mirror.index_of('clip'), 4)
+
+    def test_failed_add(self):
+        # a.mp4 was not added, b.mp4 must not be taken for it
+        self.mirror.expect('/media/a.mp4')
+        self.mirror.expect('/media/b.mp4')
+        self.mirror.load(listing([(3, 'loop.mp4'), (4, 'b.mp4')], current=3))
+        self.assertIsNone(self.mirror.index_of('a.mp4'))
+        self.assertEqual(self.mirror.index_of('b'), 4)
+
+    def test_failed_add_before_titled_item(self):
+        self.mirror.expect('/media/a.mp4')
+        self.mirror.expect('/media/b.mp4')
+        self.mirror.expect('/media/c.mp4')
+        self.mirror.load(listing([(3, 'loop.mp4'), (4, 'b.mp4'), (5, 'See')], current=3))
+        self.assertEqual(self.mirror.index_of('b.mp4'), 4)
+        # one title for a.mp4 and c.mp4, which one it is cannot be told
+        self.assertIsNone(self.mirror.index_of('a.mp4'))
+        self.assertIsNone(self.mirror.index_of('c.mp4'))
+        self.assertEqual(self.mirror.index_of('See'), 5)
+
+    def test_same_file_twice(self):
+        self.mirror.expect('/media/a.mp4')
+        self.mirror.expect('/media/a.mp4')
+        self.mirror.load(listing([(3, 'loop.mp4'), (4, 'A'), (6, 'A')], current=6))
+        self.assertEqual(self.mirror.index_of('a.mp4'), 6)
+        self.mirror.remove(6)
+        self.assertEqual(self.mirror.index_of('a.mp4'), 4)
+        self.assertIsNone(self.mirror.current)
+
+    def test_set_current(self):
+        self.mirror.expect('/media/a.mp4')
+        self.mirror.load(listing([(3, 'loop.mp4'), (4, 'a.mp4'), (6, 'loop.mp4')], current=4))
+        # the copy of the loop after the clip, not the first one
+        self.assertEqual(self.mirror.set_current('loop.mp4'), 6)
+        self.assertEqual(self.mirror.set_current('loop.mp4'), 6)
+        self.mirror.set_current('unknown.mp4')
+        self.assertFalse(self.mirror.valid)
+        self.assertIsNone(self.mirror.current)
+
+
+if __name__ == '__main__':
+    unittest.main()